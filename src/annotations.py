@@ -0,0 +1,262 @@
+# reading and writing Pascal VOC .xml label files
+# shared by all the scripts so the label format lives in one place
+import os
+import threading
+from array import array
+from xml.etree.ElementTree import iterparse, tostring
+from xml.sax.saxutils import escape
+
+class Annotation:
+    """
+    The contents of one Pascal VOC label file.
+    Boxes are stored flat in an int array as xmin, ymin, xmax, ymax per object.
+    Object fields this module doesn't know about are kept as raw xml so rewriting a label doesn't lose them.
+    """
+    __slots__ = ('folder', 'filename', 'path', 'width', 'height', 'depth', 'names', 'boxes', 'difficult', 'truncated', 'poses', 'extras')
+
+    def __init__(self, folder='', filename='', path='', width=0, height=0, depth=3):
+        self.folder = folder
+        self.filename = filename
+        self.path = path
+        self.width = width
+        self.height = height
+        self.depth = depth
+        self.names = []
+        self.boxes = array('i')
+        self.difficult = array('b')
+        self.truncated = array('b')
+        self.poses = []
+        self.extras = []
+
+    def add(self, name, box, difficult=0, truncated=0, pose='Unspecified', extra=()):
+        """
+        Add an object to the annotation
+        Args:
+            name: the unit abbreviation
+            box: (xmin, ymin, xmax, ymax); floats are truncated like the old writer did
+            difficult: the VOC difficult flag
+            truncated: the VOC truncated flag
+            pose: the VOC pose
+            extra: xml strings of any other fields of the object, written back as they are
+        """
+        self.names.append(name)
+        self.boxes.extend(int(v) for v in box[:4])
+        self.difficult.append(int(difficult))
+        self.truncated.append(int(truncated))
+        self.poses.append(pose)
+        self.extras.append(tuple(extra))
+
+    def box(self, i) -> tuple:
+        """
+        Get the (xmin, ymin, xmax, ymax) box of the i-th object
+        """
+        return tuple(self.boxes[4*i:4*i + 4])
+
+    def objects(self):
+        """
+        Iterate over the objects in the annotation
+        Yields:
+            tuples of (name, (xmin, ymin, xmax, ymax))
+        """
+        for i, name in enumerate(self.names):
+            yield name, self.box(i)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return f'Annotation({self.filename!r}, {len(self)} objects)'
+
+def to_xml(annotation) -> str:
+    """
+    Serialize an annotation to Pascal VOC xml
+    Args:
+        annotation: the Annotation to serialize
+    Returns:
+        the xml document as a string
+    """
+    parts = [
+        '<annotation>\n',
+        f'\t<folder>{escape(str(annotation.folder))}</folder>\n',
+        f'\t<filename>{escape(str(annotation.filename))}</filename>\n',
+        f'\t<path>{escape(str(annotation.path))}</path>\n',
+        '\t<source>\n\t\t<database>Unknown</database>\n\t</source>\n',
+        f'\t<size>\n\t\t<width>{annotation.width}</width>\n\t\t<height>{annotation.height}</height>\n\t\t<depth>{annotation.depth}</depth>\n\t</size>\n',
+        '\t<segmented>0</segmented>\n',
+    ]
+    boxes = annotation.boxes
+    for i, name in enumerate(annotation.names):
+        parts.append(
+            f'\t<object>\n\t\t<name>{escape(name)}</name>\n\t\t<pose>{escape(str(annotation.poses[i]))}</pose>\n'
+            f'\t\t<truncated>{annotation.truncated[i]}</truncated>\n\t\t<difficult>{annotation.difficult[i]}</difficult>\n'
+            f'\t\t<bndbox>\n\t\t\t<xmin>{boxes[4*i]}</xmin>\n\t\t\t<ymin>{boxes[4*i + 1]}</ymin>\n'
+            f'\t\t\t<xmax>{boxes[4*i + 2]}</xmax>\n\t\t\t<ymax>{boxes[4*i + 3]}</ymax>\n\t\t</bndbox>\n')
+        for extra in annotation.extras[i]:
+            parts.append(f'\t\t{extra}\n')
+        parts.append('\t</object>\n')
+    parts.append('</annotation>\n')
+    return ''.join(parts)
+
+def write_annotation(xml_path, annotation, atomic=False):
+    """
+    Write an annotation to disk with a single write call
+    Args:
+        xml_path: the .xml file to write
+        annotation: the Annotation to write
+        atomic: write to a temporary file and rename it into place, so readers and
+                other writers never see a half written file (e.g. if the process is killed)
+    """
+    data = to_xml(annotation).encode()
+    if not atomic:
+        with open(xml_path, 'wb') as f:
+            f.write(data)
+        return
+    # the temporary file is hidden and doesn't end in .xml, so globs over the labels folder skip it
+    tmp_path = os.path.join(os.path.dirname(xml_path), f'.{os.path.basename(xml_path)}.{os.getpid()}.{threading.get_ident()}.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, xml_path)
+
+def _int(text) -> int:
+    # some labelling tools write coordinates as floats
+    return int(float(text))
+
+# the object fields read_annotation parses; anything else in an object is kept as raw xml
+_OBJECT_FIELDS = {'name', 'pose', 'truncated', 'difficult', 'bndbox'}
+
+def _object_extras(elem) -> tuple:
+    """
+    The fields of an <object> element that aren't in _OBJECT_FIELDS, as xml strings
+    """
+    extras = []
+    for child in elem:
+        if child.tag not in _OBJECT_FIELDS:
+            child.tail = None
+            extras.append(tostring(child, encoding='unicode'))
+    return tuple(extras)
+
+def read_annotation(xml_path) -> Annotation:
+    """
+    Read a whole label file
+    Args:
+        xml_path: the .xml file to read
+    Returns:
+        the parsed Annotation
+    """
+    annotation = Annotation()
+    name = None
+    difficult = truncated = 0
+    pose = 'Unspecified'
+    box = [0, 0, 0, 0]
+    for _, elem in iterparse(os.fspath(xml_path)):
+        tag = elem.tag
+        if tag == 'name':
+            name = (elem.text or '').strip()
+        elif tag == 'difficult':
+            difficult = _int(elem.text or 0)
+        elif tag == 'truncated':
+            truncated = _int(elem.text or 0)
+        elif tag == 'pose':
+            pose = elem.text or ''
+        elif tag == 'xmin':
+            box[0] = _int(elem.text)
+        elif tag == 'ymin':
+            box[1] = _int(elem.text)
+        elif tag == 'xmax':
+            box[2] = _int(elem.text)
+        elif tag == 'ymax':
+            box[3] = _int(elem.text)
+        elif tag == 'object':
+            if any(child.tag not in _OBJECT_FIELDS for child in elem):
+                extras = _object_extras(elem)
+                # nested fields (e.g. VOC <part>s) may have their own name and bndbox; take the object's own
+                name = (elem.findtext('name') or '').strip()
+                bndbox = elem.find('bndbox')
+                if bndbox is not None:
+                    box = [_int(bndbox.findtext(k) or 0) for k in ('xmin', 'ymin', 'xmax', 'ymax')]
+            else:
+                extras = ()
+            annotation.add(name, box, difficult, truncated, pose, extras)
+            name, difficult, truncated, pose = None, 0, 0, 'Unspecified'
+            elem.clear()
+        elif tag == 'folder':
+            annotation.folder = elem.text or ''
+        elif tag == 'filename':
+            annotation.filename = elem.text or ''
+        elif tag == 'path':
+            annotation.path = elem.text or ''
+        elif tag == 'width':
+            annotation.width = _int(elem.text)
+        elif tag == 'height':
+            annotation.height = _int(elem.text)
+        elif tag == 'depth':
+            annotation.depth = _int(elem.text)
+    return annotation
+
+def iter_objects(xml_path):
+    """
+    Stream the objects out of a label file, only looking at the name and bndbox of each object
+    Args:
+        xml_path: the .xml file to read
+    Yields:
+        tuples of (name, (xmin, ymin, xmax, ymax))
+    """
+    name = None
+    box = [0, 0, 0, 0]
+    for _, elem in iterparse(os.fspath(xml_path)):
+        tag = elem.tag
+        if tag == 'name':
+            name = (elem.text or '').strip()
+        elif tag == 'xmin':
+            box[0] = _int(elem.text)
+        elif tag == 'ymin':
+            box[1] = _int(elem.text)
+        elif tag == 'xmax':
+            box[2] = _int(elem.text)
+        elif tag == 'ymax':
+            box[3] = _int(elem.text)
+        elif tag == 'object':
+            if any(child.tag not in _OBJECT_FIELDS for child in elem):
+                # don't let a nested field's name or bndbox stand in for the object's
+                name = (elem.findtext('name') or '').strip()
+                bndbox = elem.find('bndbox')
+                if bndbox is not None:
+                    box = [_int(bndbox.findtext(k) or 0) for k in ('xmin', 'ymin', 'xmax', 'ymax')]
+            yield name, tuple(box)
+            name = None
+            elem.clear()
+
+def read_location(xml_path) -> tuple:
+    """
+    Read just the folder, filename and path fields of a label file, stopping before the objects
+    Args:
+        xml_path: the .xml file to read
+    Returns:
+        tuple of (folder, filename, path); missing fields are None
+    """
+    location = {'folder': None, 'filename': None, 'path': None}
+    with open(xml_path, 'rb') as f:
+        for _, elem in iterparse(f):
+            if elem.tag in location:
+                location[elem.tag] = elem.text or ''
+            elif elem.tag in ('size', 'object'):
+                break
+    return location['folder'], location['filename'], location['path']
+
+def location_of(image_path) -> tuple:
+    """
+    The folder, filename and path fields a label file for an image should have
+    """
+    return image_path.parent.name, image_path.name, image_path.resolve().as_posix()
+
+def relocate(xml_path, image_path, out_path=None):
+    """
+    Point a label file at an image, fixing its folder, filename and path fields
+    Args:
+        xml_path: the .xml file to fix
+        image_path: the image the label belongs to
+        out_path: where to write the fixed label (defaults to overwriting xml_path)
+    """
+    annotation = read_annotation(xml_path)
+    annotation.folder, annotation.filename, annotation.path = location_of(image_path)
+    write_annotation(out_path if out_path is not None else xml_path, annotation)
@@ -1,29 +1,224 @@
 # this script automatically labels the images in the folder using an existing model
-# the data will then be corrected by the user and can be used to train the model 
+# the data will then be corrected by the user and can be used to train the model
 
-from re import L
-import detecto
-import detecto.core
 import cv2
-import torchvision.ops as ops
+import torch
 import numpy as np
 import argparse
+import csv
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-def get_labels(labels_file_path) -> dict:
-        """
-        Get the labels of the units in the passed in file
-        Args:
-            labels_file_name: the filename to read from
-        Returns:
-            dictionary of units {unit_full_name: unit_abbreviation}
-        """
-        # read set 6 units in
-        SET_6_UNITS = dict()
-        with open(labels_file_path) as classes_file_handle:
-            for line in classes_file_handle.readlines():
-                unit_name, abbreviated_name = [x.strip() for x in line.split(",")]
-                SET_6_UNITS[unit_name] = abbreviated_name
-        return SET_6_UNITS
+from annotations import Annotation, write_annotation
+from capture import FRAME_SUFFIXES
+from detection_server import RemoteDetector
+from detector import add_detector_arguments, detector_from_args
+from inference_cache import InferenceCache, hash_bytes
+from jobs import Journal, Progress, job_files, parse_shard, select_shard
+from profiling import PROFILER, add_profile_argument
+def load_image(image_path, cache=None):
+    """
+    Read an image from disk, skipping the decode if its predictions are already cached
+    Args:
+        image_path: path to the png (or webp) to read
+        cache: optional InferenceCache to look the image up in
+    Returns:
+        tuple of (image_path, image_hash, image, cached)
+        image is a HxWxC uint8 array (None on a cache hit or if the png can't be decoded)
+        cached is the cache entry (None on a cache miss)
+    """
+    with PROFILER.stage('read'):
+        data = np.fromfile(str(image_path), dtype=np.uint8)
+        image_hash = None
+        if cache is not None:
+            image_hash = hash_bytes(data)
+            cached = cache.get(image_hash)
+            if cached is not None:
+                return image_path, image_hash, None, cached
+    with PROFILER.stage('decode'):
+        image = cv2.imdecode(data, cv2.IMREAD_COLOR)
+    return image_path, image_hash, image, None
+
+def predict_batch(detector, loaded, cache=None):
+    """
+    Predict on a batch of loaded images, using cached predictions where available
+    Args:
+        detector: the Detector to predict with
+        loaded: list of results from load_image
+        cache: optional InferenceCache to read from and store new predictions in
+    Returns:
+        list of raw (image_path, image_shape, labels, boxes, scores) predictions
+        images that could not be decoded are dropped
+    """
+    misses = [item for item in loaded if item[3] is None and item[2] is not None]
+    with PROFILER.stage('predict', len(misses)):
+        predictions = detector.predict_raw([image for _, _, image, _ in misses])
+    fresh = {}
+    for (image_path, image_hash, image, _), (labels, boxes, scores) in zip(misses, predictions):
+        if cache is not None:
+            cache.put(image_hash, labels, np.asarray(boxes), np.asarray(scores), image.shape)
+        fresh[image_path] = (image.shape, labels, boxes, scores)
+    results = []
+    for image_path, _, _, cached in loaded:
+        if cached is not None:
+            labels, boxes, scores, shape = cached
+            results.append((image_path, shape, labels, torch.tensor(boxes), torch.tensor(scores)))
+        elif image_path in fresh:
+            results.append((image_path, *fresh[image_path]))
+    return results
+
+def write_label(labels_folder, image_path, image_shape, labels, boxes):
+    """
+    Write a Pascal VOC xml file for an image
+    Args:
+        labels_folder: folder to write the .xml file to
+        image_path: path of the labelled image
+        image_shape: (height, width, depth) of the image
+        labels: list of label strings, one per box
+        boxes: Nx4 tensor of boxes (xmin, ymin, xmax, ymax)
+    """
+    annotation = Annotation(image_path.parent.name, image_path.name, str(image_path), image_shape[1], image_shape[0], image_shape[2])
+    with PROFILER.stage('xml_write'):
+        for label, box in zip(labels, boxes.tolist()):
+            annotation.add(label, box)
+        # renamed into place, so a killed run or another shard never leaves a truncated file behind
+        write_annotation(labels_folder/f'{image_path.stem}.xml', annotation, atomic=True)
+
+def read_queue(queue_path, limit=None) -> list:
+    """
+    Get the image paths of a queue file in rank order
+    Args:
+        queue_path: the csv written by select_images.py
+        limit: only the first this many images
+    """
+    images = []
+    with open(queue_path, newline='') as f:
+        for row in csv.DictReader(f):
+            if limit is not None and len(images) >= limit:
+                break
+            images.append(Path(row['image']))
+    return images
+
+def label_images(detector, images, labels_folder, cache=None, on_done=None):
+    """
+    Label the images one at a time on the main thread
+    Args:
+        detector: the Detector to predict with
+        images: list of image paths to label
+        labels_folder: folder to write the .xml label files to
+        cache: optional InferenceCache of raw predictions
+        on_done: optional function called with each image path once its label file is written
+    Returns:
+        number of images labelled
+    """
+    done = 0
+    for image_path in images:
+        # load the image and get the labels, bounding boxes, and scores for the objects in it
+        results = predict_batch(detector, [load_image(image_path, cache)], cache)
+        with PROFILER.stage('nms', len(results)):
+            filtered = detector.postprocess([r[2:] for r in results])
+        for (_, shape, *_), (labels, boxes, _) in zip(results, filtered):
+            # write an xml file for each image
+            write_label(labels_folder, image_path, shape, labels, boxes)
+            if on_done is not None:
+                on_done(image_path)
+            done += 1
+    return done
+
+def _bounded_map(executor, fn, items, window):
+    """
+    Like executor.map, but only keeps `window` calls in flight so decoded
+    images don't pile up in memory faster than the model can consume them
+    Args:
+        executor: the executor to submit work to
+        fn: the function to call on each item
+        items: iterable of items
+        window: maximum number of outstanding futures
+    Yields:
+        results of fn in the order of items
+    """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    for future in pending:
+        yield future.result()
+
+def _batched(iterable, batch_size):
+    """
+    Group an iterable into lists of at most batch_size items
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def label_images_pipelined(detector, images, labels_folder, workers=4, batch_size=4, report_every=100, cache=None, on_done=None):
+    """
+    Label the images with a streaming pipeline:
+    a thread pool decodes pngs, the main thread runs batched predictions,
+    and a writer thread serializes the xml files
+    Args:
+        detector: the Detector to predict with
+        images: list of image paths to label
+        labels_folder: folder to write the .xml label files to
+        workers: number of decoding threads
+        batch_size: number of images per predict call
+        report_every: print throughput every this many images (0 to disable)
+        cache: optional InferenceCache of raw predictions
+        on_done: optional function called with each image path once its label file is written (on the writer thread)
+    Returns:
+        number of images labelled
+    """
+    # the writer stage gets its own thread so disk io overlaps with inference
+    write_queue = queue.Queue(maxsize=2*batch_size)
+    errors = []
+    def writer():
+        while True:
+            item = write_queue.get()
+            if item is None:
+                return
+            try:
+                write_label(labels_folder, *item)
+                if on_done is not None:
+                    on_done(item[0])
+            except Exception as e:
+                errors.append(e)
+    writer_thread = threading.Thread(target=writer, daemon=True)
+    writer_thread.start()
+    done = 0
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as decoders:
+            # keep a couple of batches decoded ahead of the model
+            decoded = _bounded_map(decoders, lambda p: load_image(p, cache), images, window=max(2*batch_size, workers))
+            for batch in _batched(decoded, batch_size):
+                results = predict_batch(detector, batch, cache)
+                # filter the whole batch in one pass
+                with PROFILER.stage('nms', len(results)):
+                    filtered = detector.postprocess([r[2:] for r in results])
+                for (image_path, shape, *_), (labels, boxes, _) in zip(results, filtered):
+                    write_queue.put((image_path, shape, labels, boxes))
+                done += len(results)
+                if report_every and results and done % report_every < len(results):
+                    elapsed = time.perf_counter() - start
+                    print(f'{done}/{len(images)} images ({done/elapsed:.2f} images/sec)')
+    finally:
+        write_queue.put(None)
+        writer_thread.join()
+    if errors:
+        raise errors[0]
+    return done
+
 if __name__ == "__main__":
     # the program takes several command line arguments
     # the first is the folder to save the .xml label files to (defaults to ../labels)
@@ -35,96 +230,95 @@ if __name__ == "__main__":
     parser.add_argument('-l', '--labels', help='Folder to save the .xml label files to.')
     # optional argument to specify the folder to save the images to; defaults to ../screenshots if not specified
     parser.add_argument('-i', '--images', help='Folder containing the images.')
-    # optional argument to specify the path to the model to use; defaults to ../models/set6_best_model.pth if not specified
-    parser.add_argument('-m', '--model', help='Path to the model to use.')
-    # optional argument to specify the path to the label file to use; defaults to ../labels/set6_labels.txt if not specified
-    parser.add_argument('-f', '--labels_file', help='Path to the label file to use.')
+    # model and post-processing options (-m model, -f label file, thresholds, nms)
+    add_detector_arguments(parser)
+    # optional streaming pipeline mode; decodes, predicts and writes on separate stages
+    parser.add_argument('-p', '--pipeline', action='store_true', help='Use the multi-threaded batched pipeline.')
+    # number of decoding threads in pipeline mode; defaults to the number of cores
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='Number of image decoding threads (pipeline mode).')
+    # number of images per predict call in pipeline mode
+    parser.add_argument('-b', '--batch-size', type=int, default=4, help='Number of images per predict call (pipeline mode).')
+
+    # path to the prediction cache; defaults to ../cache/inference_cache.sqlite, which every --shard worker can share
+    parser.add_argument('-c', '--cache', help='Path to the inference cache file.')
+    # disable the prediction cache
+    parser.add_argument('--no-cache', action='store_true', help='Do not read or write the inference cache.')
+    # maximum size of the prediction cache before least recently used entries are evicted
+    parser.add_argument('--cache-size', type=int, default=1024, help='Maximum size of the inference cache in MB.')
+    # send the images to a running detection_server.py instead of loading the model
+    parser.add_argument('--server', help='URL of a running detection server to use instead of loading the model.')
+    # relabel images even if a label file already exists for them
+    parser.add_argument('-o', '--overwrite', action='store_true', help='Relabel images that already have a label file.')
+    # label the images in the order of a queue from select_images.py instead of folder order
+    parser.add_argument('-q', '--queue', help='Ranked queue from select_images.py to label in order.')
+    parser.add_argument('-n', '--limit', type=int, help='Only label the first this many images (of the queue, or of the folder).')
+    # job mode: label only partition K of N, so N processes or hosts can share the folder; finished images are
+    # journaled and a rerun of the same shard resumes where it stopped (see jobs.py for the progress of all shards)
+    parser.add_argument('--shard', metavar='K/N', help='Only label shard K of N (0-based) and journal progress so it can resume.')
+    # folder for the shard journals and progress files; defaults to .jobs in the labels folder
+    parser.add_argument('--job-dir', help='Folder to keep the shard journals and progress files in.')
+    add_profile_argument(parser)
 
     args = parser.parse_args()
+    PROFILER.start(args.profile)
     here = Path(__file__).parent
     if args.labels:
-        labels_folder = args.labels
+        labels_folder = Path(args.labels)
     else:
         labels_folder = here/'../labels'
     if args.images:
-        images_folder = args.images
+        images_folder = Path(args.images)
     else:
         images_folder = here/'../screenshots'
-    if args.model:
-        model_path = args.model
-    else:
-        model_path = here/'../models/set6_best_model.pth'
-    if args.labels_file:
-        labels_file = args.labels_file
-    else:
-        labels_file = here/'../models/set6_labels.csv'
     # make sure the folders exist
     labels_folder.mkdir(parents=True, exist_ok=True)
     images_folder.mkdir(parents=True, exist_ok=True)
-    # raise an error if the model file doesn't exist
-    if not model_path.exists():
-        raise Exception("Model file not found!" + str(model_path))
-    # raise an error if the label file doesn't exist
-    if not labels_file.exists():
-        raise Exception("Label file not found!" + str(labels_file))
-    # get the labels
-    l_d = get_labels(labels_file)
-    l = list(l_d.values())
-    # load the model from disk
-    model = detecto.core.Model.load(model_path, l)
-    # get the list of images to label
-    images = list(images_folder.glob('*.png'))
-    # loop through the images
-    for image_path in images:
-        # if the image is already labeled, skip it
-        if image_path.with_suffix('.xml').exists():
-            continue
-        # load the image
-        image = cv2.imread(str(image_path))
-        # get the labels, bounding boxes, and scores for the objects in the image
-        labels, boxes, scores = model.predict(image)
-        # perform non-maximum suppression on the bounding boxes
-        kept_indices = ops.nms(boxes, scores, 0.4)
-        # filter out the bounding boxes that were not kept
-        labels = [labels[i] for i in kept_indices]
-        boxes = boxes[kept_indices]
-        scores = scores[kept_indices]
-        # write an xml file for each image
-        with open(str(labels_folder/image_path.stem) + '.xml', 'w') as f:
-            f.write('<annotation>\n')
-            f.write('\t<folder>{}</folder>\n'.format(image_path.parent.name))
-            f.write('\t<filename>{}</filename>\n'.format(image_path.name))
-            f.write('\t<path>{}</path>\n'.format(image_path))
-            f.write('\t<source>\n')
-            f.write('\t\t<database>Unknown</database>\n')
-            f.write('\t</source>\n')
-            f.write('\t<size>\n')
-            f.write('\t\t<width>{}</width>\n'.format(image.shape[1]))
-            f.write('\t\t<height>{}</height>\n'.format(image.shape[0]))
-            f.write('\t\t<depth>{}</depth>\n'.format(image.shape[2]))
-            f.write('\t</size>\n')
-            f.write('\t<segmented>0</segmented>\n')
-            for i in range(len(boxes)):
-                # get the bounding box
-                box = boxes[i]
-                # get the label
-                label = labels[i]
-                # get the score
-                score = scores[i]
-                # write the bounding box to the xml file
-                f.write('\t<object>\n')
-                f.write('\t\t<name>{}</name>\n'.format(label))
-                f.write('\t\t<pose>Unspecified</pose>\n')
-                f.write('\t\t<truncated>0</truncated>\n')
-                f.write('\t\t<difficult>0</difficult>\n')
-                f.write('\t\t<bndbox>\n')
-                f.write('\t\t\t<xmin>{}</xmin>\n'.format(int(box[0])))
-                f.write('\t\t\t<ymin>{}</ymin>\n'.format(int(box[1])))
-                f.write('\t\t\t<xmax>{}</xmax>\n'.format(int(box[2])))
-                f.write('\t\t\t<ymax>{}</ymax>\n'.format(int(box[3])))
-                f.write('\t\t</bndbox>\n')
-                #f.write('\t\t<score>{}</score>\n'.format(score))
-                f.write('\t</object>\n')
-            f.write('</annotation>\n')
-
-    
\ No newline at end of file
+    with PROFILER.stage('load_model'):
+        if args.server:
+            # use the warm model in the detection server; post-processing still happens here
+            detector = RemoteDetector.from_args(args.server, args)
+        else:
+            # load the model from disk
+            detector = detector_from_args(args)
+    # open the prediction cache
+    cache = None
+    if not args.no_cache:
+        cache_path = Path(args.cache) if args.cache else here/'../cache/inference_cache.sqlite'
+        cache = InferenceCache(cache_path, detector.fingerprint, max_bytes=args.cache_size << 20)
+    # get the list of images to label, skipping the ones that are already labelled
+    # Recorder may have written webp frames
+    candidates = read_queue(args.queue) if args.queue else (p for p in images_folder.iterdir() if p.suffix in FRAME_SUFFIXES)
+    journal = progress = on_done = None
+    if args.shard:
+        shard, shard_count = parse_shard(args.shard)
+        # every worker must see the same candidates in the same order for the shards to be disjoint
+        candidates = select_shard(candidates if args.queue else sorted(candidates), shard, shard_count)
+        journal_path, progress_path = job_files(Path(args.job_dir) if args.job_dir else labels_folder/'.jobs', shard, shard_count)
+        journal = Journal(journal_path)
+        total = len(candidates)
+        candidates = [p for p in candidates if p.name not in journal]
+    images = [p for p in candidates if args.overwrite or not (labels_folder/f'{p.stem}.xml').exists()]
+    if journal is not None:
+        # images labelled by an earlier run (journaled or not) count as done
+        progress = Progress(progress_path, total, total - len(images), shard=args.shard)
+        print(f'Shard {args.shard}: {len(images)} of {total} images left to label')
+        def on_done(image_path):
+            journal.record(image_path.name)
+            progress.update()
+    images = images[:args.limit]
+    start = time.perf_counter()
+    try:
+        if args.pipeline:
+            n = label_images_pipelined(detector, images, labels_folder, workers=args.workers, batch_size=args.batch_size, cache=cache, on_done=on_done)
+        else:
+            n = label_images(detector, images, labels_folder, cache=cache, on_done=on_done)
+    finally:
+        if journal is not None:
+            journal.close()
+            progress.write()
+        if cache is not None:
+            cache.close()
+        PROFILER.finish()
+    elapsed = time.perf_counter() - start
+    if n:
+        print(f'Labelled {n} images in {elapsed:.2f}s ({n/elapsed:.2f} images/sec)')
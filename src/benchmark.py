@@ -0,0 +1,402 @@
+# benchmark harness for the pipeline stages
+# generates a synthetic corpus of 1920x1080 frames and Pascal VOC labels of each requested size, times the core
+# operation of every script on it (decode, predict, nms, xml write/read, index, tally, dedup, commit, repair),
+# runs auto_label.py's pipeline end to end with a stub model at increasing worker counts, and writes the results to json so runs on different commits can be compared with --compare.
+# the corpus reuses a small set of distinct frames through hard links, so 100k image corpora stay cheap to build;
+# decode, predict and nms run on a sample of frames since their cost doesn't depend on the corpus size.
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import cv2
+import numpy as np
+from annotations import Annotation, read_annotation, write_annotation
+from dataset_index import build_index, get_classes
+from dedup import HashIndex, dhash_files
+from manifest import apply_commit, bootstrap_manifest, start_commit
+from repair_integrity import repair_dataset
+from tally import summarize, tally_files
+
+STAGES = ['decode', 'predict', 'pipeline', 'nms', 'xml_write', 'xml_read', 'index', 'tally', 'dedup', 'commit', 'repair']
+
+def synthetic_frame(rng, classes, size=(1920, 1080), units=(5, 15)) -> tuple:
+    """
+    Draw a fake board: a dark background with a few coloured rectangles standing in for units
+    Args:
+        rng: numpy random Generator
+        classes: list of unit abbreviations to label the rectangles with
+        size: (width, height) of the frame
+        units: (min, max) number of units on the board
+    Returns:
+        tuple of (HxWx3 BGR uint8 image, list of unit names, Nx4 int boxes)
+    """
+    width, height = size
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[:] = rng.integers(10, 60, 3, dtype=np.uint8)
+    n = int(rng.integers(units[0], units[1] + 1))
+    box_w = rng.integers(width // 40, width // 15, n)
+    box_h = rng.integers(height // 20, height // 8, n)
+    xmin = rng.integers(0, width - box_w)
+    ymin = rng.integers(0, height - box_h)
+    boxes = np.stack([xmin, ymin, xmin + box_w, ymin + box_h], axis=1)
+    for x0, y0, x1, y1 in boxes.tolist():
+        image[y0:y1, x0:x1] = rng.integers(0, 256, 3, dtype=np.uint8)
+    names = [classes[i] for i in rng.integers(0, len(classes), n)]
+    return image, names, boxes
+
+def _link(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def make_corpus(folder, n, classes, size=(1920, 1080), distinct=64, seed=0) -> tuple:
+    """
+    Write a corpus of n images and label files named 0-(n-1)
+    Args:
+        folder: folder to create images/ and labels/ in
+        n: number of images
+        classes: list of unit abbreviations
+        size: (width, height) of the frames
+        distinct: number of distinct frames; image i is a hard link to frame i % distinct
+        seed: random seed
+    Returns:
+        tuple of (images folder, labels folder, frames folder)
+    """
+    folder = Path(folder)
+    images_folder, labels_folder, frames_folder = folder/'images', folder/'labels', folder/'frames'
+    for f in (images_folder, labels_folder, frames_folder):
+        f.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    frames = []
+    for k in range(min(distinct, n)):
+        image, names, boxes = synthetic_frame(rng, classes, size)
+        cv2.imwrite(str(frames_folder/f'{k}.png'), image, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        frames.append((names, boxes.tolist()))
+    for i in range(n):
+        k = i % len(frames)
+        image_path = images_folder/f'{i}.png'
+        _link(frames_folder/f'{k}.png', image_path)
+        annotation = Annotation(images_folder.name, image_path.name, str(image_path), size[0], size[1], 3)
+        for name, box in zip(*frames[k]):
+            annotation.add(name, box)
+        write_annotation(labels_folder/f'{i}.xml', annotation)
+    return images_folder, labels_folder, frames_folder
+
+def _result(seconds, items, **extra) -> dict:
+    return dict(seconds=seconds, items=items, per_sec=items / seconds if seconds else None, **extra)
+
+def bench_decode(frames, workers=None) -> dict:
+    """
+    Decode the sample frames on one thread and on a thread pool
+    """
+    def decode(path):
+        return cv2.imdecode(np.fromfile(str(path), dtype=np.uint8), cv2.IMREAD_COLOR)
+    start = time.perf_counter()
+    for path in frames:
+        decode(path)
+    serial = time.perf_counter() - start
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(decode, frames))
+    return _result(serial, len(frames), pooled_per_sec=len(frames) / (time.perf_counter() - start))
+
+def bench_predict(frames, model_path, labels_file, engine='detecto', batch_size=4) -> dict:
+    """
+    Time the detector on the sample frames (skipped without a model)
+    """
+    from detector import load_detector
+    start = time.perf_counter()
+    detector = load_detector(model_path, labels_file, engine=engine)
+    load_seconds = time.perf_counter() - start
+    images = [cv2.imdecode(np.fromfile(str(path), dtype=np.uint8), cv2.IMREAD_COLOR) for path in frames]
+    # the first call pays for lazy initialization
+    detector.predict_raw(images[:1])
+    start = time.perf_counter()
+    for i in range(0, len(images), batch_size):
+        detector.predict_raw(images[i:i + batch_size])
+    return _result(time.perf_counter() - start, len(images), load_seconds=load_seconds, engine=engine)
+
+class StubDetector:
+    """
+    Stands in for the model in the pipeline stage: a fixed amount of work per image (the resize the model's
+    transform does, which releases the GIL like the real forward pass) and a few fake detections
+    """
+    def __init__(self, classes, size=(1333, 750), detections=10):
+        self.classes = list(classes)
+        self.size = size
+        self.detections = detections
+
+    def predict_raw(self, images) -> list:
+        predictions = []
+        for image in images:
+            cv2.resize(image, self.size, interpolation=cv2.INTER_LINEAR)
+            boxes = np.tile(np.array([[10, 10, 60, 60]], dtype=np.float32), (self.detections, 1))
+            predictions.append((self.classes[:self.detections], boxes, np.full(self.detections, 0.9, dtype=np.float32)))
+        return predictions
+
+    def postprocess(self, predictions) -> list:
+        return predictions
+
+def bench_pipeline(images_folder, classes, out_folder, images=256, max_workers=None, batch_size=4) -> dict:
+    """
+    Label images with auto_label.py's pipeline (decode threads, batched predictions, writer thread) using a
+    stub model, once per worker count, to show how throughput scales with the number of cores
+    Args:
+        images_folder: the corpus images
+        classes: list of unit abbreviations
+        out_folder: folder to write the label files to
+        images: number of images to label per run
+        max_workers: the most decoding threads to try (defaults to the core count); runs 1, 2, 4, ... up to it
+        batch_size: number of images per predict call
+    """
+    from auto_label import label_images_pipelined
+    paths = sorted(Path(images_folder).glob('*.png'), key=lambda p: int(p.stem))[:images]
+    max_workers = max_workers or os.cpu_count() or 1
+    worker_counts = sorted({2**k for k in range(max_workers.bit_length())} | {max_workers})
+    detector = StubDetector(classes)
+    rates = {}
+    for workers in worker_counts:
+        labels_folder = Path(out_folder)/str(workers)
+        labels_folder.mkdir(parents=True, exist_ok=True)
+        start = time.perf_counter()
+        label_images_pipelined(detector, paths, labels_folder, workers=workers, batch_size=batch_size, report_every=0)
+        seconds = time.perf_counter() - start
+        rates[workers] = len(paths) / seconds
+    most = worker_counts[-1]
+    return _result(len(paths) / rates[most], len(paths), workers=most,
+                   per_sec_by_workers={str(w): rate for w, rate in rates.items()},
+                   speedup=rates[most] / rates[worker_counts[0]])
+
+def bench_nms(classes, images=64, boxes_per_image=100, seed=0) -> dict:
+    """
+    Time the post-processing on synthetic raw predictions
+    """
+    from postprocess import PostProcessor
+    rng = np.random.default_rng(seed)
+    predictions = []
+    for _ in range(images):
+        xy = rng.uniform(0, 1800, (boxes_per_image, 2))
+        wh = rng.uniform(20, 120, (boxes_per_image, 2))
+        boxes = np.concatenate([xy, xy + wh], axis=1).astype(np.float32)
+        labels = [classes[i] for i in rng.integers(0, len(classes), boxes_per_image)]
+        predictions.append((labels, boxes, rng.uniform(0, 1, boxes_per_image).astype(np.float32)))
+    postprocessor = PostProcessor(classes)
+    postprocessor(predictions[:1])
+    start = time.perf_counter()
+    postprocessor(predictions)
+    return _result(time.perf_counter() - start, images, boxes_per_image=boxes_per_image)
+
+def bench_xml_write(labels_folder, out_folder) -> dict:
+    """
+    Re-write every label file of the corpus to another folder
+    """
+    annotations = [read_annotation(path) for path in sorted(Path(labels_folder).glob('*.xml'))]
+    out_folder = Path(out_folder)
+    out_folder.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    for i, annotation in enumerate(annotations):
+        write_annotation(out_folder/f'{i}.xml', annotation)
+    return _result(time.perf_counter() - start, len(annotations))
+
+def bench_xml_read(labels_folder) -> dict:
+    paths = list(Path(labels_folder).glob('*.xml'))
+    start = time.perf_counter()
+    objects = sum(len(read_annotation(path)) for path in paths)
+    return _result(time.perf_counter() - start, len(paths), objects=objects)
+
+def bench_index(images_folder, labels_folder, classes, index_path) -> dict:
+    """
+    Build the dataset index from scratch, then update it with nothing changed
+    """
+    start = time.perf_counter()
+    index = build_index(labels_folder, images_folder, classes, index_path)
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    build_index(labels_folder, images_folder, classes, index_path)
+    return _result(cold, len(index), warm_seconds=time.perf_counter() - start)
+
+def bench_tally(labels_folder, classes, cache_path, workers=None) -> dict:
+    """
+    Tally the labels with an empty cache, then again with a warm one, and summarize
+    """
+    start = time.perf_counter()
+    partials = tally_files(labels_folder, cache_path, workers)
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    tally_files(labels_folder, cache_path, workers)
+    warm = time.perf_counter() - start
+    start = time.perf_counter()
+    summarize(partials, classes)
+    return _result(cold, len(partials), warm_seconds=warm, summarize_seconds=time.perf_counter() - start)
+
+def bench_dedup(frames, n, threshold=4, queries=1000, seed=0) -> dict:
+    """
+    Hash the sample frames, then fill a hash index with n hashes and time lookups in it
+    """
+    start = time.perf_counter()
+    dhash_files(frames)
+    hash_seconds = time.perf_counter() - start
+    rng = np.random.default_rng(seed)
+    hashes = rng.integers(0, 2**63, n, dtype=np.int64).astype(np.uint64)
+    index = HashIndex(threshold)
+    start = time.perf_counter()
+    for i, hash_value in enumerate(hashes.tolist()):
+        index.add(str(i), hash_value)
+    add_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for hash_value in hashes[rng.integers(0, n, queries)].tolist():
+        index.query(hash_value)
+    return _result(time.perf_counter() - start, queries, hash_per_sec=len(frames) / hash_seconds, add_seconds=add_seconds)
+
+def bench_commit(images_folder, labels_folder, workdir) -> dict:
+    """
+    Commit the whole corpus to an empty clean_data folder through the journal
+    """
+    workdir = Path(workdir)
+    staging_images, staging_labels = workdir/'staging/images', workdir/'staging/labels'
+    clean_images, clean_labels = workdir/'clean_data/images', workdir/'clean_data/labels'
+    for f in (staging_images, staging_labels, clean_images, clean_labels):
+        f.mkdir(parents=True, exist_ok=True)
+    moves = []
+    for i, image_path in enumerate(sorted(Path(images_folder).glob('*.png'), key=lambda p: int(p.stem))):
+        _link(image_path, staging_images/image_path.name)
+        shutil.copyfile(Path(labels_folder)/f'{image_path.stem}.xml', staging_labels/f'{image_path.stem}.xml')
+        moves.append((i, staging_images/image_path.name, staging_labels/f'{image_path.stem}.xml', clean_images/f'{i}.png', clean_labels/f'{i}.xml'))
+    manifest_path = workdir/'clean_data/manifest.csv'
+    bootstrap_manifest(manifest_path, clean_images)
+    start = time.perf_counter()
+    apply_commit(start_commit(manifest_path, moves))
+    return _result(time.perf_counter() - start, len(moves))
+
+def bench_repair(images_folder, labels_folder, gap_every=50, workers=None) -> dict:
+    """
+    Punch a gap every gap_every images into a committed dataset, then renumber it and fix the labels
+    """
+    images_folder, labels_folder = Path(images_folder), Path(labels_folder)
+    stems = sorted(int(p.stem) for p in images_folder.glob('*.png'))
+    for stem in stems[::gap_every]:
+        (images_folder/f'{stem}.png').unlink()
+        (labels_folder/f'{stem}.xml').unlink()
+    start = time.perf_counter()
+    # the same scan, renames and label fixes repair_integrity.py runs
+    steps, fixed = repair_dataset(images_folder, labels_folder, workers=workers, verbose=False)
+    return _result(time.perf_counter() - start, len(stems) - len(stems[::gap_every]), renames=steps, fixed=fixed)
+
+def run_benchmarks(n, classes, workdir, stages=STAGES, sample=64, model_path=None, labels_file=None, engine='detecto', workers=None, verbose=True) -> dict:
+    """
+    Build a corpus of n images and run the selected stages on it
+    Returns:
+        dictionary of {stage: result}; stages that can't run here have a `skipped` reason
+    """
+    workdir = Path(workdir)
+    start = time.perf_counter()
+    images_folder, labels_folder, frames_folder = make_corpus(workdir/'corpus', n, classes, distinct=sample)
+    if verbose:
+        print(f'[INFO] built a {n} image corpus in {time.perf_counter() - start:.1f}s')
+    frames = sorted(frames_folder.glob('*.png'), key=lambda p: int(p.stem))
+    jobs = {
+        'decode': lambda: bench_decode(frames, workers),
+        'predict': lambda: bench_predict(frames, model_path, labels_file, engine),
+        'pipeline': lambda: bench_pipeline(images_folder, classes, workdir/'pipeline', min(n, 4*sample), workers),
+        'nms': lambda: bench_nms(classes),
+        'xml_write': lambda: bench_xml_write(labels_folder, workdir/'xml_write'),
+        'xml_read': lambda: bench_xml_read(labels_folder),
+        'index': lambda: bench_index(images_folder, labels_folder, classes, workdir/'dataset.idx'),
+        'tally': lambda: bench_tally(labels_folder, classes, workdir/'tally_cache.json', workers),
+        'dedup': lambda: bench_dedup(frames, n),
+        'commit': lambda: bench_commit(images_folder, labels_folder, workdir),
+        # repairs the dataset the commit stage built
+        'repair': lambda: bench_repair(workdir/'clean_data/images', workdir/'clean_data/labels', workers=workers),
+    }
+    results = {}
+    for stage in STAGES:
+        if stage not in stages:
+            continue
+        if stage == 'predict' and model_path is None:
+            results[stage] = {'skipped': 'no model given (-m)'}
+        elif stage == 'repair' and 'commit' not in results:
+            results[stage] = {'skipped': 'needs the commit stage'}
+        else:
+            try:
+                results[stage] = jobs[stage]()
+            except ImportError as e:
+                results[stage] = {'skipped': f'missing dependency: {e.name}'}
+        if verbose:
+            result = results[stage]
+            if 'skipped' in result:
+                print(f'  {stage:10} skipped ({result["skipped"]})')
+            else:
+                print(f'  {stage:10} {result["seconds"]:8.3f}s  {result["per_sec"]:10.1f} items/sec')
+                if 'per_sec_by_workers' in result:
+                    for w, rate in result['per_sec_by_workers'].items():
+                        print(f'  {"":10} {w:>3} workers {rate:10.1f} items/sec')
+    return results
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old, new):
+    """
+    Print the items/sec ratio of every stage two benchmark runs have in common
+    """
+    for size, stages in new['results'].items():
+        for stage, result in stages.items():
+            before = old['results'].get(size, {}).get(stage, {})
+            if result.get('per_sec') and before.get('per_sec'):
+                print(f'{size:>8} {stage:10} {before["per_sec"]:10.1f} -> {result["per_sec"]:10.1f} items/sec ({result["per_sec"] / before["per_sec"]:.2f}x)')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic data.')
+    # corpus sizes to benchmark
+    parser.add_argument('-n', '--sizes', type=int, nargs='+', default=[1000], help='Corpus sizes (number of images) to benchmark.')
+    parser.add_argument('-s', '--stages', nargs='+', choices=STAGES, default=STAGES, help='Stages to run.')
+    # number of distinct frames; decode, predict and dedup hashing run on these
+    parser.add_argument('--sample', type=int, default=64, help='Number of distinct frames to generate.')
+    # optional model for the predict stage; the stage is skipped without one
+    parser.add_argument('-m', '--model', help='Model to time the predict stage with.')
+    parser.add_argument('-f', '--labels_file', help='Label file of the model; defaults to ../models/set6_labels.csv.')
+    parser.add_argument('--engine', choices=['detecto', 'torchscript'], default='detecto', help='Inference engine for the predict stage.')
+    parser.add_argument('-w', '--workers', type=int, help='Number of worker threads/processes.')
+    # where the corpora are built; defaults to a temporary folder that is deleted afterwards
+    parser.add_argument('-d', '--workdir', help='Folder to build the corpora in (kept afterwards).')
+    # optional argument to specify the results file; defaults to ../benchmarks/<timestamp>.json
+    parser.add_argument('-o', '--output', help='Path to write the results to.')
+    parser.add_argument('-c', '--compare', help='Earlier results file to compare against.')
+    args = parser.parse_args()
+    here = Path(__file__).parent
+    classes = get_classes(here/'../clean_data/static/set6_classes.csv')
+    labels_file = Path(args.labels_file) if args.labels_file else here/'../models/set6_labels.csv'
+    report = {
+        'commit': _git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'results': {},
+    }
+    for n in args.sizes:
+        print(f'{n} images:')
+        workdir = Path(args.workdir)/str(n) if args.workdir else Path(tempfile.mkdtemp(prefix='tft_bench_'))
+        try:
+            report['results'][str(n)] = run_benchmarks(n, classes, workdir, args.stages, args.sample, args.model, labels_file, args.engine, args.workers)
+        finally:
+            if not args.workdir:
+                shutil.rmtree(workdir, ignore_errors=True)
+    output_path = Path(args.output) if args.output else here/f'../benchmarks/{time.strftime("%Y%m%d_%H%M%S")}.json'
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {output_path}')
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
@@ -0,0 +1,459 @@
+# frame sources for screenshot.py and anything else that needs frames of a TFT game
+# the win32 backend grabs the live game window; the others work headless (linux desktops, recorded videos,
+# folders of screenshots) so the capture pipeline can be tested without the game running
+import os
+import queue
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from PIL import Image
+from profiling import PROFILER
+
+class CaptureBackend:
+    """
+    A source of frames. grab() returns a PIL image, or None once the source is exhausted.
+    """
+    # frames must be this size if set
+    expected_size = None
+
+    def grab(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def check_size(self, im):
+        """
+        Raise if a frame isn't the expected size
+        """
+        if self.expected_size is not None and im.size != self.expected_size:
+            raise Exception("Image is not {}x{}. Dimensions: {}".format(*self.expected_size, im.size))
+        return im
+
+    def __iter__(self):
+        while True:
+            im = self.grab()
+            if im is None:
+                return
+            yield im
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class Win32Backend(CaptureBackend):
+    """
+    Screenshots of the League of Legends client window (windows only)
+    """
+    expected_size = (1920, 1080)
+
+    def __init__(self, window_name="League of Legends (TM) Client", focus_each_grab=True):
+        """
+        Args:
+            window_name: title of the window to capture
+            focus_each_grab: bring the window to the front before every grab
+                (only needed when the console has focus between grabs)
+        """
+        import win32gui
+        import pyautogui
+        self.win32gui = win32gui
+        self.pyautogui = pyautogui
+        self.window_name = window_name
+        self.focus_each_grab = focus_each_grab
+        self.focused = False
+
+    def grab(self):
+        win32gui = self.win32gui
+        hwnd = win32gui.FindWindow(None, self.window_name)
+        if not hwnd:
+            raise Exception('Window not found!')
+        if self.focus_each_grab or not self.focused:
+            win32gui.SetForegroundWindow(hwnd)
+            self.focused = True
+        x, y, x1, y1 = win32gui.GetClientRect(hwnd)
+        x, y = win32gui.ClientToScreen(hwnd, (x, y))
+        x1, y1 = win32gui.ClientToScreen(hwnd, (x1 - x, y1 - y))
+        im = self.pyautogui.screenshot(region=(x, y, x1, y1))
+        return self.check_size(im)
+
+class X11Backend(CaptureBackend):
+    """
+    Screenshots of an X11 display (linux)
+    """
+    def __init__(self, display=None, region=None, expected_size=None):
+        """
+        Args:
+            display: the X display to grab (defaults to $DISPLAY)
+            region: optional (left, top, right, bottom) box to grab
+            expected_size: optional (width, height) every frame must have
+        """
+        from PIL import ImageGrab
+        self.grab_screen = ImageGrab.grab
+        self.display = display if display is not None else os.environ.get('DISPLAY')
+        self.region = region
+        self.expected_size = expected_size
+
+    def grab(self):
+        im = self.grab_screen(bbox=self.region, xdisplay=self.display)
+        return self.check_size(im.convert('RGB'))
+
+class VideoFileBackend(CaptureBackend):
+    """
+    Frames of a recorded video
+    """
+    def __init__(self, video_path, every=1, expected_size=None):
+        """
+        Args:
+            video_path: the video file to read
+            every: only return every n-th frame
+            expected_size: optional (width, height) every frame must have
+        """
+        import cv2
+        self.cv2 = cv2
+        self.capture = cv2.VideoCapture(str(video_path))
+        if not self.capture.isOpened():
+            raise FileNotFoundError(f'Could not open video {video_path}')
+        self.every = every
+        self.expected_size = expected_size
+
+    def grab(self):
+        for _ in range(self.every - 1):
+            if not self.capture.grab():
+                return None
+        ok, frame = self.capture.read()
+        if not ok:
+            return None
+        return self.check_size(Image.fromarray(self.cv2.cvtColor(frame, self.cv2.COLOR_BGR2RGB)))
+
+    def close(self):
+        self.capture.release()
+
+class ImageDirectoryBackend(CaptureBackend):
+    """
+    Images from a folder, in numeric (then alphabetical) filename order
+    """
+    def __init__(self, folder, pattern='*.png', loop=False, expected_size=None):
+        """
+        Args:
+            folder: the folder to read from
+            pattern: glob of the images to read
+            loop: start over once every image has been returned
+            expected_size: optional (width, height) every frame must have
+        """
+        self.files = sorted(Path(folder).glob(pattern), key=lambda x: (not x.stem.isdigit(), int(x.stem) if x.stem.isdigit() else 0, x.name))
+        self.loop = loop
+        self.position = 0
+        self.expected_size = expected_size
+
+    def grab(self):
+        if self.position >= len(self.files):
+            if not self.loop or not self.files:
+                return None
+            self.position = 0
+        file_path = self.files[self.position]
+        self.position += 1
+        with Image.open(file_path) as im:
+            return self.check_size(im.convert('RGB'))
+
+# backends selectable by name from the command line
+BACKENDS = {
+    'win32': Win32Backend,
+    'x11': X11Backend,
+    'video': VideoFileBackend,
+    'images': ImageDirectoryBackend,
+}
+
+def get_backend(name, source=None, **kwargs) -> CaptureBackend:
+    """
+    Create a capture backend by name
+    Args:
+        name: one of BACKENDS
+        source: the video file or image folder for the offline backends, or the display for x11
+        kwargs: passed to the backend
+    Returns:
+        the backend
+    """
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown capture backend {name}. Choose from {", ".join(BACKENDS)}.')
+    if name in ('video', 'images'):
+        if source is None:
+            raise ValueError(f'The {name} backend needs a source')
+        return BACKENDS[name](source, **kwargs)
+    if name == 'x11' and source is not None:
+        kwargs['display'] = source
+    return BACKENDS[name](**kwargs)
+
+def default_backend_name() -> str:
+    """
+    The live capture backend for this platform
+    """
+    return 'win32' if os.name == 'nt' else 'x11'
+
+class RingBuffer:
+    """
+    Bounded, thread-safe frame buffer. When it's full the oldest frame is dropped
+    so the capture side never waits on the consumers.
+    """
+    def __init__(self, capacity):
+        self.frames = deque()
+        self.capacity = capacity
+        self.dropped = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def push(self, item):
+        with self.condition:
+            if len(self.frames) >= self.capacity:
+                self.frames.popleft()
+                self.dropped += 1
+            self.frames.append(item)
+            self.condition.notify()
+
+    def pop(self, timeout=None):
+        """
+        Take the oldest frame, waiting for one if the buffer is empty
+        Returns:
+            the frame, or None once the buffer is closed and drained
+        """
+        with self.condition:
+            while not self.frames:
+                if self.closed:
+                    return None
+                if not self.condition.wait(timeout):
+                    return None
+            return self.frames.popleft()
+
+    def pop_latest(self, timeout=None):
+        """
+        Take the newest frame and drop the older ones, waiting for one if the buffer is empty
+        Returns:
+            the frame, or None once the buffer is closed and drained
+        """
+        with self.condition:
+            while not self.frames:
+                if self.closed:
+                    return None
+                if not self.condition.wait(timeout):
+                    return None
+            item = self.frames.pop()
+            self.dropped += len(self.frames)
+            self.frames.clear()
+            return item
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __len__(self):
+        return len(self.frames)
+
+class LiveCapture:
+    """
+    Grabs frames at a fixed rate on a background thread, keeping only the newest few
+    so a slow consumer always works on the most recent frame
+    """
+    def __init__(self, backend, fps=10, buffer_size=2):
+        """
+        Args:
+            backend: the CaptureBackend to read from
+            fps: frames per second to capture
+            buffer_size: number of frames kept waiting for the consumer
+        """
+        self.backend = backend
+        self.interval = 1/fps
+        self.buffer = RingBuffer(buffer_size)
+        self.captured = 0
+        self.errors = queue.Queue()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._capture, daemon=True)
+
+    def _capture(self):
+        next_time = time.perf_counter()
+        try:
+            while not self.stop_event.is_set():
+                im = self.backend.grab()
+                if im is None:
+                    break
+                self.captured += 1
+                # stamp frames when they are grabbed so latency covers the whole pipeline
+                self.buffer.push((time.perf_counter(), im))
+                next_time += self.interval
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    self.stop_event.wait(delay)
+                else:
+                    next_time = time.perf_counter()
+        except Exception as e:
+            self.errors.put(e)
+        finally:
+            self.buffer.close()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def latest(self, timeout=None):
+        """
+        Get the newest frame, dropping any older ones
+        Returns:
+            (capture time, image), or None once the source is exhausted
+        """
+        item = self.buffer.pop_latest(timeout)
+        if item is None and not self.errors.empty():
+            raise self.errors.get()
+        return item
+
+    @property
+    def dropped(self) -> int:
+        return self.buffer.dropped
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        if not self.errors.empty():
+            raise self.errors.get()
+
+# the formats Recorder can write; everything that reads the screenshots folder accepts both
+FRAME_SUFFIXES = ('.png', '.webp')
+
+def save_frame(im, image_path, **params):
+    """
+    Save a frame under a temporary name and rename it into place, so auto_label.py running on the
+    same folder never reads a half written file
+    Args:
+        im: the PIL image
+        image_path: the .png or .webp file to write
+        params: encoder options passed to Image.save
+    """
+    image_path = Path(image_path)
+    # hidden and not ending in .png/.webp, so nothing that reads the folder picks it up
+    tmp_path = image_path.with_name(f'.{image_path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    im.save(tmp_path, format=image_path.suffix[1:], **params)
+    os.replace(tmp_path, image_path)
+
+def convert_to_png(image_path) -> Path:
+    """
+    Re-encode a recorded frame as a png next to it and remove the original
+    Args:
+        image_path: the frame to convert
+    Returns:
+        path of the png (image_path itself if it already is one)
+    """
+    image_path = Path(image_path)
+    if image_path.suffix == '.png':
+        return image_path
+    png_path = image_path.with_suffix('.png')
+    if png_path.exists():
+        raise FileExistsError(f'{png_path} already exists; {image_path} cannot be converted to it.')
+    with Image.open(image_path) as im:
+        save_frame(im, png_path, compress_level=1)
+    image_path.unlink()
+    return png_path
+
+class Recorder:
+    """
+    Captures frames at a fixed rate into a ring buffer while a pool of encoder threads writes them to disk
+    """
+    def __init__(self, backend, folder, fps=4, buffer_size=64, encoders=2, image_format='png', first_index=0, frame_filter=None):
+        """
+        Args:
+            backend: the CaptureBackend to read from
+            folder: folder to write the frames to
+            fps: frames per second to capture
+            buffer_size: maximum number of frames waiting to be encoded
+            encoders: number of encoder threads
+            image_format: 'png' or 'webp'
+            first_index: file name of the first frame; later frames count up from it
+            frame_filter: optional callable(image) -> bool; frames it rejects are not saved
+        """
+        self.backend = backend
+        self.folder = Path(folder)
+        self.interval = 1/fps
+        self.buffer = RingBuffer(buffer_size)
+        self.image_format = image_format
+        self.next_index = first_index
+        self.frame_filter = frame_filter
+        self.captured = 0
+        self.saved = 0
+        self.filtered = 0
+        self.errors = queue.Queue()
+        self.stop_event = threading.Event()
+        self.capture_thread = threading.Thread(target=self._capture, daemon=True)
+        self.encoder_threads = [threading.Thread(target=self._encode, daemon=True) for _ in range(encoders)]
+        self.lock = threading.Lock()
+
+    def _capture(self):
+        next_time = time.perf_counter()
+        try:
+            while not self.stop_event.is_set():
+                with PROFILER.stage('grab'):
+                    im = self.backend.grab()
+                if im is None:
+                    break
+                self.captured += 1
+                with PROFILER.stage('filter'):
+                    rejected = self.frame_filter is not None and not self.frame_filter(im)
+                if rejected:
+                    self.filtered += 1
+                else:
+                    # names are handed out at capture time so frames stay in order however they are encoded
+                    self.buffer.push((self.next_index, im))
+                    self.next_index += 1
+                next_time += self.interval
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    self.stop_event.wait(delay)
+                else:
+                    # running behind; don't try to catch up with a burst of frames
+                    next_time = time.perf_counter()
+        except Exception as e:
+            self.errors.put(e)
+        finally:
+            self.buffer.close()
+
+    def _encode(self):
+        while True:
+            item = self.buffer.pop()
+            if item is None:
+                return
+            index, im = item
+            try:
+                with PROFILER.stage('encode'):
+                    if self.image_format == 'webp':
+                        save_frame(im, self.folder/f'{index}.webp', lossless=True, method=0)
+                    else:
+                        # fast compression; these are re-encoded when the dataset is packed anyway
+                        save_frame(im, self.folder/f'{index}.png', compress_level=1)
+                with self.lock:
+                    self.saved += 1
+            except Exception as e:
+                self.errors.put(e)
+
+    def start(self):
+        self.folder.mkdir(parents=True, exist_ok=True)
+        for thread in self.encoder_threads:
+            thread.start()
+        self.capture_thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop capturing and wait for the buffered frames to be written
+        """
+        self.stop_event.set()
+        self.capture_thread.join()
+        for thread in self.encoder_threads:
+            thread.join()
+        if not self.errors.empty():
+            raise self.errors.get()
+
+    def wait(self, duration=None):
+        """
+        Record until the source runs out, or for duration seconds
+        """
+        self.capture_thread.join(duration)
+        self.stop()
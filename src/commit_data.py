@@ -1,6 +1,11 @@
 import argparse
 from pathlib import Path
-import xml.etree.ElementTree 
+import sys
+import xml.etree.ElementTree
+from capture import FRAME_SUFFIXES, convert_to_png
+from dedup import HashIndex, append_dataset_hashes, dhash_files, load_dataset_hashes
+from manifest import apply_commit, load_journal, next_id, rollback_commit, start_commit
+from profiling import PROFILER, add_profile_argument
 # this file moves verified images and labels to the data folder
 # the data folder is then used to train the model
 if __name__ == "__main__":
@@ -18,100 +23,150 @@ if __name__ == "__main__":
     parser.add_argument('-di', '--commit-images-to', help='Folder to move the verified images to.')
     # optional argument to specify the folder to move the verified .xml label files to; defaults to ../clean_data/labels if not specified
     parser.add_argument('-dl', '--commit-labels-to', help='Folder to move the verified .xml label files to.')
+    # optional argument to specify the manifest of committed images; defaults to ../clean_data/manifest.csv if not specified
+    parser.add_argument('-m', '--manifest', help='Manifest of committed images.')
+    # commit images even if they are near-duplicates of images already in the dataset
+    parser.add_argument('--allow-duplicates', action='store_true', help='Commit near-duplicate images too.')
+    parser.add_argument('--dedup-threshold', type=int, default=4, help='Images whose 64 bit hashes differ in at most this many bits are duplicates.')
+    # finish or undo a commit that was interrupted
+    parser.add_argument('--resume', action='store_true', help='Finish an interrupted commit.')
+    parser.add_argument('--rollback', action='store_true', help='Undo an interrupted commit.')
+    add_profile_argument(parser)
 
     args = parser.parse_args()
-    here = Path(__file__).parent
-    if args.images:
-        images_folder = args.images
-    else:
-        images_folder = here/'../screenshots'
-    if args.labels:
-        labels_folder = args.labels
-    else:
-        labels_folder = here/'../labels'
-    if args.commit_labels_to:
-        commit_labels_to = args.commit_labels_to
-    else:
-        commit_labels_to = here/'../clean_data/labels'
-    if args.commit_images_to:
-        commit_images_to = args.commit_images_to
-    else:
-        commit_images_to = here/'../clean_data/images'
-    # err if the source folders don't exist
-    if not images_folder.exists():
-        raise FileNotFoundError(f'{images_folder} does not exist')
-    if not labels_folder.exists():
-        raise FileNotFoundError(f'{labels_folder} does not exist')
-    # make sure the destination folders exist
-    commit_labels_to.mkdir(parents=True, exist_ok=True)
-    commit_images_to.mkdir(parents=True, exist_ok=True)
-    # check that there is a corresponding label file for each image in the source folder
-    for image_file in images_folder.glob('*.png'):
-        # get the image file name without the extension
-        image_name = image_file.stem
-        # get the label file name
-        label_file = labels_folder/f'{image_name}.xml'
-        # check that the label file exists
-        if not label_file.exists():
-            raise FileNotFoundError(f'{label_file} does not exist for image {image_name}.png. There must be a label in the source labels folder for each image in the source images folder.')
+    PROFILER.start(args.profile)
+    # finish in a finally so the --resume/--rollback exit and errors still write the profile
+    try:
+        here = Path(__file__).parent
+        if args.images:
+            images_folder = Path(args.images)
+        else:
+            images_folder = here/'../screenshots'
+        if args.labels:
+            labels_folder = Path(args.labels)
+        else:
+            labels_folder = here/'../labels'
+        if args.commit_labels_to:
+            commit_labels_to = Path(args.commit_labels_to)
+        else:
+            commit_labels_to = here/'../clean_data/labels'
+        if args.commit_images_to:
+            commit_images_to = Path(args.commit_images_to)
+        else:
+            commit_images_to = here/'../clean_data/images'
+        if args.manifest:
+            manifest_path = Path(args.manifest)
+        else:
+            manifest_path = commit_images_to.parent/'manifest.csv'
+        # deal with an interrupted commit before anything else
+        journal = load_journal(manifest_path)
+        if args.resume or args.rollback:
+            if journal is None:
+                print('No interrupted commit found.')
+            elif args.resume:
+                apply_commit(journal, verbose=True)
+                # the interrupted run never got to record the batch's hashes
+                new_images = [Path(new_image) for _, _, _, new_image, _ in journal['moves']]
+                append_dataset_hashes(manifest_path.parent/'hashes.npz', [p.stem for p in new_images], dhash_files(new_images).tolist(), commit_images_to)
+                print('Interrupted commit finished.')
+            else:
+                rollback_commit(journal, verbose=True)
+                print('Interrupted commit rolled back.')
+            sys.exit(0)
+        if journal is not None:
+            raise RuntimeError(f'An interrupted commit was found ({len(journal["moves"])} files). Run again with --resume or --rollback.')
+        # err if the source folders don't exist
+        if not images_folder.exists():
+            raise FileNotFoundError(f'{images_folder} does not exist')
+        if not labels_folder.exists():
+            raise FileNotFoundError(f'{labels_folder} does not exist')
+        # make sure the destination folders exist
+        commit_labels_to.mkdir(parents=True, exist_ok=True)
+        commit_images_to.mkdir(parents=True, exist_ok=True)
+        # gather the image files (png, or webp from screenshot.py --format webp)
+        image_files = sorted((p for p in images_folder.iterdir() if p.suffix in FRAME_SUFFIXES), key=lambda x: (len(x.stem), x.stem))
+        # check that there is a corresponding label file for each image in the source folder
+        seen = {}
+        for image_file in image_files:
+            # get the image file name without the extension
+            image_name = image_file.stem
+            # a png and a webp with the same name would share one label
+            if image_name in seen:
+                raise FileExistsError(f'{seen[image_name]} and {image_file} have the same name. Remove one of them.')
+            seen[image_name] = image_file
+            # get the label file name
+            label_file = labels_folder/f'{image_name}.xml'
+            # check that the label file exists
+            if not label_file.exists():
+                raise FileNotFoundError(f'{label_file} does not exist for image {image_file.name}. There must be a label in the source labels folder for each image in the source images folder.')
 
-    # gather all label files and image files
-    label_files = list(labels_folder.glob('*.xml'))
-    image_files = list(images_folder.glob('*.png')) 
-    # collect the next len(label_files) available file names for the images and labels
-    # get the next available file name for the images
-    next_available_l= len(list(commit_labels_to.glob('*.xml')))
-    next_available_i= len(list(commit_images_to.glob('*.png')))
-    assert(next_available_i == next_available_l)
-    new_l_stems = [f'{next_available_l+i}' for i in range(len(label_files))]
-    new_i_stems = [f'{next_available_i+i}' for i in range(len(image_files))]
-    # construct the new file names for the labels and images
-    new_l_files = [commit_labels_to/f'{new_l_stem}.xml' for new_l_stem in new_l_stems]
-    new_i_files = [commit_images_to/f'{new_i_stem}.png' for new_i_stem in new_i_stems]
-    # report the changes to the user
-    print('The following files will be moved:')
-    for old_label_file, new_label_file in zip(label_files, new_l_files):
-        print(f'{old_label_file} -> {new_label_file}')
-    for old_image_file, new_image_file in zip(image_files, new_i_files):
-        print(f'{old_image_file} -> {new_image_file}')
-    # ask the user if they want to continue
-    answer = input('Continue? (y/n) ')
-    if answer.lower() == 'y':
-        # move the files
-        for label_file, new_label_file in zip(label_files, new_l_files):
-            # change the folder file and path in the xml file to reflect the new location
+        # gather the label files
+        label_files = [labels_folder/f'{image_file.stem}.xml' for image_file in image_files]
+        # labels without an image are left where they are
+        for label_file in set(labels_folder.glob('*.xml')) - set(label_files):
+            print(f'Warning: {label_file} has no image and will not be moved.')
+        # leave out images that are already in the dataset (or earlier in this batch)
+        batch_hashes = {}
+        if not args.allow_duplicates:
+            with PROFILER.stage('dedup_load'):
+                hash_index = load_dataset_hashes(commit_images_to, manifest_path.parent/'hashes.npz', args.dedup_threshold)
+            with PROFILER.stage('dedup_hash', len(image_files)):
+                batch_hashes_list = dhash_files(image_files).tolist()
+            batch_index = HashIndex(args.dedup_threshold)
+            kept = []
+            for image_file, label_file, hash_value in zip(image_files, label_files, batch_hashes_list):
+                matches = hash_index.query(hash_value)
+                batch_matches = batch_index.query(hash_value)
+                if matches:
+                    print(f'Warning: {image_file} is a near-duplicate of {commit_images_to/f"{matches[0][0]}.png"} and will not be moved.')
+                elif batch_matches:
+                    print(f'Warning: {image_file} is a near-duplicate of {images_folder/batch_matches[0][0]} and will not be moved.')
+                else:
+                    batch_index.add(image_file.name, hash_value)
+                    batch_hashes[image_file] = hash_value
+                    kept.append((image_file, label_file))
+            image_files = [image_file for image_file, _ in kept]
+            label_files = [label_file for _, label_file in kept]
+        # the next available ids come from the manifest rather than counting the destination folders
+        first_id = next_id(manifest_path, commit_images_to)
+        moves = []
+        for i, (image_file, label_file) in enumerate(zip(image_files, label_files)):
+            new_image_file = commit_images_to/f'{first_id + i}.png'
+            new_label_file = commit_labels_to/f'{first_id + i}.xml'
+            # never overwrite anything that's already in the dataset
+            if new_image_file.exists() or new_label_file.exists():
+                raise FileExistsError(f'{new_image_file} already exists. The manifest is out of date; run repair_integrity.py.')
+            moves.append((first_id + i, image_file, label_file, new_image_file, new_label_file))
+        # report the changes to the user
+        print('The following files will be moved:')
+        for _, image_file, label_file, new_image_file, new_label_file in moves:
+            print(f'{label_file} -> {new_label_file}')
+            print(f'{image_file} -> {new_image_file}')
+        # ask the user if they want to continue
+        answer = input('Continue? (y/n) ')
+        if answer.lower() == 'y':
+            # clean_data only holds pngs; convert webp frames in place first so the journal only ever moves files
+            with PROFILER.stage('convert'):
+                for k, (i, image_file, label_file, new_image_file, new_label_file) in enumerate(moves):
+                    if image_file.suffix != '.png':
+                        png_file = convert_to_png(image_file)
+                        if image_file in batch_hashes:
+                            batch_hashes[png_file] = batch_hashes.pop(image_file)
+                        moves[k] = (i, png_file, label_file, new_image_file, new_label_file)
+            # write the journal, then move the files
+            journal = start_commit(manifest_path, moves)
             try:
-                tree = xml.etree.ElementTree.parse(label_file)
-            except xml.etree.ElementTree.ParseError:
-                print(f'{label_file} is not a valid xml file. Skipping.')
-                raise FileNotFoundError(f'{label_file} is not a valid xml file. Skipping.')
-            root = tree.getroot()
-            folder = root.find('folder')
-            folder.text = commit_labels_to.name 
-            for filename in root.findall('filename'):
-                filename.text = str(new_label_file.name)
-            # new path
-            for path in root.findall('path'):
-                path.text = str(new_label_file.resolve().parent)
-            tree.write(label_file)
-            label_file.rename(str(new_label_file))
-
-        for image_file, new_image_file in zip(image_files, new_i_files):
-            image_file.rename(new_image_file)
-        print('Files moved successfully.')
-        if len(list(commit_labels_to.glob('*.xml'))) != len(list(commit_images_to.glob('*.png'))):
-            raise ValueError('The number of label files and image files in the destination folders must be the same. Label scheme might be corrputed.')
-        n = len(list(commit_labels_to.glob('*.xml')))
-        # check that the file names are in order
-        for i in range(n):
-            if not commit_labels_to.glob(f'{i}.xml') or not commit_images_to.glob(f'{i}.png'):
-                raise ValueError('The file names in the destination folders are not in order. Label scheme might be corrputed.')
-    else:
-        print('Files not moved.')
-
-
-
-
-
-
-
+                with PROFILER.stage('commit', len(moves)):
+                    apply_commit(journal)
+            except xml.etree.ElementTree.ParseError as e:
+                raise ValueError(f'A label file is not a valid xml file ({e}). Fix it and run again with --resume, or undo the batch with --rollback.')
+            print(f'{len(moves)} images committed successfully.')
+            if not args.allow_duplicates:
+                # remember the committed images' hashes under their new ids
+                with PROFILER.stage('dedup_save', len(moves)):
+                    append_dataset_hashes(manifest_path.parent/'hashes.npz', [i for i, *_ in moves],
+                                          [batch_hashes[image_file] for _, image_file, *_ in moves], commit_images_to)
+        else:
+            print('Files not moved.')
+    finally:
+        PROFILER.finish()
@@ -0,0 +1,300 @@
+# columnar index of the clean_data annotations
+# compiles every label file into one memory-mapped file so questions about the dataset
+# (unit counts, image/label pairing, box sizes) don't need to re-read thousands of .xml files
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+import numpy as np
+from annotations import read_annotation
+
+MAGIC = b'TFTIDX1\0'
+# one row per label file
+IMAGE_DTYPE = np.dtype([
+    ('stem', '<i8'),
+    ('mtime_ns', '<i8'),
+    ('size', '<i8'),
+    ('width', '<i4'),
+    ('height', '<i4'),
+    ('first', '<i8'),
+    ('count', '<i4'),
+    ('has_image', '?'),
+])
+# one row per labelled unit; class_id is -1 for names that aren't in the classes csv
+OBJECT_DTYPE = np.dtype([
+    ('image', '<i4'),
+    ('class_id', '<i2'),
+    ('box', '<i4', (4,)),
+])
+ALIGN = 64
+
+def get_classes(labels_file_path) -> list:
+    """
+    Get the unit abbreviations in the order of the classes csv
+    Args:
+        labels_file_path: the csv to read from
+    Returns:
+        list of unit abbreviations
+    """
+    classes = []
+    with open(labels_file_path) as classes_file_handle:
+        for line in classes_file_handle.readlines():
+            if line.strip():
+                classes.append(line.split(",")[1].strip())
+    return classes
+
+def _align(n) -> int:
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+class DatasetIndex:
+    """
+    Read-only view of an index file. The image and object tables are numpy memmaps.
+    """
+    def __init__(self, index_path):
+        """
+        Args:
+            index_path: the index file to open
+        """
+        self.path = Path(index_path)
+        with open(self.path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{self.path} is not a dataset index')
+            header_size = int.from_bytes(f.read(8), 'little')
+            self._read_header(json.loads(f.read(header_size)))
+        self.images = self._table('images', IMAGE_DTYPE)
+        self.objects = self._table('objects', OBJECT_DTYPE)
+
+    @classmethod
+    def in_memory(cls, header, images, objects) -> 'DatasetIndex':
+        """
+        An index that was built but not written to disk
+        Args:
+            header: the header dictionary (classes, unindexed, orphan_images)
+            images: IMAGE_DTYPE table
+            objects: OBJECT_DTYPE table
+        """
+        index = cls.__new__(cls)
+        index.path = None
+        index._read_header(header)
+        index.images = images
+        index.objects = objects
+        return index
+
+    def _read_header(self, header):
+        self.header = header
+        self.classes = self.header['classes']
+        self.class_ids = {c: i for i, c in enumerate(self.classes)}
+        # every label file whose stem isn't a number can't go in the stem column
+        self.unindexed = self.header['unindexed']
+        # images in the images folder with no label file
+        self.orphan_images = self.header['orphan_images']
+
+    def _table(self, name, dtype):
+        offset, count = self.header[name]
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self.path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+
+    def __len__(self):
+        return len(self.images)
+
+    def class_counts(self) -> dict:
+        """
+        Count the units of each class
+        Returns:
+            dictionary of {unit_abbreviation: count}; unknown names are counted under None
+        """
+        class_ids = np.asarray(self.objects['class_id'], dtype=np.int64)
+        counts = np.bincount(class_ids + 1, minlength=len(self.classes) + 1)
+        result = {c: int(n) for c, n in zip(self.classes, counts[1:])}
+        if counts[0]:
+            result[None] = int(counts[0])
+        return result
+
+    def images_with(self, unit) -> np.ndarray:
+        """
+        Get the stems of the images containing a unit
+        Args:
+            unit: the unit abbreviation
+        Returns:
+            sorted array of image stems
+        """
+        rows = self.objects['image'][self.objects['class_id'] == self.class_ids[unit]]
+        return np.unique(self.images['stem'][rows])
+
+    def objects_for(self, stem) -> np.ndarray:
+        """
+        Get the objects labelled in an image
+        Args:
+            stem: the image stem (e.g. 42 for 42.png)
+        Returns:
+            structured array of OBJECT_DTYPE rows
+        """
+        row = np.searchsorted(self.images['stem'], stem)
+        if row >= len(self.images) or self.images['stem'][row] != stem:
+            raise KeyError(stem)
+        first, count = int(self.images['first'][row]), int(self.images['count'][row])
+        return self.objects[first:first + count]
+
+    def box_sizes(self) -> np.ndarray:
+        """
+        Returns:
+            Nx2 array of (width, height) for every labelled unit
+        """
+        boxes = np.asarray(self.objects['box'])
+        return np.stack([boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]], axis=1)
+
+    def missing_images(self) -> np.ndarray:
+        """
+        Returns:
+            stems of label files with no matching image
+        """
+        return self.images['stem'][~self.images['has_image']]
+
+def check_integrity(index) -> list:
+    """
+    Check that every image has a label and every label has an image
+    Args:
+        index: the DatasetIndex to check
+    Returns:
+        list of human readable problems (empty if the dataset is consistent)
+    """
+    problems = []
+    for stem in index.missing_images():
+        problems.append(f'{stem}.xml has no image')
+    for stem in index.orphan_images:
+        problems.append(f'{stem}.png has no label')
+    for name in index.unindexed:
+        problems.append(f'{name} does not have a numeric name')
+    unknown = index.class_counts().get(None, 0)
+    if unknown:
+        problems.append(f'{unknown} labelled units are not in the classes file')
+    return problems
+
+def _write_index(index_path, header, images, objects):
+    """
+    Atomically write an index file
+    """
+    index_path = Path(index_path)
+    tables = [('images', images), ('objects', objects)]
+    # the header records table offsets, which depend on the header size, so settle the size first
+    header = dict(header, images=[0, 0], objects=[0, 0])
+    header_bytes = json.dumps(header).encode()
+    for _ in range(2):
+        offset = _align(len(MAGIC) + 8 + len(header_bytes) + 64)
+        for name, table in tables:
+            header[name] = [offset, len(table)]
+            offset = _align(offset + table.nbytes)
+        header_bytes = json.dumps(header).encode()
+    tmp_path = index_path.with_suffix(index_path.suffix + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(len(header_bytes).to_bytes(8, 'little'))
+        f.write(header_bytes)
+        for name, table in tables:
+            f.seek(header[name][0])
+            f.write(table.tobytes())
+        f.truncate(max([header[name][0] + table.nbytes for name, table in tables]))
+    os.replace(tmp_path, index_path)
+
+def build_index(labels_folder, images_folder, classes, index_path, verbose=False, save=True) -> DatasetIndex:
+    """
+    Build or update the index. Label files whose mtime and size haven't changed
+    since the last build are copied from the old index instead of being re-parsed.
+    Args:
+        labels_folder: folder containing the .xml label files
+        images_folder: folder containing the .png images
+        classes: list of unit abbreviations
+        index_path: the index file to write
+        verbose: print how many files were re-parsed
+        save: write the updated index to index_path; otherwise it is only kept in memory (e.g. for a read-only check)
+    Returns:
+        the updated DatasetIndex
+    """
+    start = time.perf_counter()
+    index_path = Path(index_path)
+    old = None
+    if index_path.exists():
+        try:
+            old = DatasetIndex(index_path)
+        except (ValueError, KeyError, json.JSONDecodeError):
+            old = None
+        # class ids are only comparable if the classes are the same
+        if old is not None and old.classes != list(classes):
+            old = None
+    old_rows = {}
+    if old is not None:
+        # copy the old tables out of the file so it can be replaced (windows won't replace a mapped file)
+        old_images, old_objects = np.array(old.images), np.array(old.objects)
+        old_rows = {int(stem): row for row, stem in enumerate(old_images['stem'])}
+        del old
+    class_ids = {c: i for i, c in enumerate(classes)}
+    image_stems = {entry.name[:-4] for entry in os.scandir(images_folder) if entry.name.endswith('.png')}
+    # collect the label files, sorted by stem
+    labels, unindexed = [], []
+    for entry in os.scandir(labels_folder):
+        if not entry.name.endswith('.xml'):
+            continue
+        stem = entry.name[:-4]
+        if not stem.isdigit():
+            unindexed.append(entry.name)
+            continue
+        labels.append((int(stem), entry))
+    labels.sort(key=lambda x: x[0])
+    label_stems = {str(stem) for stem, _ in labels}
+    images = np.zeros(len(labels), dtype=IMAGE_DTYPE)
+    object_chunks = []
+    first = 0
+    reparsed = 0
+    for row, (stem, entry) in enumerate(labels):
+        st = entry.stat()
+        old_row = old_rows.get(stem)
+        if old_row is not None and old_images['mtime_ns'][old_row] == st.st_mtime_ns and old_images['size'][old_row] == st.st_size:
+            # unchanged since the last build; reuse the old rows
+            old_image = old_images[old_row]
+            width, height = old_image['width'], old_image['height']
+            chunk = old_objects[old_image['first']:old_image['first'] + old_image['count']].copy()
+        else:
+            annotation = read_annotation(entry.path)
+            width, height = annotation.width, annotation.height
+            chunk = np.zeros(len(annotation), dtype=OBJECT_DTYPE)
+            chunk['class_id'] = [class_ids.get(name, -1) for name in annotation.names]
+            chunk['box'] = np.frombuffer(annotation.boxes, dtype=np.int32).reshape(-1, 4) if len(annotation) else 0
+            reparsed += 1
+        chunk['image'] = row
+        images[row] = (stem, st.st_mtime_ns, st.st_size, width, height, first, len(chunk), str(stem) in image_stems)
+        object_chunks.append(chunk)
+        first += len(chunk)
+    objects = np.concatenate(object_chunks) if object_chunks else np.zeros(0, dtype=OBJECT_DTYPE)
+    header = {
+        'classes': list(classes),
+        'unindexed': sorted(unindexed),
+        'orphan_images': sorted(image_stems - label_stems),
+    }
+    if verbose:
+        print(f'[INFO] indexed {len(labels)} label files ({reparsed} re-parsed) in {time.perf_counter() - start:.2f}s')
+    if not save:
+        return DatasetIndex.in_memory(header, images, objects)
+    _write_index(index_path, header, images, objects)
+    return DatasetIndex(index_path)
+
+if __name__ == '__main__':
+    # builds (or updates) the index for the clean_data folder and reports any integrity problems
+    parser = argparse.ArgumentParser(description='Build the clean_data dataset index.')
+    # optional argument to specify the labels folder; defaults to ../clean_data/labels
+    parser.add_argument('-l', '--labels', help='Folder containing the label files.')
+    # optional argument to specify the images folder; defaults to ../clean_data/images
+    parser.add_argument('-i', '--images', help='Folder containing the images.')
+    # optional argument to specify the index file; defaults to ../clean_data/dataset.idx
+    parser.add_argument('-x', '--index', help='Path to the index file.')
+    args = parser.parse_args()
+    here = Path(__file__).parent
+    labels_folder = Path(args.labels) if args.labels else here/'../clean_data/labels'
+    images_folder = Path(args.images) if args.images else here/'../clean_data/images'
+    index_path = Path(args.index) if args.index else here/'../clean_data/dataset.idx'
+    classes = get_classes(here/'../clean_data/static/set6_classes.csv')
+    index = build_index(labels_folder, images_folder, classes, index_path, verbose=True)
+    print(f'{len(index)} images, {len(index.objects)} labelled units')
+    for problem in check_integrity(index):
+        print(problem)
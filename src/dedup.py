@@ -0,0 +1,271 @@
+# near-duplicate frame detection
+# frames are reduced to 64 bit difference hashes (dhash); two frames whose hashes differ in only a
+# few bits are treated as the same board. lookups use multi-index hashing: the hash is split into
+# threshold+1 chunks and, by the pigeonhole principle, any hash within the threshold must match at
+# least one chunk exactly, so only those candidates need a full comparison.
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+from PIL import Image
+
+# number of set bits in every byte value
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def _thumbnail(im) -> np.ndarray:
+    """
+    Shrink an image to the 9x8 grayscale thumbnail the hash is computed from
+    Args:
+        im: PIL image, HxWx3 uint8 array (RGB) or path to an image
+    """
+    if isinstance(im, (str, os.PathLike)):
+        with Image.open(im) as f:
+            return _thumbnail(f)
+    if isinstance(im, np.ndarray):
+        im = Image.fromarray(im)
+    return np.asarray(im.convert('L').resize((9, 8), Image.BOX), dtype=np.int16)
+
+def _hash_thumbnails(thumbs) -> np.ndarray:
+    """
+    Turn a list of 9x8 thumbnails into 64 bit hashes in one pass
+    """
+    if not thumbs:
+        return np.zeros(0, dtype=np.uint64)
+    thumbs = np.stack(thumbs)
+    # one bit per pixel: is it brighter than its left neighbour
+    bits = thumbs[:, :, 1:] > thumbs[:, :, :-1]
+    return np.packbits(bits.reshape(len(thumbs), 64), axis=1).view('>u8').astype(np.uint64).reshape(-1)
+
+def dhash(images) -> np.ndarray:
+    """
+    Compute the difference hash of a batch of images
+    Args:
+        images: list of PIL images, RGB arrays or image paths
+    Returns:
+        uint64 array of hashes, one per image
+    """
+    return _hash_thumbnails([_thumbnail(im) for im in images])
+
+def dhash_files(paths, workers=None) -> np.ndarray:
+    """
+    Hash image files, decoding them on a thread pool
+    Args:
+        paths: list of image paths
+        workers: number of decoding threads
+    Returns:
+        uint64 array of hashes, one per path
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        thumbs = list(pool.map(_thumbnail, paths))
+    return _hash_thumbnails(thumbs)
+
+def hamming(hash_value, hashes) -> np.ndarray:
+    """
+    Count the differing bits between one hash and an array of hashes
+    Args:
+        hash_value: a 64 bit hash
+        hashes: uint64 array of hashes
+    Returns:
+        array of bit distances
+    """
+    x = np.bitwise_xor(np.asarray(hashes, dtype=np.uint64), np.uint64(hash_value))
+    return _POPCOUNT[x.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+class HashIndex:
+    """
+    Near-duplicate lookup over a set of named hashes
+    """
+    def __init__(self, threshold=4):
+        """
+        Args:
+            threshold: hashes differing in at most this many bits are duplicates
+        """
+        self.threshold = threshold
+        # split the 64 bits into threshold+1 chunks
+        chunks = threshold + 1
+        edges = np.linspace(0, 64, chunks + 1).astype(int)
+        self.chunks = [(int(lo), int(hi)) for lo, hi in zip(edges[:-1], edges[1:])]
+        self.tables = [dict() for _ in self.chunks]
+        self.names = []
+        self._hashes = []
+        self._array = np.zeros(0, dtype=np.uint64)
+
+    def _keys(self, hash_value):
+        hash_value = int(hash_value)
+        return [(hash_value >> lo) & ((1 << (hi - lo)) - 1) for lo, hi in self.chunks]
+
+    def add(self, name, hash_value):
+        """
+        Add a named hash to the index
+        """
+        row = len(self.names)
+        self.names.append(name)
+        self._hashes.append(int(hash_value))
+        for table, key in zip(self.tables, self._keys(hash_value)):
+            table.setdefault(key, []).append(row)
+
+    def hashes(self) -> np.ndarray:
+        if len(self._array) != len(self._hashes):
+            self._array = np.array(self._hashes, dtype=np.uint64)
+        return self._array
+
+    def query(self, hash_value) -> list:
+        """
+        Find the near-duplicates of a hash
+        Args:
+            hash_value: the hash to look up
+        Returns:
+            list of (name, distance) of indexed hashes within the threshold, closest first
+        """
+        candidates = set()
+        for table, key in zip(self.tables, self._keys(hash_value)):
+            candidates.update(table.get(key, ()))
+        if not candidates:
+            return []
+        rows = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        distances = hamming(hash_value, self.hashes()[rows])
+        close = distances <= self.threshold
+        return sorted(((self.names[r], int(d)) for r, d in zip(rows[close], distances[close])), key=lambda x: x[1])
+
+    def __len__(self):
+        return len(self.names)
+
+def load_dataset_hashes(images_folder, index_path, threshold=4, workers=None, rescan=False) -> HashIndex:
+    """
+    Get the hash index of every image in a folder, keyed by file stem.
+    The saved index is trusted as it is (commit_data.py appends every batch it commits), so loading it doesn't
+    touch the images. Without a saved index, or with rescan, every image's mtime is checked against the saved
+    one and only images that are new or have changed get decoded.
+    Args:
+        images_folder: the folder of .png images
+        index_path: the .npz file the hashes are kept in
+        threshold: hashes differing in at most this many bits are duplicates
+        workers: number of decoding threads
+        rescan: check the saved hashes against the images (e.g. after editing clean_data by hand)
+    Returns:
+        the HashIndex
+    """
+    index = HashIndex(threshold)
+    if Path(index_path).exists() and not rescan:
+        with np.load(index_path) as data:
+            for name, hash_value in zip(data['names'].tolist(), data['hashes'].tolist()):
+                index.add(name, hash_value)
+        return index
+    files = {entry.name[:-4]: entry.stat().st_mtime_ns for entry in os.scandir(images_folder) if entry.name.endswith('.png')}
+    known = {}
+    saved = 0
+    if Path(index_path).exists():
+        with np.load(index_path) as data:
+            saved = len(data['names'])
+            for name, hash_value, mtime in zip(data['names'].tolist(), data['hashes'].tolist(), data['mtimes'].tolist()):
+                if files.get(name) == mtime:
+                    known[name] = hash_value
+    missing = [stem for stem in files if stem not in known]
+    for stem, hash_value in zip(missing, dhash_files([Path(images_folder)/f'{stem}.png' for stem in missing], workers).tolist()):
+        known[stem] = hash_value
+    for stem in files:
+        index.add(stem, known[stem])
+    # also drops the hashes of images that are gone
+    if missing or saved != len(files) or not Path(index_path).exists():
+        save_dataset_hashes(index, index_path, images_folder)
+    return index
+
+def stale_dataset_hashes(images_folder, index_path) -> list:
+    """
+    Find the saved hashes that don't match the images any more, without decoding or writing anything
+    Args:
+        images_folder: the folder of .png images
+        index_path: the .npz file the hashes are kept in
+    Returns:
+        sorted list of stems of images that are new or changed since their hash was saved, or gone
+    """
+    # without a saved index there is nothing to be stale; the next commit builds it
+    if not Path(index_path).exists():
+        return []
+    files = {entry.name[:-4]: entry.stat().st_mtime_ns for entry in os.scandir(images_folder) if entry.name.endswith('.png')}
+    with np.load(index_path) as data:
+        saved = dict(zip(data['names'].tolist(), data['mtimes'].tolist()))
+    return sorted((stem for stem in files.keys() | saved.keys() if files.get(stem) != saved.get(stem)), key=lambda stem: (len(stem), stem))
+
+def save_dataset_hashes(index, index_path, images_folder):
+    """
+    Save a dataset hash index along with the mtimes of the images it was computed from
+    Args:
+        index: HashIndex keyed by file stem
+        index_path: the .npz file to write
+        images_folder: the folder of .png images
+    """
+    mtimes = [os.stat(Path(images_folder)/f'{stem}.png').st_mtime_ns for stem in index.names]
+    _write_hashes(index_path, np.array(index.names, dtype=str), index.hashes(), np.array(mtimes, dtype=np.int64))
+
+def _write_hashes(index_path, names, hashes, mtimes):
+    index_path = Path(index_path)
+    tmp_path = index_path.with_name(index_path.name + '.tmp.npz')
+    np.savez(tmp_path, names=names, hashes=hashes, mtimes=mtimes)
+    os.replace(tmp_path, index_path)
+
+def append_dataset_hashes(index_path, stems, hashes, images_folder):
+    """
+    Add the hashes of newly committed images to a saved index, only looking at those images
+    Args:
+        index_path: the .npz file the hashes are kept in (nothing is done if it doesn't exist yet;
+                    the next load_dataset_hashes builds it from the whole folder)
+        stems: the stems of the new images
+        hashes: their hashes
+        images_folder: the folder of .png images
+    """
+    if not Path(index_path).exists() or not len(stems):
+        return
+    stems = [str(stem) for stem in stems]
+    mtimes = [os.stat(Path(images_folder)/f'{stem}.png').st_mtime_ns for stem in stems]
+    with np.load(index_path) as data:
+        names, old_hashes, old_mtimes = data['names'], data['hashes'], data['mtimes']
+    # a resumed commit may add images that are already in the index
+    keep = ~np.isin(names, stems)
+    _write_hashes(index_path,
+                  np.concatenate([names[keep], np.array(stems, dtype=str)]),
+                  np.concatenate([old_hashes[keep], np.array(hashes, dtype=np.uint64)]),
+                  np.concatenate([old_mtimes[keep], np.array(mtimes, dtype=np.int64)]))
+
+def remap_dataset_hashes(index_path, renames):
+    """
+    Follow renamed images in a saved index
+    Args:
+        index_path: the .npz file the hashes are kept in
+        renames: dictionary of {old stem: new stem}
+    """
+    if not Path(index_path).exists() or not renames:
+        return
+    renames = {str(old): str(new) for old, new in renames.items()}
+    with np.load(index_path) as data:
+        names, hashes, mtimes = data['names'].tolist(), data['hashes'], data['mtimes']
+    # renaming keeps the mtime
+    _write_hashes(index_path, np.array([renames.get(name, name) for name in names], dtype=str), hashes, mtimes)
+
+class RecentFrames:
+    """
+    Remembers the hashes of the last few frames so near-identical consecutive frames can be dropped
+    """
+    def __init__(self, size=32, threshold=4):
+        """
+        Args:
+            size: number of recent frames to compare against
+            threshold: frames whose hashes differ in at most this many bits are duplicates
+        """
+        self.recent = deque(maxlen=size)
+        self.threshold = threshold
+
+    def is_new(self, im) -> bool:
+        """
+        Check a frame against the recent frames, remembering it if it's new
+        Args:
+            im: PIL image or RGB array
+        Returns:
+            False if the frame is a near-duplicate of a recent frame
+        """
+        hash_value = int(dhash([im])[0])
+        if self.recent and hamming(hash_value, np.array(self.recent, dtype=np.uint64)).min() <= self.threshold:
+            return False
+        self.recent.append(hash_value)
+        return True
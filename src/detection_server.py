@@ -0,0 +1,306 @@
+# long-running detection service
+# loads the model once and answers detection requests over http, so the capture and labelling tools
+# can share one warm model instead of paying the load cost on every run. requests that arrive close
+# together are grouped into one predict call (micro-batching), bounded by a maximum added latency.
+#
+#   POST /detect?format=json|voc&raw=0|1
+#       body: a png/jpeg (image/*), a HxWx3 BGR uint8 array saved with np.save (application/x-npy)
+#             or {"paths": [...]} (application/json) to read images on the server
+#   GET /health
+#   GET /info     classes, model fingerprint and the regions/scale the model runs at
+import argparse
+import io
+import json
+import queue
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import cv2
+import numpy as np
+from annotations import Annotation, to_xml
+from detector import Detector, add_detector_arguments, detector_from_args, parse_regions
+from postprocess import PostProcessor, load_thresholds
+
+class MicroBatcher:
+    """
+    Groups images submitted from many threads into batched predict calls
+    """
+    def __init__(self, detector, max_batch=8, max_latency=0.01):
+        """
+        Args:
+            detector: the Detector to predict with
+            max_batch: maximum number of images per predict call
+            max_latency: seconds to wait for more images after the first one of a batch arrives
+        """
+        self.detector = detector
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.images = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image, raw=False) -> Future:
+        """
+        Queue an image for detection
+        Args:
+            image: HxWxC BGR uint8 array (as read by cv2)
+            raw: return the unfiltered model output instead of the post-processed predictions
+        Returns:
+            Future resolving to (labels, boxes, scores)
+        """
+        future = Future()
+        self.requests.put((image, raw, future))
+        return future
+
+    def _collect(self) -> list:
+        batch = [self.requests.get()]
+        if batch[0] is None:
+            return batch
+        deadline = time.perf_counter() + self.max_latency
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                item = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(item)
+            if item is None:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            stop = batch[-1] is None
+            batch = [item for item in batch if item is not None]
+            if batch:
+                self._predict(batch)
+            if stop:
+                return
+
+    def _predict(self, batch):
+        try:
+            predictions = self.detector.predict_raw([image for image, _, _ in batch])
+            # filter everything that wants it in one post-processing pass
+            filtered = [i for i, (_, raw, _) in enumerate(batch) if not raw]
+            if filtered:
+                for i, prediction in zip(filtered, self.detector.postprocess([predictions[i] for i in filtered])):
+                    predictions[i] = prediction
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        self.images += len(batch)
+        for (_, _, future), prediction in zip(batch, predictions):
+            future.set_result(prediction)
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+def _read_image(image_path):
+    image = cv2.imdecode(np.fromfile(str(image_path), dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f'Could not read image {image_path}')
+    return image
+
+def _to_dict(prediction, image_shape, image_path=None) -> dict:
+    labels, boxes, scores = prediction
+    result = {
+        'width': int(image_shape[1]),
+        'height': int(image_shape[0]),
+        'labels': list(labels),
+        'boxes': np.asarray(boxes, dtype=np.float32).reshape(-1, 4).tolist(),
+        'scores': np.asarray(scores, dtype=np.float32).reshape(-1).tolist(),
+    }
+    if image_path is not None:
+        result['path'] = str(image_path)
+    return result
+
+def _to_voc(prediction, image_shape, image_path=None) -> str:
+    labels, boxes, _ = prediction
+    image_path = Path(image_path) if image_path is not None else Path('image.png')
+    depth = image_shape[2] if len(image_shape) > 2 else 1
+    annotation = Annotation(image_path.parent.name, image_path.name, str(image_path), image_shape[1], image_shape[0], depth)
+    for label, box in zip(labels, np.asarray(boxes).reshape(-1, 4).tolist()):
+        annotation.add(label, [int(x) for x in box])
+    return to_xml(annotation)
+
+class DetectionHandler(BaseHTTPRequestHandler):
+    """
+    Answers the requests of a DetectionServer
+    """
+    def _send(self, status, body, content_type='application/json'):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urllib.parse.urlparse(self.path).path
+        if path == '/health':
+            self._send(200, {'status': 'ok', 'batches': self.server.batcher.batches, 'images': self.server.batcher.images})
+        elif path == '/info':
+            detector = self.server.detector
+            self._send(200, {'classes': detector.classes, 'fingerprint': detector.fingerprint,
+                             'regions': detector.regions, 'scale': detector.scale})
+        else:
+            self._send(404, {'error': f'Unknown path {path}'})
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != '/detect':
+            self._send(404, {'error': f'Unknown path {url.path}'})
+            return
+        options = urllib.parse.parse_qs(url.query)
+        output_format = options.get('format', ['json'])[0]
+        raw = options.get('raw', ['0'])[0] in ('1', 'true')
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            content_type = self.headers.get('Content-Type', '').split(';')[0].strip()
+            if content_type == 'application/json':
+                paths = json.loads(body)['paths']
+                images = [_read_image(p) for p in paths]
+            elif content_type == 'application/x-npy':
+                paths = [None]
+                images = [np.load(io.BytesIO(body), allow_pickle=False)]
+            else:
+                paths = [None]
+                images = [cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)]
+                if images[0] is None:
+                    raise ValueError('Could not decode the image')
+            if output_format == 'voc' and len(images) != 1:
+                raise ValueError('format=voc takes exactly one image per request')
+        except (ValueError, KeyError, OSError) as e:
+            self._send(400, {'error': str(e)})
+            return
+        # submit every image before waiting so they can share a batch
+        futures = [self.server.batcher.submit(image, raw) for image in images]
+        try:
+            predictions = [future.result() for future in futures]
+        except Exception as e:
+            self._send(500, {'error': str(e)})
+            return
+        if output_format == 'voc':
+            self._send(200, _to_voc(predictions[0], images[0].shape, paths[0]), 'application/xml')
+        else:
+            self._send(200, {'results': [_to_dict(p, image.shape, path) for p, image, path in zip(predictions, images, paths)]})
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+class DetectionServer(ThreadingHTTPServer):
+    """
+    HTTP server around a warm Detector
+    """
+    daemon_threads = True
+
+    def __init__(self, address, detector, max_batch=8, max_latency=0.01, verbose=False):
+        """
+        Args:
+            address: (host, port) to listen on
+            detector: the Detector to serve
+            max_batch: maximum number of images per predict call
+            max_latency: seconds a request may wait for others to share its batch
+            verbose: log every request
+        """
+        super().__init__(address, DetectionHandler)
+        self.detector = detector
+        self.batcher = MicroBatcher(detector, max_batch, max_latency)
+        self.verbose = verbose
+
+    def server_close(self):
+        super().server_close()
+        self.batcher.close()
+
+class RemoteDetector(Detector):
+    """
+    Client for a running detection server with the same interface as Detector.
+    Raw predictions come from the server; post-processing happens locally so each client can use its own thresholds.
+    """
+    def __init__(self, url, iou_threshold=0.4, thresholds_file=None, top_k=None, class_agnostic=False, workers=8):
+        """
+        Args:
+            url: base url of the server, e.g. http://127.0.0.1:8765
+            iou_threshold: IoU threshold for non-maximum suppression
+            thresholds_file: optional csv of per-unit score thresholds
+            top_k: keep at most this many boxes per image
+            class_agnostic: suppress overlapping boxes regardless of unit
+            workers: number of requests in flight at once
+        """
+        self.url = url.rstrip('/')
+        with urllib.request.urlopen(f'{self.url}/info') as response:
+            info = json.load(response)
+        thresholds = load_thresholds(thresholds_file) if thresholds_file else None
+        postprocessor = PostProcessor(info['classes'], iou_threshold=iou_threshold, thresholds=thresholds, top_k=top_k, class_agnostic=class_agnostic)
+        super().__init__(None, info['classes'], postprocessor, info['fingerprint'], info.get('regions'), info.get('scale', 1.0))
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    @classmethod
+    def from_args(cls, url, args):
+        """
+        Connect to a server using the post-processing options from add_detector_arguments
+        The model options (-m, --engine, -t, --roi, --scale) belong to the server; asking for different ones is an error
+        rather than being silently ignored.
+        """
+        for option, value, default in (('-m', args.model, None), ('--engine', args.engine, 'detecto'), ('-t', args.torch_threads, None)):
+            if value != default:
+                raise ValueError(f'{option} has no effect with --server; pass it to detection_server.py instead')
+        detector = cls(url, iou_threshold=args.iou_threshold, thresholds_file=args.thresholds, top_k=args.top_k, class_agnostic=args.class_agnostic)
+        regions = [tuple(r) for r in parse_regions(args.roi)] if args.roi else None
+        server_regions = [tuple(r) for r in detector.regions] if detector.regions else None
+        if regions != server_regions or args.scale != detector.scale:
+            raise ValueError(f'The server at {url} runs with --roi {server_regions} --scale {detector.scale}, not --roi {regions} --scale {args.scale}; '
+                             'restart detection_server.py with the regions and scale you want')
+        return detector
+
+    def _predict_one(self, image):
+        buffer = io.BytesIO()
+        np.save(buffer, np.ascontiguousarray(image), allow_pickle=False)
+        request = urllib.request.Request(f'{self.url}/detect?raw=1', data=buffer.getvalue(), headers={'Content-Type': 'application/x-npy'})
+        with urllib.request.urlopen(request) as response:
+            result = json.load(response)['results'][0]
+        return result['labels'], np.array(result['boxes'], dtype=np.float32).reshape(-1, 4), np.array(result['scores'], dtype=np.float32)
+
+    def predict_raw(self, images) -> list:
+        # one request per image, all in flight at once, so the server can batch them with other clients' images
+        return list(self.pool.map(self._predict_one, images))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve the detection model over http.')
+    # model and post-processing options (-m model, -f label file, thresholds, nms)
+    add_detector_arguments(parser)
+    # address to listen on; only local connections by default
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on.')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on.')
+    # the most images run through the model at once
+    parser.add_argument('--max-batch', type=int, default=8, help='Maximum number of images per predict call.')
+    # how long a request may wait for others to share its batch
+    parser.add_argument('--max-latency', type=float, default=10, help='Maximum batching delay in milliseconds.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log every request.')
+    args = parser.parse_args()
+    start = time.perf_counter()
+    detector = detector_from_args(args)
+    print(f'[INFO] model loaded in {time.perf_counter() - start:.2f}s')
+    server = DetectionServer((args.host, args.port), detector, args.max_batch, args.max_latency / 1000, args.verbose)
+    print(f'[INFO] serving on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
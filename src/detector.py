@@ -0,0 +1,319 @@
+# the detection model and its post-processing
+# shared by every script that runs inference so they all load and filter predictions the same way
+import copy
+import json
+from pathlib import Path
+import numpy as np
+import torch
+from inference_cache import hash_bytes, model_fingerprint
+from postprocess import PostProcessor, load_thresholds
+
+here = Path(__file__).parent
+DEFAULT_MODEL = here/'../models/set6_best_model.pth'
+DEFAULT_LABELS_FILE = here/'../models/set6_labels.csv'
+# where export_model.py writes the torchscript model
+DEFAULT_EXPORTED_MODEL = here/'../models/set6_best_model.pt'
+# model formats load_detector can run
+ENGINES = ['detecto', 'torchscript']
+# the normalization detecto applies to images before they reach the model
+IMAGENET_MEAN = torch.tensor([0.485, 0.456, 0.406]).view(3, 1, 1)
+IMAGENET_STD = torch.tensor([0.229, 0.224, 0.225]).view(3, 1, 1)
+# `xmin:ymin:xmax:ymax` regions on the command line are given in the coordinates of a frame this size (width, height)
+REFERENCE_SIZE = (1920, 1080)
+
+def _fractions(xmin, ymin, xmax, ymax) -> tuple:
+    # reference frame pixels -> fractions of the frame
+    return xmin / REFERENCE_SIZE[0], ymin / REFERENCE_SIZE[1], xmax / REFERENCE_SIZE[0], ymax / REFERENCE_SIZE[1]
+
+# named regions of interest (xmin, ymin, xmax, ymax) as fractions of the frame, so they fit any resolution
+REGIONS = {
+    'board': _fractions(380, 150, 1540, 760),
+    'bench': _fractions(330, 740, 1560, 890),
+    'shop': _fractions(470, 920, 1500, 1080),
+}
+
+def parse_regions(specs) -> list:
+    """
+    Turn region names or `xmin:ymin:xmax:ymax` strings into boxes
+    Args:
+        specs: list of names from REGIONS or colon separated 1920x1080 coordinates
+    Returns:
+        list of (xmin, ymin, xmax, ymax) tuples as fractions of the frame
+    """
+    regions = []
+    for spec in specs:
+        if spec in REGIONS:
+            regions.append(REGIONS[spec])
+        else:
+            try:
+                xmin, ymin, xmax, ymax = [int(x) for x in spec.split(':')]
+            except ValueError:
+                raise ValueError(f'Unknown region {spec}. Use one of {", ".join(REGIONS)} or xmin:ymin:xmax:ymax.')
+            if xmin >= xmax or ymin >= ymax:
+                raise ValueError(f'Region {spec} is empty')
+            regions.append(_fractions(xmin, ymin, xmax, ymax))
+    return regions
+
+def get_labels(labels_file_path) -> dict:
+    """
+    Get the labels of the units in the passed in file
+    Args:
+        labels_file_path: the filename to read from
+    Returns:
+        dictionary of units {unit_full_name: unit_abbreviation}
+    """
+    # read set 6 units in
+    SET_6_UNITS = dict()
+    with open(labels_file_path) as classes_file_handle:
+        for line in classes_file_handle.readlines():
+            unit_name, abbreviated_name = [x.strip() for x in line.split(",")]
+            SET_6_UNITS[unit_name] = abbreviated_name
+    return SET_6_UNITS
+
+class ExportedModel:
+    """
+    A torchscript model written by export_model.py, with the same predict() as a detecto model
+    """
+    def __init__(self, model_path):
+        """
+        Args:
+            model_path: path to the exported .pt file
+        """
+        extra_files = {'detector.json': ''}
+        # named like detecto's attribute so the detector can reach the resize transform
+        self._model = torch.jit.load(str(model_path), map_location='cpu', _extra_files=extra_files)
+        self._model.eval()
+        meta = json.loads(extra_files['detector.json'])
+        # detecto's class list, starting with __background__
+        self._classes = meta['classes']
+        self.normalize = meta['normalize']
+        self.quantized = meta.get('quantized', False)
+
+    def predict(self, images) -> list:
+        """
+        Run the model on a list of HxWxC BGR uint8 arrays
+        Returns:
+            list of (labels, boxes, scores) tuples, one per image
+        """
+        tensors = []
+        for image in images:
+            tensor = torch.from_numpy(np.ascontiguousarray(image)).permute(2, 0, 1).float().div_(255)
+            if self.normalize:
+                tensor = (tensor - IMAGENET_MEAN) / IMAGENET_STD
+            tensors.append(tensor)
+        with torch.no_grad():
+            predictions = self._model(tensors)
+        # scripted detection models return (losses, detections)
+        if isinstance(predictions, tuple):
+            predictions = predictions[1]
+        return [([self._classes[i] for i in p['labels'].tolist()], p['boxes'], p['scores']) for p in predictions]
+
+class Detector:
+    """
+    A detecto model plus the post-processing applied to its predictions
+    """
+    def __init__(self, model, classes, postprocessor, fingerprint=None, regions=None, scale=1.0):
+        """
+        Args:
+            model: the loaded detecto model
+            classes: list of unit abbreviations the model predicts
+            postprocessor: PostProcessor applied by detect()
+            fingerprint: identifies the weights and labels for the inference cache
+            regions: optional list of (xmin, ymin, xmax, ymax) regions (fractions of the frame) to detect in; the rest of the frame is ignored
+            scale: inference resolution relative to the resolution the model normally runs full frames at
+        """
+        self.model = model
+        self.classes = classes
+        self.postprocessor = postprocessor
+        self.fingerprint = fingerprint
+        self.regions = regions
+        self.scale = scale
+        # the torchvision transform that resizes the detecto model's inputs (None for other models)
+        self.transform = None
+        if not isinstance(model, ExportedModel):
+            self.transform = getattr(getattr(model, '_model', None), 'transform', None)
+
+    def predict_raw(self, images) -> list:
+        """
+        Run the model on a batch of images
+        Args:
+            images: list of HxWxC BGR uint8 arrays (as read by cv2; the channel order the model is trained on)
+        Returns:
+            list of raw (labels, boxes, scores) tuples, one per image
+        """
+        if not images:
+            return []
+        if not self.regions and self.scale == 1:
+            return self.model.predict(list(images))
+        return self._predict_regions(images)
+
+    def _crops(self, image) -> list:
+        """
+        Get the (xmin, ymin, crop) of every region of an image; the crops are views, not copies
+        """
+        height, width = image.shape[:2]
+        if not self.regions:
+            return [(0, 0, image)]
+        crops = []
+        for xmin, ymin, xmax, ymax in self.regions:
+            x0, y0 = max(0, round(xmin * width)), max(0, round(ymin * height))
+            x1, y1 = min(width, round(xmax * width)), min(height, round(ymax * height))
+            if x1 > x0 and y1 > y0:
+                crops.append((x0, y0, image[y0:y1, x0:x1]))
+        return crops
+
+    def _predict_resized(self, crops, min_size, max_size) -> list:
+        """
+        Run the detecto model on crops resized to (min_size, max_size) instead of the model's own sizes.
+        The resize happens in a copy of the model's transform, so the model itself is never changed and
+        full frame predictions on other threads are unaffected.
+        Returns:
+            list of (labels, boxes, scores) tuples in crop coordinates, one per crop
+        """
+        network = self.model._model
+        transform = copy.copy(self.transform)
+        transform.min_size, transform.max_size = (min_size,), max_size
+        tensors = []
+        for crop in crops:
+            # what detecto's predict does to an image before handing it to the network
+            tensor = torch.from_numpy(np.ascontiguousarray(crop)).permute(2, 0, 1).float().div_(255)
+            tensors.append(((tensor - IMAGENET_MEAN) / IMAGENET_STD).to(self.model._device))
+        original_sizes = [tuple(tensor.shape[-2:]) for tensor in tensors]
+        network.eval()
+        with torch.no_grad():
+            # GeneralizedRCNN.forward in eval mode, with our transform in place of the model's
+            image_list, _ = transform(tensors)
+            features = network.backbone(image_list.tensors)
+            proposals, _ = network.rpn(image_list, features)
+            detections, _ = network.roi_heads(features, proposals, image_list.image_sizes)
+            detections = transform.postprocess(detections, image_list.image_sizes, original_sizes)
+        return [([self.model._classes[i] for i in d['labels'].tolist()], d['boxes'].cpu(), d['scores'].cpu()) for d in detections]
+
+    def _predict_regions(self, images) -> list:
+        """
+        Predict on the regions of interest at the inference scale and map the boxes back to full frame coordinates
+        """
+        # crops of the same shape (from frames of the same size) share a predict call
+        groups = {}
+        for i, image in enumerate(images):
+            for x0, y0, crop in self._crops(image):
+                groups.setdefault((crop.shape, image.shape[:2]), []).append((i, x0, y0, crop))
+        merged = [([], [], []) for _ in images]
+        for (shape, frame_shape), group in groups.items():
+            crops = [crop for _, _, _, crop in group]
+            if self.transform is None:
+                predictions = self.model.predict(crops)
+            else:
+                # resize each crop by the same factor its full frame would have been, times the scale;
+                # the transform maps the boxes back to crop coordinates
+                min_size, max_size = self.transform.min_size[-1], self.transform.max_size
+                factor = min(min_size / min(frame_shape), max_size / max(frame_shape)) * self.scale
+                predictions = self._predict_resized(crops, max(1, round(min(shape[:2]) * factor)), max(1, round(max(shape[:2]) * factor)))
+            for (i, x0, y0, _), (labels, boxes, scores) in zip(group, predictions):
+                merged[i][0].extend(labels)
+                merged[i][1].append(torch.as_tensor(boxes, dtype=torch.float32).reshape(-1, 4) + torch.tensor([x0, y0, x0, y0], dtype=torch.float32))
+                merged[i][2].append(torch.as_tensor(scores, dtype=torch.float32).reshape(-1))
+        return [(labels, torch.cat(boxes) if boxes else torch.zeros((0, 4)), torch.cat(scores) if scores else torch.zeros(0))
+                for labels, boxes, scores in merged]
+
+    def postprocess(self, predictions) -> list:
+        """
+        Filter a batch of raw predictions
+        """
+        return self.postprocessor(predictions)
+
+    def detect(self, images) -> list:
+        """
+        Run the model on a batch of images and filter the predictions
+        Args:
+            images: list of HxWxC BGR uint8 arrays (as read by cv2)
+        Returns:
+            list of filtered (labels, boxes, scores) tuples, one per image
+        """
+        return self.postprocess(self.predict_raw(images))
+
+def load_detector(model_path=DEFAULT_MODEL, labels_file=DEFAULT_LABELS_FILE, iou_threshold=0.4, thresholds_file=None,
+                  top_k=None, class_agnostic=False, torch_threads=None, regions=None, scale=1.0, engine='detecto') -> Detector:
+    """
+    Load the model from disk
+    Args:
+        model_path: path to the .pth weights (or the exported .pt for the torchscript engine)
+        labels_file: path to the labels csv the model was trained with
+        iou_threshold: IoU threshold for non-maximum suppression
+        thresholds_file: optional csv of per-unit score thresholds
+        top_k: keep at most this many boxes per image
+        class_agnostic: suppress overlapping boxes regardless of unit
+        torch_threads: number of threads torch uses for inference
+        regions: optional list of (xmin, ymin, xmax, ymax) regions (fractions of the frame) from parse_regions to detect in
+        scale: inference resolution relative to the model's normal full frame resolution
+        engine: 'detecto' to load the weights with detecto, 'torchscript' for a model from export_model.py
+    Returns:
+        the Detector
+    """
+    model_path, labels_file = Path(model_path), Path(labels_file)
+    # raise an error if the model file doesn't exist
+    if not model_path.exists():
+        raise Exception("Model file not found!" + str(model_path))
+    # raise an error if the label file doesn't exist
+    if not labels_file.exists():
+        raise Exception("Label file not found!" + str(labels_file))
+    if torch_threads:
+        torch.set_num_threads(torch_threads)
+    classes = list(get_labels(labels_file).values())
+    thresholds = load_thresholds(thresholds_file) if thresholds_file else None
+    postprocessor = PostProcessor(classes, iou_threshold=iou_threshold, thresholds=thresholds, top_k=top_k, class_agnostic=class_agnostic)
+    if engine == 'torchscript':
+        # the exported model's resize is compiled in, so it can only run full frames at its own resolution
+        if regions or scale != 1:
+            raise ValueError('--roi and --scale need the detecto engine; the torchscript model always runs full frames at its exported resolution')
+        model = ExportedModel(model_path)
+        if model._classes[1:] != classes:
+            raise ValueError(f'{model_path} was exported with different labels than {labels_file}')
+    elif engine == 'detecto':
+        import detecto.core
+        model = detecto.core.Model.load(model_path, classes)
+    else:
+        raise ValueError(f'Unknown engine {engine}. Choose from {", ".join(ENGINES)}.')
+    fingerprint = model_fingerprint(model_path, labels_file)
+    if regions or scale != 1:
+        # cropped or rescaled predictions differ from full frame ones, so they're cached separately
+        fingerprint = hash_bytes(f'{fingerprint}:{regions}:{scale}'.encode())
+    return Detector(model, classes, postprocessor, fingerprint, regions, scale)
+
+def add_detector_arguments(parser):
+    """
+    Add the model and post-processing options to an argument parser
+    """
+    # optional argument to specify the path to the model to use; defaults to ../models/set6_best_model.pth
+    # (../models/set6_best_model.pt for the torchscript engine) if not specified
+    parser.add_argument('-m', '--model', help='Path to the model to use.')
+    # run the detecto weights or a model exported (and optionally quantized) by export_model.py
+    parser.add_argument('--engine', choices=ENGINES, default='detecto', help='Inference engine to use.')
+    # optional argument to specify the path to the label file to use; defaults to ../models/set6_labels.csv if not specified
+    parser.add_argument('-f', '--labels_file', help='Path to the label file to use.')
+    # number of threads torch uses for inference; defaults to torch's own choice
+    parser.add_argument('-t', '--torch-threads', type=int, help='Number of threads torch uses for inference.')
+    # iou above which overlapping boxes of the same unit are suppressed
+    parser.add_argument('--iou-threshold', type=float, default=0.4, help='IoU threshold for non-maximum suppression.')
+    # optional csv of per-unit score thresholds (unit_abbreviation, threshold); a `default` line applies to the rest
+    parser.add_argument('-s', '--thresholds', help='Path to a csv of per-unit score thresholds.')
+    # optional maximum number of boxes per image
+    parser.add_argument('-k', '--top-k', type=int, help='Keep at most this many boxes per image.')
+    # suppress overlapping boxes even if they are different units (the old behaviour)
+    parser.add_argument('--class-agnostic', action='store_true', help='Suppress overlapping boxes regardless of unit.')
+    # only detect inside these parts of the frame (board, bench, shop or xmin:ymin:xmax:ymax in 1920x1080 coordinates)
+    parser.add_argument('--roi', nargs='+', help='Regions of the frame to detect in (board, bench, shop or xmin:ymin:xmax:ymax).')
+    # run the model at a fraction of its usual resolution; smaller is faster but misses small units
+    parser.add_argument('--scale', type=float, default=1.0, help='Inference resolution relative to the default.')
+
+def detector_from_args(args) -> Detector:
+    """
+    Load the detector described by the options from add_detector_arguments
+    """
+    default_model = DEFAULT_EXPORTED_MODEL if args.engine == 'torchscript' else DEFAULT_MODEL
+    return load_detector(
+        Path(args.model) if args.model else default_model,
+        Path(args.labels_file) if args.labels_file else DEFAULT_LABELS_FILE,
+        iou_threshold=args.iou_threshold, thresholds_file=args.thresholds, top_k=args.top_k,
+        class_agnostic=args.class_agnostic, torch_threads=args.torch_threads,
+        regions=parse_regions(args.roi) if args.roi else None, scale=args.scale, engine=args.engine)
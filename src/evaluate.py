@@ -0,0 +1,138 @@
+# measures how well the detector does on labelled clean_data images
+# the images go through the same path auto_label.py uses (threaded decoding, batched predictions, the inference
+# cache and the detector's post-processing), so the numbers describe the labels auto_label.py would write. reports
+# per-unit AP, precision and recall, mAP and the most common confusions, and optionally writes them all (with
+# the full confusion matrix) to a json file so runs with different engines, scales or thresholds can be compared.
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+from annotations import read_annotation
+from auto_label import _batched, _bounded_map, load_image, predict_batch
+from detection_server import RemoteDetector
+from detector import add_detector_arguments, detector_from_args
+from export_model import held_out_slice
+from inference_cache import InferenceCache
+from metrics import DetectionEvaluator
+from profiling import PROFILER, add_profile_argument
+
+def evaluate(detector, pairs, iou_threshold=0.5, confusion_threshold=0.0, cache=None, workers=4, batch_size=4, report_every=500) -> tuple:
+    """
+    Run the detector over labelled images and score its post-processed detections
+    Args:
+        detector: the Detector to evaluate
+        pairs: list of (image path, label path) pairs
+        iou_threshold: minimum IoU for a detection to count as a true positive
+        confusion_threshold: minimum score for a detection to be counted in the confusion matrix
+        cache: optional InferenceCache of raw predictions
+        workers: number of decoding threads
+        batch_size: number of images per predict call
+        report_every: print progress every this many images (0 to disable)
+    Returns:
+        tuple of (DetectionEvaluator, seconds per image)
+    """
+    evaluator = DetectionEvaluator(detector.classes, iou_threshold, confusion_threshold)
+    label_paths = dict(pairs)
+    done = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as decoders:
+        decoded = _bounded_map(decoders, lambda p: load_image(p, cache), label_paths, window=max(2*batch_size, workers))
+        for batch in _batched(decoded, batch_size):
+            results = predict_batch(detector, batch, cache)
+            with PROFILER.stage('nms', len(results)):
+                filtered = detector.postprocess([r[2:] for r in results])
+            with PROFILER.stage('metrics', len(results)):
+                for (image_path, *_), (labels, boxes, scores) in zip(results, filtered):
+                    annotation = read_annotation(label_paths[image_path])
+                    gt_boxes = np.frombuffer(annotation.boxes, dtype=np.int32).reshape(-1, 4)
+                    evaluator.add(labels, np.asarray(boxes), np.asarray(scores), annotation.names, gt_boxes)
+            done += len(results)
+            if report_every and results and done % report_every < len(results):
+                print(f'[INFO] evaluated {done}/{len(pairs)} images')
+    return evaluator, (time.perf_counter() - start) / max(1, done)
+
+def report(evaluator, score_threshold=0.0) -> dict:
+    """
+    Collect the metrics of an evaluation
+    Returns:
+        json-serializable dictionary of the mAP, per-unit metrics and confusion matrix
+    """
+    aps = evaluator.average_precisions()
+    per_class = evaluator.precision_recall(score_threshold)
+    for c, metrics in per_class.items():
+        metrics['ap'] = aps[c]
+    # json has no nan
+    clean = lambda v: None if isinstance(v, float) and np.isnan(v) else v
+    return {
+        'images': evaluator.images,
+        'iou_threshold': evaluator.iou_threshold,
+        'score_threshold': score_threshold,
+        'map': clean(evaluator.mean_ap()),
+        'classes': {c: {k: clean(v) for k, v in metrics.items()} for c, metrics in per_class.items()},
+        'confusion': {'labels': evaluator.classes + ['background'], 'matrix': evaluator.confusion.tolist()},
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Evaluate the detector on labelled clean_data images.')
+    # optional argument to specify the clean_data folders; default to ../clean_data/images and ../clean_data/labels
+    parser.add_argument('-i', '--images', help='Folder containing the images.')
+    parser.add_argument('-l', '--labels', help='Folder containing the label files.')
+    # the split: the images train.py held out for validation (the last --val images, at most a fifth of clean_data)
+    parser.add_argument('--val', type=int, default=200, help='The --val the model was trained with; its held-out images are evaluated.')
+    parser.add_argument('-a', '--all', action='store_true', help='Evaluate every labelled image.')
+    # model and post-processing options (-m model, -f label file, thresholds, nms, engine, roi, scale)
+    add_detector_arguments(parser)
+    parser.add_argument('--server', help='URL of a running detection server to use instead of loading the model.')
+    parser.add_argument('--iou', type=float, default=0.5, help='Minimum IoU for a detection to count as correct.')
+    # detections scoring below this are left out of precision/recall and the confusion matrix (AP uses all of them)
+    parser.add_argument('--score-threshold', type=float, default=0.0, help='Minimum score for precision/recall and the confusion matrix.')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='Number of image decoding threads.')
+    parser.add_argument('-b', '--batch-size', type=int, default=4, help='Number of images per predict call.')
+    parser.add_argument('-c', '--cache', help='Path to the inference cache file.')
+    parser.add_argument('--no-cache', action='store_true', help='Do not read or write the inference cache.')
+    # optional json report with every metric and the full confusion matrix
+    parser.add_argument('-o', '--output', help='Path to write the json report to.')
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    PROFILER.start(args.profile)
+    here = Path(__file__).parent
+    images_folder = Path(args.images) if args.images else here/'../clean_data/images'
+    labels_folder = Path(args.labels) if args.labels else here/'../clean_data/labels'
+    pairs = held_out_slice(images_folder, labels_folder, None if args.all else args.val)
+    if not pairs:
+        raise Exception(f'No held-out images in {labels_folder} (train.py holds out at most a fifth of the dataset; -a evaluates every image)')
+    with PROFILER.stage('load_model'):
+        if args.server:
+            detector = RemoteDetector.from_args(args.server, args)
+        else:
+            detector = detector_from_args(args)
+    cache = None
+    if not args.no_cache:
+        cache_path = Path(args.cache) if args.cache else here/'../cache/inference_cache.sqlite'
+        cache = InferenceCache(cache_path, detector.fingerprint)
+    try:
+        evaluator, seconds = evaluate(detector, pairs, args.iou, args.score_threshold, cache, args.workers, args.batch_size)
+    finally:
+        if cache is not None:
+            cache.close()
+        PROFILER.finish()
+    results = report(evaluator, args.score_threshold)
+    results['seconds_per_image'] = seconds
+    print(f'{"unit":8} {"AP":>6} {"prec":>6} {"recall":>6} {"tp":>6} {"fp":>6} {"gt":>6}')
+    fmt = lambda v: f'{v:6.3f}' if v is not None else f'{"-":>6}'
+    for c, m in results['classes'].items():
+        if m['ground_truth'] or m['false_positives']:
+            print(f'{c:8} {fmt(m["ap"])} {fmt(m["precision"])} {fmt(m["recall"])} {m["true_positives"]:6} {m["false_positives"]:6} {m["ground_truth"]:6}')
+    print(f'mAP@{args.iou} {fmt(results["map"]).strip()} over {evaluator.images} images ({seconds*1000:.1f}ms/image)')
+    confusions = evaluator.confusions()
+    if confusions:
+        print('Most common confusions (labelled -> detected):')
+        for labelled, detected, count in confusions:
+            print(f'  {labelled:>10} -> {detected:10} {count}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Wrote the report to {args.output}')
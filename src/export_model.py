@@ -0,0 +1,124 @@
+# exports the trained model to a torchscript file for the `--engine torchscript` inference backend
+# the linear layers of the box head can be dynamically quantized to int8; an accuracy check on the last
+# images of clean_data reports the mAP and speed of the exported model next to the fp32 detecto model
+import argparse
+import json
+import time
+from pathlib import Path
+import cv2
+import numpy as np
+import torch
+from annotations import read_annotation
+from detector import DEFAULT_EXPORTED_MODEL, DEFAULT_LABELS_FILE, DEFAULT_MODEL, get_labels, load_detector
+from metrics import DetectionEvaluator
+from shards import held_out_count
+
+def export_model(model_path, labels_file, output_path, quantize=False) -> Path:
+    """
+    Export a detecto model to torchscript
+    Args:
+        model_path: path to the .pth weights
+        labels_file: path to the labels csv the model was trained with
+        output_path: the .pt file to write
+        quantize: dynamically quantize the linear layers to int8
+    Returns:
+        the output path
+    """
+    import detecto.core
+    classes = list(get_labels(labels_file).values())
+    model = detecto.core.Model.load(model_path, classes)
+    internal = model.get_internal_model()
+    internal.eval()
+    if quantize:
+        # only the fully connected layers (box head and predictor) support dynamic quantization;
+        # the convolutional backbone stays fp32
+        internal = torch.ao.quantization.quantize_dynamic(internal, {torch.nn.Linear}, dtype=torch.qint8)
+    scripted = torch.jit.script(internal)
+    meta = {'classes': model._classes, 'normalize': not model._disable_normalize, 'quantized': quantize}
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    torch.jit.save(scripted, str(output_path), _extra_files={'detector.json': json.dumps(meta)})
+    return output_path
+
+def held_out_slice(images_folder, labels_folder, val=200) -> list:
+    """
+    Get the labelled images of clean_data that train.py holds out for validation (with its --val)
+    Args:
+        images_folder: the clean_data images folder
+        labels_folder: the clean_data labels folder
+        val: train.py's --val; None for every labelled image
+    Returns:
+        list of (image path, label path) pairs, oldest first
+    """
+    stems = sorted(int(p.stem) for p in Path(labels_folder).glob('*.xml') if p.stem.isdigit() and (Path(images_folder)/f'{p.stem}.png').exists())
+    if val is not None:
+        # the most recently committed images, the same rule train.py splits by
+        stems = stems[len(stems) - held_out_count(len(stems), val):]
+    return [(Path(images_folder)/f'{stem}.png', Path(labels_folder)/f'{stem}.xml') for stem in stems]
+
+def evaluate_detector(detector, pairs, iou_threshold=0.5, batch_size=4) -> tuple:
+    """
+    Measure the mAP and speed of a detector on labelled images
+    Args:
+        detector: the Detector to evaluate
+        pairs: list of (image path, label path) pairs
+        iou_threshold: minimum IoU for a detection to count as a true positive
+        batch_size: number of images per predict call
+    Returns:
+        tuple of (DetectionEvaluator, seconds of inference per image)
+    """
+    evaluator = DetectionEvaluator(detector.classes, iou_threshold)
+    elapsed = 0.0
+    for i in range(0, len(pairs), batch_size):
+        batch = pairs[i:i + batch_size]
+        images = [cv2.imdecode(np.fromfile(str(image_path), dtype=np.uint8), cv2.IMREAD_COLOR) for image_path, _ in batch]
+        start = time.perf_counter()
+        predictions = detector.detect(images)
+        elapsed += time.perf_counter() - start
+        for (_, label_path), (labels, boxes, scores) in zip(batch, predictions):
+            annotation = read_annotation(label_path)
+            gt_boxes = np.frombuffer(annotation.boxes, dtype=np.int32).reshape(-1, 4)
+            evaluator.add(labels, np.asarray(boxes), np.asarray(scores), annotation.names, gt_boxes)
+    return evaluator, elapsed / max(1, len(pairs))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export the model to torchscript for faster cpu inference.')
+    # optional argument to specify the path to the model to export; defaults to ../models/set6_best_model.pth if not specified
+    parser.add_argument('-m', '--model', help='Path to the model to export.')
+    # optional argument to specify the path to the label file to use; defaults to ../models/set6_labels.csv if not specified
+    parser.add_argument('-f', '--labels_file', help='Path to the label file to use.')
+    # optional argument to specify where to write the exported model; defaults to ../models/set6_best_model.pt
+    parser.add_argument('-o', '--output', help='Path to write the exported model to.')
+    # int8 weights for the box head
+    parser.add_argument('-q', '--quantize', action='store_true', help='Dynamically quantize the linear layers to int8.')
+    # train.py's --val: the accuracy check runs on the images it held out (at most a fifth of clean_data); 0 to skip the check
+    parser.add_argument('-c', '--check', type=int, default=200, help='train.py --val of the model; its held-out images are used for the accuracy check.')
+    # optional argument to specify the clean_data folders; default to ../clean_data/images and ../clean_data/labels
+    parser.add_argument('-i', '--images', help='Folder containing the clean_data images.')
+    parser.add_argument('-l', '--labels', help='Folder containing the clean_data labels.')
+    parser.add_argument('-t', '--torch-threads', type=int, help='Number of threads torch uses for inference.')
+    args = parser.parse_args()
+    here = Path(__file__).parent
+    model_path = Path(args.model) if args.model else DEFAULT_MODEL
+    labels_file = Path(args.labels_file) if args.labels_file else DEFAULT_LABELS_FILE
+    output_path = Path(args.output) if args.output else DEFAULT_EXPORTED_MODEL
+    images_folder = Path(args.images) if args.images else here/'../clean_data/images'
+    labels_folder = Path(args.labels) if args.labels else here/'../clean_data/labels'
+    if args.torch_threads:
+        torch.set_num_threads(args.torch_threads)
+    export_model(model_path, labels_file, output_path, args.quantize)
+    print(f'Exported {model_path} to {output_path}' + (' (int8 linear layers)' if args.quantize else ''))
+    if args.check:
+        pairs = held_out_slice(images_folder, labels_folder, args.check)
+        if not pairs:
+            print('No labelled clean_data images to check against')
+        else:
+            results = {}
+            for engine, path in (('detecto', model_path), ('torchscript', output_path)):
+                detector = load_detector(path, labels_file, engine=engine)
+                results[engine] = evaluate_detector(detector, pairs)
+            print(f'Accuracy check on {len(pairs)} held-out images (mAP@0.5):')
+            for engine, (evaluator, seconds) in results.items():
+                print(f'  {engine:12} mAP {evaluator.mean_ap():.4f}  {seconds*1000:.1f}ms/image')
+            (reference, reference_time), (exported, exported_time) = results['detecto'], results['torchscript']
+            print(f'  mAP change {exported.mean_ap() - reference.mean_ap():+.4f}, speedup {reference_time / exported_time:.2f}x')
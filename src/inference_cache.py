@@ -0,0 +1,233 @@
+# on-disk cache of raw model predictions
+# predictions are keyed by a hash of the png bytes and a fingerprint of the model weights + labels file,
+# so re-running auto_label with different post-processing never has to run the model again
+import hashlib
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+import numpy as np
+
+def hash_bytes(data) -> str:
+    """
+    Hash a buffer of bytes
+    Args:
+        data: bytes-like object (bytes, memoryview, uint8 array)
+    Returns:
+        hex digest of the data
+    """
+    return hashlib.blake2b(memoryview(data), digest_size=16).hexdigest()
+
+def hash_file(file_path, chunk_size=1 << 20) -> str:
+    """
+    Hash a file without reading it into memory all at once
+    Args:
+        file_path: the file to hash
+        chunk_size: number of bytes to read at a time
+    Returns:
+        hex digest of the file contents
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def model_fingerprint(model_path, labels_file) -> str:
+    """
+    Fingerprint a model by its weights and the labels it was loaded with
+    Args:
+        model_path: path to the .pth weights
+        labels_file: path to the labels csv
+    Returns:
+        hex digest identifying the model
+    """
+    return hash_bytes((hash_file(model_path) + hash_file(labels_file)).encode())
+
+class InferenceCache:
+    """
+    LRU cache of (labels, boxes, scores, image shape) stored in a single sqlite file.
+    Safe to share between threads, and between processes (e.g. the shards of an auto_label.py job).
+    Writes are buffered and flushed in short transactions, so other processes are only locked out for milliseconds.
+    """
+    def __init__(self, cache_path, fingerprint, max_bytes=1 << 30, flush_every=64, flush_interval=2.0, timeout=30.0):
+        """
+        Args:
+            cache_path: path to the sqlite file (created if missing)
+            fingerprint: model fingerprint from model_fingerprint()
+            max_bytes: evict least recently used entries once the stored predictions exceed this size
+            flush_every: write the buffered predictions after this many puts or hits
+            flush_interval: or after this many seconds
+            timeout: seconds to wait for another process's write to finish before giving up
+        """
+        cache_path = Path(cache_path)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.fingerprint = fingerprint
+        self.max_bytes = max_bytes
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        # autocommit mode; _transaction() opens the (short) write transactions explicitly
+        self._conn = sqlite3.connect(str(cache_path), timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        with self._transaction():
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS predictions ('
+                'image_hash TEXT NOT NULL, model_hash TEXT NOT NULL, '
+                'labels TEXT NOT NULL, boxes BLOB NOT NULL, scores BLOB NOT NULL, '
+                'height INTEGER NOT NULL, width INTEGER NOT NULL, depth INTEGER NOT NULL, '
+                'size INTEGER NOT NULL, last_used REAL NOT NULL, '
+                'PRIMARY KEY (image_hash, model_hash))')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)')
+            # the stored size lives in the file, so every process sharing it evicts against the same total
+            self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            self._conn.execute(
+                "INSERT OR IGNORE INTO meta VALUES ('total_bytes', (SELECT COALESCE(SUM(size), 0) FROM predictions))")
+        # image hash -> row waiting to be written
+        self._pending = {}
+        # image hash -> time of a hit waiting to be written
+        self._touched = {}
+        self._last_flush = time.monotonic()
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front (waiting up to the timeout) instead of failing halfway through
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+
+    def get(self, image_hash):
+        """
+        Look up the predictions for an image
+        Args:
+            image_hash: hash of the png bytes from hash_bytes()
+        Returns:
+            tuple of (labels, boxes, scores, shape) or None if the image has not been seen by this model
+            boxes is an Nx4 float32 array, scores an N float32 array
+        """
+        with self._lock:
+            row = self._pending.get(image_hash)
+            if row is not None:
+                row = row[2:8]
+            else:
+                row = self._conn.execute(
+                    'SELECT labels, boxes, scores, height, width, depth FROM predictions '
+                    'WHERE image_hash = ? AND model_hash = ?', (image_hash, self.fingerprint)).fetchone()
+                if row is None:
+                    return None
+                # reads don't write; the new last_used goes out with the next flush
+                self._touched[image_hash] = time.time()
+                self._maybe_flush()
+        labels, boxes, scores, height, width, depth = row
+        labels = labels.split(',') if labels else []
+        boxes = np.frombuffer(boxes, dtype=np.float32).reshape(-1, 4)
+        scores = np.frombuffer(scores, dtype=np.float32)
+        return labels, boxes, scores, (height, width, depth)
+
+    def put(self, image_hash, labels, boxes, scores, shape):
+        """
+        Store the raw predictions for an image
+        Args:
+            image_hash: hash of the png bytes from hash_bytes()
+            labels: list of predicted label strings
+            boxes: Nx4 array-like of boxes
+            scores: N array-like of scores
+            shape: (height, width, depth) of the image
+        """
+        boxes = np.ascontiguousarray(boxes, dtype=np.float32).tobytes()
+        scores = np.ascontiguousarray(scores, dtype=np.float32).tobytes()
+        labels = ','.join(labels)
+        size = len(boxes) + len(scores) + len(labels)
+        with self._lock:
+            self._pending[image_hash] = (image_hash, self.fingerprint, labels, boxes, scores, *shape[:3], size, time.time())
+            self._touched.pop(image_hash, None)
+            self._maybe_flush()
+
+    def _maybe_flush(self):
+        # must be called with the lock held
+        if len(self._pending) + len(self._touched) >= self.flush_every or time.monotonic() - self._last_flush >= self.flush_interval:
+            self._flush()
+
+    def _flush(self):
+        """
+        Write the buffered predictions and hit times in one transaction, evicting if the cache grew too big.
+        Must be called with the lock held.
+        """
+        rows = list(self._pending.values())
+        touched = [(last_used, image_hash, self.fingerprint) for image_hash, last_used in self._touched.items()]
+        self._pending.clear()
+        self._touched.clear()
+        self._last_flush = time.monotonic()
+        if not rows and not touched:
+            return
+        try:
+            with self._transaction():
+                added = 0
+                for row in rows:
+                    old = self._conn.execute(
+                        'SELECT size FROM predictions WHERE image_hash = ? AND model_hash = ?', row[:2]).fetchone()
+                    added += row[8] - (old[0] if old is not None else 0)
+                self._conn.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                self._conn.executemany(
+                    'UPDATE predictions SET last_used = ? WHERE image_hash = ? AND model_hash = ?', touched)
+                self._conn.execute("UPDATE meta SET value = value + ? WHERE key = 'total_bytes'", (added,))
+                total = self._conn.execute("SELECT value FROM meta WHERE key = 'total_bytes'").fetchone()[0]
+                if total > self.max_bytes:
+                    self._evict(total)
+        except sqlite3.OperationalError:
+            # hit times only steer eviction; losing some is better than failing a read-only run
+            if rows:
+                raise
+
+    def _evict(self, total):
+        """
+        Drop least recently used entries until the cache is back under 90% of max_bytes.
+        Must be called inside a _flush transaction.
+        Args:
+            total: the current size of the stored predictions
+        """
+        target = int(self.max_bytes * 0.9)
+        rows = self._conn.execute('SELECT rowid, size FROM predictions ORDER BY last_used')
+        doomed = []
+        for rowid, size in rows:
+            if total <= target:
+                break
+            doomed.append((rowid,))
+            total -= size
+        rows.close()
+        self._conn.executemany('DELETE FROM predictions WHERE rowid = ?', doomed)
+        self._conn.execute("UPDATE meta SET value = ? WHERE key = 'total_bytes'", (total,))
+
+    def total_bytes(self) -> int:
+        """
+        The size of the stored predictions, counting every process's flushed writes
+        """
+        with self._lock:
+            return self._conn.execute("SELECT value FROM meta WHERE key = 'total_bytes'").fetchone()[0]
+
+    def flush(self):
+        """
+        Write the buffered predictions now
+        """
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        """
+        Write outstanding predictions and close the cache file
+        """
+        with self._lock:
+            self._flush()
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
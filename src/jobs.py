@@ -0,0 +1,201 @@
+# resumable, shardable batch jobs
+# a large folder is split into N partitions by a hash of each file name, so any number of processes or
+# hosts can each take one partition without coordinating and the split doesn't change when files are added.
+# every worker appends the items it finishes to its own journal and rewrites a small progress file with its
+# rate and ETA; a restarted worker skips everything in its journal. `python jobs.py JOB_FOLDER` shows the
+# progress of every shard of a job.
+import argparse
+import hashlib
+import json
+import os
+import socket
+import time
+from pathlib import Path
+
+def parse_shard(spec) -> tuple:
+    """
+    Parse a `K/N` shard specification
+    Returns:
+        tuple of (shard index K, shard count N)
+    """
+    try:
+        k, n = [int(x) for x in spec.split('/')]
+    except ValueError:
+        raise ValueError(f'Shards are given as K/N (e.g. 0/4), not {spec}')
+    if not 0 <= k < n:
+        raise ValueError(f'Shard {k} is not in 0-{n - 1}')
+    return k, n
+
+def shard_of(name, shard_count) -> int:
+    """
+    The partition an item belongs to; depends only on its name
+    """
+    digest = hashlib.blake2b(str(name).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') % shard_count
+
+def select_shard(paths, shard, shard_count) -> list:
+    """
+    Keep the paths that belong to a shard, in their original order
+    Args:
+        paths: iterable of paths
+        shard: the shard index
+        shard_count: the number of shards
+    """
+    return [p for p in paths if shard_of(Path(p).name, shard_count) == shard]
+
+class Journal:
+    """
+    Append-only record of the items a worker has finished
+    """
+    def __init__(self, journal_path, sync_every=64, sync_interval=2.0):
+        """
+        Args:
+            journal_path: the journal file (created if missing)
+            sync_every: flush to disk after this many records
+            sync_interval: or after this many seconds
+        """
+        self.path = Path(journal_path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.done = set()
+        if self.path.exists():
+            with open(self.path, 'rb+') as f:
+                data = f.read()
+                # a line cut short by a crash has no newline; drop it so that item is redone
+                end = data.rfind(b'\n') + 1
+                if end < len(data):
+                    f.truncate(end)
+            self.done.update(data[:end].decode().split('\n')[:-1])
+        self.file = open(self.path, 'a', newline='')
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def __contains__(self, name):
+        return name in self.done
+
+    def record(self, name):
+        """
+        Mark an item finished
+        """
+        self.file.write(f'{name}\n')
+        self.done.add(name)
+        self.pending += 1
+        if self.pending >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class Progress:
+    """
+    Tracks a worker's rate and ETA and periodically writes them to a json file
+    """
+    def __init__(self, progress_path, total, done=0, interval=2.0, shard=None):
+        """
+        Args:
+            progress_path: the json file to write
+            total: number of items in the shard
+            done: items already finished by earlier runs
+            interval: minimum seconds between writes
+            shard: the `K/N` shard this worker is running
+        """
+        self.path = Path(progress_path)
+        self.total = total
+        self.resumed_from = done
+        self.done = done
+        self.interval = interval
+        self.shard = shard
+        self.start = time.time()
+        self.last_write = 0.0
+
+    def update(self, count=1):
+        self.done += count
+        if time.monotonic() - self.last_write >= self.interval:
+            self.write()
+
+    def stats(self) -> dict:
+        elapsed = time.time() - self.start
+        # the rate only counts this run, so a resumed job doesn't look faster than it is
+        rate = (self.done - self.resumed_from) / elapsed if elapsed > 0 else 0.0
+        remaining = self.total - self.done
+        return {
+            'shard': self.shard,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'done': self.done,
+            'total': self.total,
+            'rate': rate,
+            'eta_seconds': remaining / rate if rate > 0 else None,
+            'started': self.start,
+            'updated': time.time(),
+            'finished': self.done >= self.total,
+        }
+
+    def write(self):
+        self.last_write = time.monotonic()
+        tmp_path = self.path.with_name(f'{self.path.name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.stats(), f)
+        os.replace(tmp_path, self.path)
+
+def job_files(job_folder, shard, shard_count) -> tuple:
+    """
+    The journal and progress paths of one shard of a job
+    """
+    stem = Path(job_folder)/f'shard_{shard}_of_{shard_count}'
+    return stem.with_suffix('.journal'), stem.with_suffix('.progress.json')
+
+def job_status(job_folder) -> list:
+    """
+    Read the progress files of every shard of a job
+    Returns:
+        list of progress dictionaries, sorted by shard
+    """
+    status = []
+    for path in sorted(Path(job_folder).glob('shard_*.progress.json')):
+        try:
+            with open(path) as f:
+                status.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return status
+
+def _duration(seconds) -> str:
+    if seconds is None:
+        return '?'
+    seconds = int(seconds)
+    return f'{seconds // 3600}h{seconds % 3600 // 60:02d}m{seconds % 60:02d}s'
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Show the progress of a sharded job.')
+    # the folder the workers keep their journals in; defaults to ../labels/.jobs (auto_label.py's default)
+    parser.add_argument('job_folder', nargs='?', help='Folder containing the job journals.')
+    args = parser.parse_args()
+    here = Path(__file__).parent
+    job_folder = Path(args.job_folder) if args.job_folder else here/'../labels/.jobs'
+    status = job_status(job_folder)
+    if not status:
+        print(f'No jobs found in {job_folder}')
+    now = time.time()
+    for s in status:
+        state = 'finished' if s['finished'] else ('stale' if now - s['updated'] > 60 else 'running')
+        print(f'shard {s["shard"]:>6} {s["done"]:>8}/{s["total"]:<8} {s["rate"]:7.2f}/s  eta {_duration(s["eta_seconds"]):>10}  {state} ({s["host"]}:{s["pid"]})')
+    if status:
+        done, total = sum(s['done'] for s in status), sum(s['total'] for s in status)
+        running = [s for s in status if not s['finished'] and now - s['updated'] <= 60]
+        rate = sum(s['rate'] for s in running)
+        print(f'total {done}/{total} ({100 * done / total if total else 100:.1f}%), {rate:.2f} images/sec, eta {_duration((total - done) / rate if rate else None)}')
@@ -0,0 +1,464 @@
+# converts the Pascal VOC label files to and from compact formats
+#   coco     one json file with images, annotations and categories (category id = class position + 1, like detecto)
+#   yolo     one txt file per image of `class cx cy w h` (class id = class position, coordinates normalized)
+#   parquet  one table with a row per image and list columns of names, class ids, boxes and the other object fields (needs pyarrow)
+#   arrow    the same table as an Arrow IPC file, which can be memory-mapped
+# class ids come from set6_classes.csv. every conversion streams one label file (or one batch of rows) at a
+# time, so converting 100k images never holds more than the per-image sizes in memory.
+import argparse
+import json
+import os
+import shutil
+from pathlib import Path
+from PIL import Image
+from annotations import Annotation, location_of, read_annotation, write_annotation
+from dataset_index import get_classes
+
+FORMATS = ['coco', 'yolo', 'parquet', 'arrow']
+# images per parquet row group / arrow record batch
+BATCH_SIZE = 4096
+
+def iter_labels(labels_folder):
+    """
+    Stream the label files of a folder in stem order
+    Yields:
+        tuples of (stem, Annotation)
+    """
+    names = [entry.name for entry in os.scandir(labels_folder) if entry.name.endswith('.xml')]
+    # numeric stems (clean_data) sort numerically, anything else by name
+    names.sort(key=lambda name: (0, int(name[:-4]), '') if name[:-4].isdigit() else (1, 0, name))
+    for name in names:
+        yield name[:-4], read_annotation(Path(labels_folder)/name)
+
+def _image_size(image_path) -> tuple:
+    # only reads the png header
+    with Image.open(image_path) as im:
+        return im.size
+
+def _new_annotation(images_folder, file_name, width, height) -> Annotation:
+    annotation = Annotation(width=width, height=height, depth=3)
+    annotation.folder, annotation.filename, annotation.path = location_of(Path(images_folder)/file_name)
+    return annotation
+
+def _write_label(labels_folder, file_name, annotation):
+    write_annotation(Path(labels_folder)/f'{Path(file_name).stem}.xml', annotation, atomic=True)
+
+def _tmp_path(path) -> Path:
+    return Path(path).with_name(f'{Path(path).name}.tmp')
+
+def _write_text(path, text):
+    # renamed into place like the label files, so an interrupted export never leaves a truncated file
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def export_coco(labels_folder, classes, output_path) -> tuple:
+    """
+    Write every label file of a folder to one COCO json file
+    The annotations are spooled to a temporary file while the images are written, so memory doesn't grow with the dataset.
+    Args:
+        labels_folder: folder containing the .xml label files
+        classes: list of unit abbreviations
+        output_path: the .json file to write
+    Returns:
+        tuple of (images, objects, objects skipped because their unit isn't in classes)
+    """
+    class_ids = {c: i for i, c in enumerate(classes)}
+    tmp_path, spool_path = _tmp_path(output_path), Path(output_path).with_name(f'{Path(output_path).name}.annotations.tmp')
+    n_images = n_objects = skipped = 0
+    try:
+        with open(tmp_path, 'w') as f, open(spool_path, 'w+') as spool:
+            categories = ',\n'.join(json.dumps({'id': i + 1, 'name': c, 'supercategory': 'unit'}) for i, c in enumerate(classes))
+            f.write(f'{{\n"info": {{"description": "TFT-Detector labels"}},\n"categories": [\n{categories}\n],\n"images": [\n')
+            for image_id, (stem, annotation) in enumerate(iter_labels(labels_folder), 1):
+                # one image or annotation per line keeps the file greppable and diffable
+                f.write(('' if image_id == 1 else ',\n') + json.dumps({'id': image_id, 'file_name': f'{stem}.png', 'width': annotation.width, 'height': annotation.height}))
+                n_images += 1
+                for name, (xmin, ymin, xmax, ymax) in annotation.objects():
+                    if name not in class_ids:
+                        skipped += 1
+                        continue
+                    n_objects += 1
+                    spool.write(('' if n_objects == 1 else ',\n') + json.dumps({
+                        'id': n_objects, 'image_id': image_id, 'category_id': class_ids[name] + 1,
+                        'bbox': [xmin, ymin, xmax - xmin, ymax - ymin], 'area': (xmax - xmin) * (ymax - ymin), 'iscrowd': 0}))
+            f.write('\n],\n"annotations": [\n')
+            spool.seek(0)
+            shutil.copyfileobj(spool, f)
+            f.write('\n]\n}\n')
+        os.replace(tmp_path, output_path)
+    finally:
+        spool_path.unlink(missing_ok=True)
+        tmp_path.unlink(missing_ok=True)
+    return n_images, n_objects, skipped
+
+def iter_json(f, chunk_size=1 << 20):
+    """
+    Incrementally parse a json object, yielding the elements of its top level arrays one at a time
+    Args:
+        f: text file positioned at the start of the object
+        chunk_size: characters read at a time
+    Yields:
+        tuples of (key, value) for top level scalars and objects, (key, element) for every element of a top level array
+    """
+    decoder = json.JSONDecoder()
+    buf, pos, eof = '', 0, False
+
+    def fill():
+        nonlocal buf, pos, eof
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buf, pos = buf[pos:] + chunk, 0
+        return not eof
+
+    def peek():
+        # the next non-whitespace character
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buf) or not fill():
+                return buf[pos] if pos < len(buf) else ''
+
+    def value():
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                v, end = decoder.raw_decode(buf, pos)
+                # a number at the end of the buffer might continue in the next chunk
+                if end < len(buf) or eof:
+                    pos = end
+                    return v
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            fill()
+
+    def expect(char):
+        nonlocal pos
+        if peek() != char:
+            raise ValueError(f'Expected {char!r} at {f.name if hasattr(f, "name") else "input"}')
+        pos += 1
+
+    expect('{')
+    if peek() == '}':
+        return
+    while True:
+        key = value()
+        expect(':')
+        if peek() == '[':
+            pos += 1
+            if peek() == ']':
+                pos += 1
+            else:
+                while True:
+                    yield key, value()
+                    if peek() == ',':
+                        pos += 1
+                    else:
+                        expect(']')
+                        break
+        else:
+            yield key, value()
+        if peek() == ',':
+            pos += 1
+        else:
+            expect('}')
+            return
+
+def import_coco(coco_path, labels_folder, images_folder) -> tuple:
+    """
+    Write a label file for every image of a COCO json file
+    Annotations are expected to be grouped by image (as export_coco writes them); an image whose annotations are
+    split up still converts correctly, it's just read back and extended. Annotations of images or categories the
+    file doesn't list (which some tools write) are skipped.
+    Args:
+        coco_path: the .json file to read
+        labels_folder: folder to write the .xml label files to
+        images_folder: folder the images are in (for the folder/filename/path fields)
+    Returns:
+        tuple of (images, objects, objects skipped)
+    """
+    Path(labels_folder).mkdir(parents=True, exist_ok=True)
+    categories, images, written = {}, {}, set()
+    pending, n_objects, skipped = {}, 0, 0
+
+    def flush(image_id):
+        nonlocal n_objects, skipped
+        file_name, width, height = images[image_id]
+        boxes = pending.pop(image_id, [])
+        if image_id in written:
+            annotation = read_annotation(Path(labels_folder)/f'{Path(file_name).stem}.xml')
+        else:
+            annotation = _new_annotation(images_folder, file_name, width, height)
+        for category_id, box in boxes:
+            if category_id not in categories:
+                skipped += 1
+                continue
+            annotation.add(categories[category_id], box)
+            n_objects += 1
+        _write_label(labels_folder, file_name, annotation)
+        written.add(image_id)
+
+    current = None
+    with open(coco_path) as f:
+        for key, item in iter_json(f):
+            if key == 'categories':
+                categories[item['id']] = item['name']
+            elif key == 'images':
+                images[item['id']] = (item['file_name'], item.get('width', 0), item.get('height', 0))
+            elif key == 'annotations':
+                image_id = item['image_id']
+                # the previous image is complete once its annotations stop
+                if current is not None and image_id != current and current in images and categories:
+                    flush(current)
+                current = image_id
+                x, y, w, h = item['bbox']
+                pending.setdefault(image_id, []).append((item['category_id'], (round(x), round(y), round(x + w), round(y + h))))
+    # annotations that came before their images, and the images without any
+    for image_id in list(pending):
+        if image_id in images:
+            flush(image_id)
+        else:
+            skipped += len(pending.pop(image_id))
+    for image_id in images:
+        if image_id not in written:
+            flush(image_id)
+    return len(images), n_objects, skipped
+
+def export_yolo(labels_folder, classes, output_folder, images_folder=None) -> tuple:
+    """
+    Write every label file of a folder as a YOLO txt file, plus the class names to classes.txt
+    Args:
+        labels_folder: folder containing the .xml label files
+        classes: list of unit abbreviations
+        output_folder: folder to write the .txt files to
+        images_folder: where to read the size of images whose label file doesn't record it
+    Returns:
+        tuple of (images, objects, objects skipped because their unit isn't in classes)
+    """
+    output_folder = Path(output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    _write_text(output_folder/'classes.txt', ''.join(f'{c}\n' for c in classes))
+    class_ids = {c: i for i, c in enumerate(classes)}
+    n_images = n_objects = skipped = 0
+    for stem, annotation in iter_labels(labels_folder):
+        width, height = annotation.width, annotation.height
+        if not (width and height):
+            width, height = _image_size(Path(images_folder)/f'{stem}.png')
+        lines = []
+        for name, (xmin, ymin, xmax, ymax) in annotation.objects():
+            if name not in class_ids:
+                skipped += 1
+                continue
+            lines.append(f'{class_ids[name]} {(xmin + xmax) / 2 / width:.6f} {(ymin + ymax) / 2 / height:.6f} {(xmax - xmin) / width:.6f} {(ymax - ymin) / height:.6f}\n')
+        _write_text(output_folder/f'{stem}.txt', ''.join(lines))
+        n_images += 1
+        n_objects += len(lines)
+    return n_images, n_objects, skipped
+
+def import_yolo(yolo_folder, labels_folder, images_folder, classes=None) -> tuple:
+    """
+    Write a label file for every YOLO txt file of a folder
+    Args:
+        yolo_folder: folder containing the .txt files (and classes.txt)
+        labels_folder: folder to write the .xml label files to
+        images_folder: folder the images are in; YOLO boxes are relative, so every image's size is read from it
+        classes: list of unit abbreviations, used if the folder has no classes.txt
+    Returns:
+        tuple of (images, objects, objects skipped because their class id is out of range)
+    """
+    yolo_folder = Path(yolo_folder)
+    Path(labels_folder).mkdir(parents=True, exist_ok=True)
+    if (yolo_folder/'classes.txt').exists():
+        with open(yolo_folder/'classes.txt') as f:
+            classes = [line.strip() for line in f if line.strip()]
+    n_images = n_objects = skipped = 0
+    for entry in os.scandir(yolo_folder):
+        if not entry.name.endswith('.txt') or entry.name == 'classes.txt':
+            continue
+        file_name = f'{entry.name[:-4]}.png'
+        width, height = _image_size(Path(images_folder)/file_name)
+        annotation = _new_annotation(images_folder, file_name, width, height)
+        with open(entry.path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                class_id, cx, cy, w, h = line.split()
+                if not 0 <= int(class_id) < len(classes):
+                    skipped += 1
+                    continue
+                cx, cy, w, h = float(cx) * width, float(cy) * height, float(w) * width, float(h) * height
+                annotation.add(classes[int(class_id)], (round(cx - w / 2), round(cy - h / 2), round(cx + w / 2), round(cy + h / 2)))
+        _write_label(labels_folder, file_name, annotation)
+        n_images += 1
+        n_objects += len(annotation)
+    return n_images, n_objects, skipped
+
+def export_table(labels_folder, classes, output_path, table_format='parquet', batch_size=BATCH_SIZE) -> tuple:
+    """
+    Write every label file of a folder to one Parquet or Arrow table, a row per image
+    Rows are written in batches, so only batch_size images are held in memory.
+    Args:
+        labels_folder: folder containing the .xml label files
+        classes: list of unit abbreviations
+        output_path: the .parquet or .arrow file to write
+        table_format: 'parquet' or 'arrow'
+        batch_size: images per row group / record batch
+    Returns:
+        tuple of (images, objects, objects whose unit isn't in classes)
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    class_ids = {c: i for i, c in enumerate(classes)}
+    schema = pa.schema([
+        ('stem', pa.string()),
+        ('width', pa.int32()),
+        ('height', pa.int32()),
+        ('names', pa.list_(pa.string())),
+        # position in set6_classes.csv, -1 for units that aren't in it
+        ('class_ids', pa.list_(pa.int16())),
+        # xmin, ymin, xmax, ymax of every object, back to back
+        ('boxes', pa.list_(pa.int32())),
+        # the rest of each object, so importing the table gives back the same label files
+        ('difficult', pa.list_(pa.int8())),
+        ('truncated', pa.list_(pa.int8())),
+        ('poses', pa.list_(pa.string())),
+        ('extras', pa.list_(pa.list_(pa.string()))),
+    ], metadata={'classes': json.dumps(list(classes))})
+    tmp_path = _tmp_path(output_path)
+    n_images = n_objects = unknown = 0
+    columns = {name: [] for name in schema.names}
+
+    def write_batch(writer):
+        writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+        for column in columns.values():
+            column.clear()
+
+    writer = pq.ParquetWriter(str(tmp_path), schema) if table_format == 'parquet' else pa.ipc.new_file(str(tmp_path), schema)
+    try:
+        for stem, annotation in iter_labels(labels_folder):
+            ids = [class_ids.get(name, -1) for name in annotation.names]
+            columns['stem'].append(stem)
+            columns['width'].append(annotation.width)
+            columns['height'].append(annotation.height)
+            columns['names'].append(annotation.names)
+            columns['class_ids'].append(ids)
+            columns['boxes'].append(annotation.boxes.tolist())
+            columns['difficult'].append(annotation.difficult.tolist())
+            columns['truncated'].append(annotation.truncated.tolist())
+            columns['poses'].append(annotation.poses)
+            columns['extras'].append([list(extra) for extra in annotation.extras])
+            n_images += 1
+            n_objects += len(ids)
+            unknown += ids.count(-1)
+            if len(columns['stem']) >= batch_size:
+                write_batch(writer)
+        if columns['stem'] or not n_images:
+            write_batch(writer)
+    finally:
+        writer.close()
+    os.replace(tmp_path, output_path)
+    return n_images, n_objects, unknown
+
+def iter_table(table_path, table_format='parquet', batch_size=BATCH_SIZE):
+    """
+    Stream the rows of a table written by export_table
+    Yields:
+        dictionaries with the stem, width, height, names, class_ids, boxes, difficult, truncated, poses and extras of an image
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    if table_format == 'parquet':
+        batches = pq.ParquetFile(table_path).iter_batches(batch_size=batch_size)
+    else:
+        reader = pa.ipc.open_file(pa.memory_map(str(table_path)))
+        batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+    for batch in batches:
+        yield from batch.to_pylist()
+
+def import_table(table_path, labels_folder, images_folder, table_format='parquet') -> tuple:
+    """
+    Write a label file for every row of a table written by export_table
+    Args:
+        table_path: the .parquet or .arrow file to read
+        labels_folder: folder to write the .xml label files to
+        images_folder: folder the images are in (for the folder/filename/path fields)
+        table_format: 'parquet' or 'arrow'
+    Returns:
+        tuple of (images, objects, 0); tables keep units that aren't in the classes, so nothing is skipped
+    """
+    Path(labels_folder).mkdir(parents=True, exist_ok=True)
+    n_images = n_objects = 0
+    for row in iter_table(table_path, table_format):
+        file_name = f'{row["stem"]}.png'
+        annotation = _new_annotation(images_folder, file_name, row['width'], row['height'])
+        boxes = row['boxes']
+        # tables written before the object fields were added only have names and boxes
+        n = len(row['names'])
+        difficult = row.get('difficult') or [0]*n
+        truncated = row.get('truncated') or [0]*n
+        poses = row.get('poses') or ['Unspecified']*n
+        extras = row.get('extras') or [()]*n
+        for i, name in enumerate(row['names']):
+            annotation.add(name, boxes[4*i:4*i + 4], difficult[i], truncated[i], poses[i], extras[i])
+        _write_label(labels_folder, file_name, annotation)
+        n_images += 1
+        n_objects += len(annotation)
+    return n_images, n_objects, 0
+
+def export_labels(labels_folder, classes, output, label_format, images_folder=None) -> tuple:
+    """
+    Export a labels folder to one of FORMATS
+    Returns:
+        tuple of (images, objects, objects whose unit isn't in classes)
+    """
+    if label_format == 'coco':
+        return export_coco(labels_folder, classes, output)
+    if label_format == 'yolo':
+        return export_yolo(labels_folder, classes, output, images_folder)
+    return export_table(labels_folder, classes, output, label_format)
+
+def import_labels(source, labels_folder, images_folder, label_format, classes=None) -> tuple:
+    """
+    Import one of FORMATS back into a folder of label files
+    Returns:
+        tuple of (images, objects, objects skipped)
+    """
+    if label_format == 'coco':
+        return import_coco(source, labels_folder, images_folder)
+    if label_format == 'yolo':
+        return import_yolo(source, labels_folder, images_folder, classes)
+    return import_table(source, labels_folder, images_folder, label_format)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert the label files to and from COCO, YOLO, Parquet or Arrow.')
+    parser.add_argument('format', choices=FORMATS, help='The format to convert to (or from, with --import).')
+    # convert the other way: read OUTPUT in the given format and write .xml label files to the labels folder
+    parser.add_argument('--import', dest='import_', action='store_true', help='Import the output back into label files.')
+    # optional argument to specify the label and image folders; default to ../clean_data/labels and ../clean_data/images
+    parser.add_argument('-l', '--labels', help='Folder containing the label files.')
+    parser.add_argument('-i', '--images', help='Folder containing the images.')
+    # optional argument to specify the classes csv; defaults to ../clean_data/static/set6_classes.csv
+    parser.add_argument('-f', '--classes', help='Path to the classes csv.')
+    # the file (coco, parquet, arrow) or folder (yolo) to write; defaults to ../clean_data/labels.FORMAT
+    parser.add_argument('-o', '--output', help='File or folder to write to (read from, with --import).')
+    args = parser.parse_args()
+    here = Path(__file__).parent
+    labels_folder = Path(args.labels) if args.labels else here/'../clean_data/labels'
+    images_folder = Path(args.images) if args.images else here/'../clean_data/images'
+    classes = get_classes(Path(args.classes) if args.classes else here/'../clean_data/static/set6_classes.csv')
+    default_output = {'coco': 'labels.coco.json', 'yolo': 'labels_yolo', 'parquet': 'labels.parquet', 'arrow': 'labels.arrow'}
+    output = Path(args.output) if args.output else here/'../clean_data'/default_output[args.format]
+    if args.import_:
+        n_images, n_objects, skipped = import_labels(output, labels_folder, images_folder, args.format, classes)
+        print(f'Imported {n_images} images ({n_objects} units) from {output} into {labels_folder}')
+        if skipped:
+            print(f'[WARNING] {skipped} units belong to no listed image or class and were skipped')
+    else:
+        n_images, n_objects, skipped = export_labels(labels_folder, classes, output, args.format, images_folder)
+        print(f'Exported {n_images} images ({n_objects} units) to {output}')
+        if skipped:
+            print(f'[WARNING] {skipped} units are not in the classes csv' + (' (kept with class id -1)' if args.format in ('parquet', 'arrow') else ' and were skipped'))
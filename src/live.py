@@ -0,0 +1,131 @@
+# live board detection
+# runs the detector on a live game (or a video / screenshot folder standing in for one) and prints the board
+# state of every processed frame. capture runs on its own thread and only the newest frame is ever detected,
+# so when inference is slower than the game the stale frames are skipped instead of piling up.
+import argparse
+import json
+import sys
+import time
+import numpy as np
+from capture import BACKENDS, LiveCapture, default_backend_name, get_backend
+from detection_server import RemoteDetector
+from detector import add_detector_arguments, detector_from_args
+
+def board_state(labels, boxes) -> dict:
+    """
+    Group the detected units by abbreviation
+    Args:
+        labels: list of unit abbreviations, one per box
+        boxes: Nx4 boxes (xmin, ymin, xmax, ymax)
+    Returns:
+        dictionary of {unit_abbreviation: [[x, y], ...]} box centres, left to right
+    """
+    state = {}
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    centres = np.rint((boxes[:, :2] + boxes[:, 2:]) / 2).astype(int).tolist()
+    for label, centre in sorted(zip(labels, centres), key=lambda x: (x[0], x[1])):
+        state.setdefault(label, []).append(centre)
+    return state
+
+class LatencyStats:
+    """
+    Collects end-to-end frame latencies
+    """
+    def __init__(self, budget=None):
+        """
+        Args:
+            budget: optional latency budget in seconds; frames over it are counted
+        """
+        self.latencies = []
+        self.budget = budget
+        self.over_budget = 0
+
+    def add(self, latency):
+        self.latencies.append(latency)
+        if self.budget is not None and latency > self.budget:
+            self.over_budget += 1
+
+    def percentile(self, q) -> float:
+        """
+        Get a latency percentile in seconds (0 if nothing was recorded)
+        """
+        return float(np.percentile(self.latencies, q)) if self.latencies else 0.0
+
+    def __len__(self):
+        return len(self.latencies)
+
+def run_live(capture, detector, on_frame, stats, max_frames=None) -> int:
+    """
+    Detect the newest captured frame until the source runs out
+    Args:
+        capture: a started LiveCapture
+        detector: Detector or RemoteDetector to predict with
+        on_frame: called with (frame number, latency in seconds, board state) for every processed frame
+        stats: LatencyStats to record into
+        max_frames: stop after this many processed frames
+    Returns:
+        the number of processed frames
+    """
+    processed = 0
+    while max_frames is None or processed < max_frames:
+        item = capture.latest()
+        if item is None:
+            break
+        captured_at, im = item
+        # the model expects BGR arrays, as read by cv2 (train.py trains on BGR too)
+        frame = np.ascontiguousarray(np.asarray(im.convert('RGB'))[:, :, ::-1])
+        labels, boxes, _ = detector.detect([frame])[0]
+        state = board_state(labels, boxes)
+        latency = time.perf_counter() - captured_at
+        stats.add(latency)
+        on_frame(processed, latency, state)
+        processed += 1
+    return processed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Detect the units on a live TFT board.')
+    # model and post-processing options (-m model, -f label file, thresholds, nms)
+    add_detector_arguments(parser)
+    # use a running detection_server.py instead of loading the model
+    parser.add_argument('--server', help='URL of a running detection server to use instead of loading the model.')
+    # where frames come from; defaults to the game window on windows and the X display elsewhere
+    parser.add_argument('-b', '--backend', choices=list(BACKENDS), default=default_backend_name(), help='Capture backend to use.')
+    # the video file or image folder for the offline backends (or the display for x11)
+    parser.add_argument('--source', help='Video file, image folder or X display to capture from.')
+    parser.add_argument('--fps', type=float, default=10, help='Frames per second to capture.')
+    # end-to-end latency (capture to board state) that frames should stay under
+    parser.add_argument('--budget', type=float, default=500, help='Latency budget in milliseconds.')
+    parser.add_argument('-n', '--frames', type=int, help='Stop after this many processed frames.')
+    # board states are written as json lines; defaults to stdout
+    parser.add_argument('-o', '--output', help='File to write the board state of every frame to.')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Only print the latency summary.')
+    args = parser.parse_args()
+    if args.server:
+        detector = RemoteDetector.from_args(args.server, args)
+    else:
+        detector = detector_from_args(args)
+    # the game window only needs to be focused once
+    kwargs = {'focus_each_grab': False} if args.backend == 'win32' else {}
+    backend = get_backend(args.backend, args.source, **kwargs)
+    stats = LatencyStats(args.budget / 1000)
+    output = open(args.output, 'w') if args.output else sys.stdout
+
+    def emit(frame, latency, state):
+        if not args.quiet or args.output:
+            output.write(json.dumps({'frame': frame, 'latency_ms': round(latency * 1000, 1), 'board': state}) + '\n')
+            output.flush()
+
+    capture = LiveCapture(backend, fps=args.fps).start()
+    start = time.perf_counter()
+    try:
+        n = run_live(capture, detector, emit, stats, args.frames)
+    except KeyboardInterrupt:
+        n = len(stats)
+    finally:
+        capture.stop()
+        backend.close()
+        if args.output:
+            output.close()
+    elapsed = time.perf_counter() - start
+    print(f'{n} frames in {elapsed:.2f}s ({n/elapsed if elapsed else 0:.2f} fps), {capture.captured} captured, {capture.dropped} stale frames skipped', file=sys.stderr)
+    print(f'latency p50 {stats.percentile(50)*1000:.1f}ms, p99 {stats.percentile(99)*1000:.1f}ms, {stats.over_budget} frames over the {args.budget:.0f}ms budget', file=sys.stderr)
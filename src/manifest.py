@@ -0,0 +1,224 @@
+# bookkeeping for the clean_data folder
+# manifest.csv is an append-only record of every committed image (id, source image, commit time);
+# the next free id is one past the id on its last line, so finding it doesn't depend on the dataset size.
+# commits go through a write-ahead journal so an interrupted batch can be resumed or rolled back.
+import json
+import os
+import time
+from pathlib import Path
+from annotations import relocate
+
+def _fsync_dir(folder):
+    """
+    Flush a directory entry to disk (a no-op where directories can't be opened, e.g. windows)
+    """
+    try:
+        fd = os.open(folder, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _fsync_file(file_path):
+    with open(file_path, 'rb+') as f:
+        os.fsync(f.fileno())
+
+def _last_line(file_path, block_size=4096) -> str:
+    """
+    Read the last non-empty line of a file without reading the whole file
+    """
+    with open(file_path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        data = b''
+        while end > 0:
+            start = max(0, end - block_size)
+            f.seek(start)
+            data = f.read(end - start) + data
+            end = start
+            lines = data.strip().splitlines()
+            if len(lines) > 1 or (lines and end == 0):
+                return lines[-1].decode()
+    return ''
+
+def bootstrap_manifest(manifest_path, images_folder):
+    """
+    Create a manifest for a clean_data folder that was filled before manifests existed.
+    This is the only step that has to look at every file.
+    Args:
+        manifest_path: the manifest to create
+        images_folder: the clean_data images folder
+    """
+    stems = sorted(int(entry.name[:-4]) for entry in os.scandir(images_folder) if entry.name.endswith('.png') and entry.name[:-4].isdigit())
+    now = int(time.time())
+    with open(manifest_path, 'w', newline='') as f:
+        f.write('id,source,committed\n')
+        f.writelines(f'{stem},,{now}\n' for stem in stems)
+        f.flush()
+        os.fsync(f.fileno())
+
+def next_id(manifest_path, images_folder) -> int:
+    """
+    Get the next free id in clean_data
+    Args:
+        manifest_path: the clean_data manifest (created if missing)
+        images_folder: the clean_data images folder, used to bootstrap the manifest
+    Returns:
+        the id the next committed image should get
+    """
+    manifest_path = Path(manifest_path)
+    if not manifest_path.exists():
+        bootstrap_manifest(manifest_path, images_folder)
+    last = _last_line(manifest_path).split(',')[0]
+    return int(last) + 1 if last.isdigit() else 0
+
+def append_manifest(manifest_path, entries):
+    """
+    Record committed images in the manifest
+    Args:
+        manifest_path: the clean_data manifest
+        entries: list of (id, source image path) tuples
+    """
+    now = int(time.time())
+    with open(manifest_path, 'a', newline='') as f:
+        f.writelines(f'{i},{source},{now}\n' for i, source in entries)
+        f.flush()
+        os.fsync(f.fileno())
+
+def remap_manifest(manifest_path, renames, existing):
+    """
+    Rewrite the manifest after clean_data has been renumbered
+    Args:
+        manifest_path: the clean_data manifest
+        renames: dictionary of {old id: new id}
+        existing: set of ids that were in clean_data before renumbering;
+            entries for anything else are dropped and images missing from the manifest are added
+    """
+    manifest_path = Path(manifest_path)
+    if not manifest_path.exists():
+        return
+    entries = {}
+    with open(manifest_path, newline='') as f:
+        header = f.readline()
+        for line in f:
+            i, rest = line.rstrip('\n').split(',', 1)
+            if int(i) in existing:
+                entries[int(i)] = rest
+    now = int(time.time())
+    for i in existing:
+        entries.setdefault(i, f',{now}')
+    entries = sorted((renames.get(i, i), rest) for i, rest in entries.items())
+    tmp_path = manifest_path.with_suffix('.csv.tmp')
+    with open(tmp_path, 'w', newline='') as f:
+        f.write(header)
+        f.writelines(f'{i},{rest}\n' for i, rest in entries)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, manifest_path)
+
+def journal_path(manifest_path) -> Path:
+    """
+    The write-ahead journal that belongs to a manifest
+    """
+    return Path(manifest_path).with_suffix('.journal')
+
+def load_journal(manifest_path):
+    """
+    Get the journal of an interrupted commit
+    Args:
+        manifest_path: the clean_data manifest
+    Returns:
+        the journal dictionary, or None if there is no interrupted commit
+    """
+    path = journal_path(manifest_path)
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def start_commit(manifest_path, moves) -> dict:
+    """
+    Write the journal for a batch before any file is touched
+    Args:
+        manifest_path: the clean_data manifest
+        moves: list of (id, source image, source label, destination image, destination label)
+    Returns:
+        the journal dictionary to pass to apply_commit
+    """
+    journal = {
+        'manifest': str(manifest_path),
+        'moves': [[i, str(si), str(sl), str(di), str(dl)] for i, si, sl, di, dl in moves],
+    }
+    path = journal_path(manifest_path)
+    tmp_path = path.with_suffix('.journal.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(journal, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(path.parent)
+    return journal
+
+def apply_commit(journal, verbose=False):
+    """
+    Move every file in a journal to clean_data, then flush, record the batch in the manifest and drop the journal.
+    Each step checks what is already on disk, so running it again on an interrupted journal resumes it.
+    Args:
+        journal: the journal dictionary from start_commit or load_journal
+        verbose: print each move
+    """
+    written = []
+    folders = set()
+    for i, source_image, source_label, dest_image, dest_label in journal['moves']:
+        source_image, source_label, dest_image, dest_label = map(Path, (source_image, source_label, dest_image, dest_label))
+        if source_label.exists():
+            # point the label at the image's new location and write it straight to its new name
+            relocate(source_label, dest_image, out_path=dest_label)
+            written.append(dest_label)
+        if source_image.exists():
+            source_image.replace(dest_image)
+        if not dest_label.exists() or not dest_image.exists():
+            raise FileNotFoundError(f'Commit of {source_image} to {dest_image} could not be completed')
+        if verbose:
+            print(f'{source_image} -> {dest_image}')
+        folders.update((dest_image.parent, dest_label.parent))
+    # flush the whole batch at once before the sources disappear and the manifest records it
+    for file_path in written:
+        _fsync_file(file_path)
+    for folder in folders:
+        _fsync_dir(folder)
+    for _, _, source_label, _, _ in journal['moves']:
+        Path(source_label).unlink(missing_ok=True)
+    manifest_path = journal['manifest']
+    moves = journal['moves']
+    # don't record the batch twice if we were interrupted after the manifest was written
+    if moves and next_id(manifest_path, Path(moves[0][3]).parent) <= moves[-1][0]:
+        append_manifest(manifest_path, [(i, Path(source_image).name) for i, source_image, _, _, _ in moves])
+    journal_path(manifest_path).unlink()
+
+def rollback_commit(journal, verbose=False):
+    """
+    Undo an interrupted commit, putting every file back where it came from
+    Args:
+        journal: the journal dictionary from load_journal
+        verbose: print each move
+    """
+    manifest_path = journal['manifest']
+    moves = journal['moves']
+    if moves and next_id(manifest_path, Path(moves[0][3]).parent) > moves[-1][0]:
+        raise ValueError('This batch was already recorded in the manifest; resume it instead of rolling it back.')
+    for i, source_image, source_label, dest_image, dest_label in reversed(moves):
+        source_image, source_label, dest_image, dest_label = map(Path, (source_image, source_label, dest_image, dest_label))
+        if dest_image.exists() and not source_image.exists():
+            dest_image.replace(source_image)
+        if dest_label.exists():
+            if not source_label.exists():
+                relocate(dest_label, source_image, out_path=source_label)
+            dest_label.unlink()
+        if verbose:
+            print(f'{dest_image} -> {source_image}')
+    journal_path(manifest_path).unlink()
@@ -0,0 +1,258 @@
+# detection accuracy metrics
+# pascal voc style average precision: detections are matched greedily (highest score first) to the unmatched
+# ground truth box of the same unit with the largest IoU above a threshold. matching works on one IoU matrix per
+# image for all units at once, so evaluating is cheap next to running the model.
+import numpy as np
+
+def box_iou(boxes_a, boxes_b) -> np.ndarray:
+    """
+    Compute the IoU of every pair of boxes
+    Args:
+        boxes_a: Nx4 boxes (xmin, ymin, xmax, ymax)
+        boxes_b: Mx4 boxes
+    Returns:
+        NxM array of IoUs
+    """
+    a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype=np.float64).reshape(-1, 4)
+    top_left = np.maximum(a[:, None, :2], b[None, :, :2])
+    bottom_right = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+def _greedy_match(ious, scores, iou_threshold) -> np.ndarray:
+    """
+    Greedily match detections (highest score first) to the untaken ground truth box with the largest IoU
+    Args:
+        ious: NxM IoUs; pairs that may not match (e.g. different units) should be negative
+        scores: N detection scores
+        iou_threshold: minimum IoU for a match
+    Returns:
+        array of N ground truth indices, -1 for unmatched detections
+    """
+    matches = np.full(len(scores), -1, dtype=np.int64)
+    if ious.size == 0:
+        return matches
+    order = np.argsort(-scores, kind='stable')
+    ious = ious[order]
+    best = np.argmax(ious, axis=1)
+    hit = ious[np.arange(len(order)), best] >= iou_threshold
+    # usually every detection wants a different box, and then the greedy result is just each one's best box
+    if len(np.unique(best[hit])) == hit.sum():
+        matches[order[hit]] = best[hit]
+        return matches
+    taken = np.zeros(ious.shape[1], dtype=bool)
+    for i, row in zip(order, ious):
+        candidates = np.where(taken, -1.0, row)
+        j = int(np.argmax(candidates))
+        if candidates[j] >= iou_threshold:
+            matches[i] = j
+            taken[j] = True
+    return matches
+
+def match_detections(pred_boxes, pred_scores, gt_boxes, iou_threshold=0.5) -> np.ndarray:
+    """
+    Match the detections of one unit in one image to its ground truth boxes
+    Args:
+        pred_boxes: Nx4 detected boxes
+        pred_scores: N detection scores
+        gt_boxes: Mx4 ground truth boxes
+        iou_threshold: minimum IoU for a detection to count as a true positive
+    Returns:
+        array of N ground truth indices, -1 for false positives
+    """
+    pred_scores = np.asarray(pred_scores, dtype=np.float64).reshape(-1)
+    return _greedy_match(box_iou(pred_boxes, gt_boxes), pred_scores, iou_threshold)
+
+def match_image(pred_ids, pred_boxes, pred_scores, gt_ids, gt_boxes, iou_threshold=0.5) -> np.ndarray:
+    """
+    Match the detections of every unit in one image at once
+    Args:
+        pred_ids: N class ids of the detections
+        pred_boxes: Nx4 detected boxes
+        pred_scores: N detection scores
+        gt_ids: M class ids of the ground truth boxes
+        gt_boxes: Mx4 ground truth boxes
+        iou_threshold: minimum IoU for a detection to count as a true positive
+    Returns:
+        array of N ground truth indices, -1 for false positives
+    """
+    ious = box_iou(pred_boxes, gt_boxes)
+    # a detection only matches boxes of its own unit
+    ious[np.asarray(pred_ids)[:, None] != np.asarray(gt_ids)[None, :]] = -1.0
+    return _greedy_match(ious, np.asarray(pred_scores, dtype=np.float64).reshape(-1), iou_threshold)
+
+def confusion_pairs(ious, iou_threshold=0.5) -> tuple:
+    """
+    Pair detections with ground truth boxes by IoU alone, ignoring the unit
+    Each box is used at most once, the pairs with the largest IoU first.
+    Args:
+        ious: NxM IoUs of the detections and ground truth boxes
+        iou_threshold: minimum IoU for a pair
+    Returns:
+        tuple of (detection indices, ground truth indices) of the pairs
+    """
+    pred_index, gt_index = np.nonzero(ious >= iou_threshold)
+    if len(pred_index) == 0:
+        return pred_index, gt_index
+    order = np.argsort(-ious[pred_index, gt_index], kind='stable')
+    pred_index, gt_index = pred_index[order], gt_index[order]
+    # np.unique keeps the first (largest IoU) pair of every detection, then of every box
+    _, first = np.unique(pred_index, return_index=True)
+    first.sort()
+    pred_index, gt_index = pred_index[first], gt_index[first]
+    _, first = np.unique(gt_index, return_index=True)
+    first.sort()
+    return pred_index[first], gt_index[first]
+
+def average_precision(scores, true_positives, n_ground_truth) -> float:
+    """
+    Area under the interpolated precision/recall curve
+    Args:
+        scores: detection scores
+        true_positives: boolean array, one per detection
+        n_ground_truth: number of ground truth boxes
+    Returns:
+        the average precision (nan if there is no ground truth)
+    """
+    if n_ground_truth == 0:
+        return float('nan')
+    if len(scores) == 0:
+        return 0.0
+    order = np.argsort(-np.asarray(scores), kind='stable')
+    tp = np.cumsum(np.asarray(true_positives, dtype=bool)[order])
+    fp = np.arange(1, len(tp) + 1) - tp
+    recall = tp / n_ground_truth
+    precision = tp / (tp + fp)
+    # make precision monotonically decreasing, then integrate over the recall steps
+    precision = np.maximum.accumulate(precision[::-1])[::-1]
+    recall = np.concatenate([[0.0], recall])
+    return float(np.sum((recall[1:] - recall[:-1]) * precision))
+
+class DetectionEvaluator:
+    """
+    Accumulates detections and ground truth over a dataset and computes per-unit average precision,
+    precision/recall and a confusion matrix
+    """
+    def __init__(self, classes, iou_threshold=0.5, confusion_threshold=0.0):
+        """
+        Args:
+            classes: list of unit abbreviations
+            iou_threshold: minimum IoU for a detection to count as a true positive
+            confusion_threshold: minimum score for a detection to be counted in the confusion matrix
+        """
+        self.classes = list(classes)
+        self.class_ids = {c: i for i, c in enumerate(self.classes)}
+        self.iou_threshold = iou_threshold
+        self.confusion_threshold = confusion_threshold
+        # per image arrays of the detections' class ids, scores and whether they are true positives
+        self.pred_ids = []
+        self.scores = []
+        self.true_positives = []
+        self.n_ground_truth = np.zeros(len(self.classes), dtype=np.int64)
+        # rows are the labelled unit, columns the detected unit; the last row/column is background (missed/spurious)
+        self.confusion = np.zeros((len(self.classes) + 1, len(self.classes) + 1), dtype=np.int64)
+        self.images = 0
+
+    def _ids(self, labels) -> np.ndarray:
+        return np.fromiter((self.class_ids.get(label, -1) for label in labels), dtype=np.int64)
+
+    def add(self, pred_labels, pred_boxes, pred_scores, gt_labels, gt_boxes):
+        """
+        Add the detections and ground truth of one image
+        Args:
+            pred_labels: list of detected unit abbreviations
+            pred_boxes: Nx4 detected boxes
+            pred_scores: N detection scores
+            gt_labels: list of labelled unit abbreviations
+            gt_boxes: Mx4 labelled boxes
+        """
+        pred_ids = self._ids(pred_labels)
+        pred_boxes = np.asarray(pred_boxes, dtype=np.float64).reshape(-1, 4)
+        pred_scores = np.asarray(pred_scores, dtype=np.float64).reshape(-1)
+        gt_ids = self._ids(gt_labels)
+        gt_boxes = np.asarray(gt_boxes, dtype=np.float64).reshape(-1, 4)
+        # units that aren't in the classes are ignored
+        keep, known = pred_ids >= 0, gt_ids >= 0
+        pred_ids, pred_boxes, pred_scores = pred_ids[keep], pred_boxes[keep], pred_scores[keep]
+        gt_ids, gt_boxes = gt_ids[known], gt_boxes[known]
+        self.images += 1
+        self.n_ground_truth += np.bincount(gt_ids, minlength=len(self.classes))
+        ious = box_iou(pred_boxes, gt_boxes)
+        same_unit = np.where(pred_ids[:, None] == gt_ids[None, :], ious, -1.0)
+        matches = _greedy_match(same_unit, pred_scores, self.iou_threshold)
+        self.pred_ids.append(pred_ids)
+        self.scores.append(pred_scores)
+        self.true_positives.append(matches >= 0)
+        # the confusion matrix pairs boxes regardless of unit, so a right box with the wrong unit shows up off the diagonal
+        confident = pred_scores >= self.confusion_threshold
+        confident_ids = pred_ids[confident]
+        pred_index, gt_index = confusion_pairs(ious[confident], self.iou_threshold)
+        background = len(self.classes)
+        np.add.at(self.confusion, (gt_ids[gt_index], confident_ids[pred_index]), 1)
+        missed = np.ones(len(gt_ids), dtype=bool)
+        missed[gt_index] = False
+        np.add.at(self.confusion, (gt_ids[missed], background), 1)
+        spurious = np.ones(len(confident_ids), dtype=bool)
+        spurious[pred_index] = False
+        np.add.at(self.confusion, (background, confident_ids[spurious]), 1)
+
+    def _detections(self) -> tuple:
+        # every detection so far, sorted by class and then by descending score
+        if not self.scores:
+            return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0, dtype=bool)
+        pred_ids, scores, tp = np.concatenate(self.pred_ids), np.concatenate(self.scores), np.concatenate(self.true_positives)
+        order = np.lexsort((-scores, pred_ids))
+        return pred_ids[order], scores[order], tp[order]
+
+    def average_precisions(self) -> dict:
+        """
+        Returns:
+            dictionary of {unit_abbreviation: AP}; units with no ground truth are nan
+        """
+        pred_ids, scores, tp = self._detections()
+        bounds = np.searchsorted(pred_ids, np.arange(len(self.classes) + 1))
+        return {c: average_precision(scores[bounds[i]:bounds[i + 1]], tp[bounds[i]:bounds[i + 1]], int(self.n_ground_truth[i]))
+                for i, c in enumerate(self.classes)}
+
+    def mean_ap(self) -> float:
+        """
+        Mean of the per-unit APs over the units that have ground truth
+        """
+        aps = [ap for ap in self.average_precisions().values() if not np.isnan(ap)]
+        return float(np.mean(aps)) if aps else float('nan')
+
+    def precision_recall(self, score_threshold=0.0) -> dict:
+        """
+        Precision and recall of every unit, counting the detections scoring at least score_threshold
+        Returns:
+            dictionary of {unit_abbreviation: {'precision', 'recall', 'true_positives', 'false_positives', 'ground_truth'}}
+            precision is nan for units that were never detected, recall for units with no ground truth
+        """
+        pred_ids, scores, tp = self._detections()
+        kept = scores >= score_threshold
+        n = len(self.classes)
+        true_positives = np.bincount(pred_ids[kept & tp], minlength=n)
+        detections = np.bincount(pred_ids[kept], minlength=n)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            precision = true_positives / detections
+            recall = true_positives / self.n_ground_truth
+        return {c: {'precision': float(precision[i]), 'recall': float(recall[i]), 'true_positives': int(true_positives[i]),
+                    'false_positives': int(detections[i] - true_positives[i]), 'ground_truth': int(self.n_ground_truth[i])}
+                for i, c in enumerate(self.classes)}
+
+    def confusions(self, top=10) -> list:
+        """
+        The most common off-diagonal entries of the confusion matrix
+        Returns:
+            list of (labelled unit, detected unit, count); 'background' stands for a missed or spurious box
+        """
+        names = self.classes + ['background']
+        off_diagonal = self.confusion.copy()
+        np.fill_diagonal(off_diagonal, 0)
+        flat = np.argsort(-off_diagonal, axis=None, kind='stable')[:top]
+        rows, cols = np.unravel_index(flat, off_diagonal.shape)
+        return [(names[r], names[c], int(off_diagonal[r, c])) for r, c in zip(rows, cols) if off_diagonal[r, c] > 0]
@@ -0,0 +1,89 @@
+# post-processing of raw model predictions
+# runs per-class non-maximum suppression, score thresholds and top-k as tensor ops over a whole batch of images
+import torch
+import torchvision.ops as ops
+
+def load_thresholds(thresholds_file_path) -> dict:
+    """
+    Get the per-class score thresholds from the passed in file
+    Each line is `unit_abbreviation, threshold`; a `default` line sets the threshold for unlisted units
+    Args:
+        thresholds_file_path: the filename to read from
+    Returns:
+        dictionary of thresholds {unit_abbreviation: threshold}
+    """
+    thresholds = dict()
+    with open(thresholds_file_path) as thresholds_file_handle:
+        for line in thresholds_file_handle.readlines():
+            # skip blank lines and comments
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            unit, threshold = [x.strip() for x in line.split(",")]
+            thresholds[unit] = float(threshold)
+    return thresholds
+
+class PostProcessor:
+    """
+    Filters a batch of raw (labels, boxes, scores) predictions in a single pass
+    """
+    def __init__(self, classes, iou_threshold=0.4, thresholds=None, top_k=None, class_agnostic=False):
+        """
+        Args:
+            classes: list of unit abbreviations, in the order of the labels csv
+            iou_threshold: boxes overlapping a higher scoring box of the same class by more than this are dropped
+            thresholds: optional dictionary {unit_abbreviation: minimum score}; the `default` key applies to unlisted units
+            top_k: keep at most this many boxes per image (None to keep all)
+            class_agnostic: suppress overlapping boxes regardless of class
+        """
+        self.classes = list(classes)
+        self.class_ids = {c: i for i, c in enumerate(self.classes)}
+        self.iou_threshold = iou_threshold
+        self.top_k = top_k
+        self.class_agnostic = class_agnostic
+        thresholds = thresholds or {}
+        unknown = set(thresholds) - set(self.class_ids) - {'default'}
+        if unknown:
+            raise ValueError(f'Thresholds given for unknown units: {", ".join(sorted(unknown))}')
+        default = thresholds.get('default', 0.0)
+        # threshold lookup table indexed by class id
+        self.thresholds = torch.tensor([thresholds.get(c, default) for c in self.classes], dtype=torch.float32)
+
+    def __call__(self, predictions):
+        """
+        Args:
+            predictions: list of (labels, boxes, scores) tuples, one per image
+        Returns:
+            list of filtered (labels, boxes, scores) tuples, one per image
+        """
+        n = len(predictions)
+        counts = torch.tensor([len(boxes) for _, boxes, _ in predictions], dtype=torch.long)
+        if n == 0 or int(counts.sum()) == 0:
+            return [([], torch.zeros((0, 4)), torch.zeros(0)) for _ in range(n)]
+        # flatten the batch into one set of tensors, remembering which image each box came from
+        boxes = torch.cat([torch.as_tensor(b, dtype=torch.float32).reshape(-1, 4) for _, b, _ in predictions])
+        scores = torch.cat([torch.as_tensor(s, dtype=torch.float32).reshape(-1) for _, _, s in predictions])
+        class_ids = torch.tensor([self.class_ids[label] for labels, _, _ in predictions for label in labels], dtype=torch.long)
+        image_ids = torch.repeat_interleave(torch.arange(n), counts)
+        # drop boxes under their class threshold before suppression
+        keep = torch.nonzero(scores >= self.thresholds[class_ids]).squeeze(1)
+        # boxes only suppress each other within the same image (and class, unless class agnostic)
+        groups = image_ids[keep] if self.class_agnostic else image_ids[keep]*len(self.classes) + class_ids[keep]
+        keep = keep[ops.batched_nms(boxes[keep], scores[keep], groups, self.iou_threshold)]
+        # batched_nms returns boxes by decreasing score; a stable sort by image keeps that order within each image
+        keep = keep[torch.sort(image_ids[keep], stable=True).indices]
+        kept_images = image_ids[keep]
+        kept_counts = torch.bincount(kept_images, minlength=n)
+        if self.top_k is not None:
+            # rank of each box within its image
+            starts = torch.cumsum(kept_counts, 0) - kept_counts
+            rank = torch.arange(len(keep)) - starts[kept_images]
+            keep = keep[rank < self.top_k]
+            kept_counts = torch.clamp(kept_counts, max=self.top_k)
+        # split the flat results back into per image tuples
+        kept_labels = [self.classes[i] for i in class_ids[keep].tolist()]
+        results = []
+        start = 0
+        for count, image_boxes, image_scores in zip(kept_counts.tolist(), boxes[keep].split(kept_counts.tolist()), scores[keep].split(kept_counts.tolist())):
+            results.append((kept_labels[start:start + count], image_boxes, image_scores))
+            start += count
+        return results
@@ -0,0 +1,112 @@
+# opt-in profiling for the pipeline scripts
+# with --profile PREFIX a script records the wall time of each of its stages to PREFIX.json and a cProfile
+# dump of the main thread to PREFIX.prof (open it with `python -m pstats` or snakeviz). without the flag
+# every stage() is a no-op context manager, so the hooks cost nothing.
+import cProfile
+import json
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+class Profiler:
+    """
+    Accumulates per-stage wall times, safely from several threads
+    """
+    def __init__(self):
+        self.enabled = False
+        self.output_prefix = None
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.profile = None
+        self.start_time = None
+
+    def start(self, output_prefix):
+        """
+        Enable profiling and start the cProfile of the main thread
+        Args:
+            output_prefix: path prefix for the .json and .prof files; None leaves profiling disabled
+        """
+        if output_prefix is None:
+            return self
+        self.enabled = True
+        self.output_prefix = Path(output_prefix)
+        self.start_time = time.perf_counter()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return self
+
+    def add(self, name, seconds, items=1):
+        """
+        Record time spent in a stage
+        Args:
+            name: the stage
+            seconds: time spent
+            items: number of items (images, files) processed in that time
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0, 'items': 0})
+            stage['seconds'] += seconds
+            stage['calls'] += 1
+            stage['items'] += items
+
+    def stage(self, name, items=1):
+        """
+        Time a block of code as part of a stage
+            with profiler.stage('decode', len(batch)):
+                ...
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self._stage(name, items)
+
+    @contextmanager
+    def _stage(self, name, items):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, items)
+
+    def report(self) -> dict:
+        """
+        Returns:
+            dictionary of the total time and the per-stage times, calls, items and items/sec
+        """
+        stages = {}
+        for name, stage in self.stages.items():
+            stages[name] = dict(stage, per_sec=stage['items'] / stage['seconds'] if stage['seconds'] else None)
+        total = time.perf_counter() - self.start_time if self.start_time is not None else None
+        return {'total_seconds': total, 'stages': stages}
+
+    def finish(self) -> dict:
+        """
+        Stop profiling and write the .json and .prof files
+        Returns:
+            the report (None if profiling is disabled)
+        """
+        if not self.enabled:
+            return None
+        if self.profile is not None:
+            self.profile.disable()
+        self.output_prefix.parent.mkdir(parents=True, exist_ok=True)
+        report = self.report()
+        with open(self.output_prefix.with_name(self.output_prefix.name + '.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+        if self.profile is not None:
+            self.profile.dump_stats(self.output_prefix.with_name(self.output_prefix.name + '.prof'))
+        for name, stage in report['stages'].items():
+            print(f'[PROFILE] {name}: {stage["seconds"]:.3f}s over {stage["calls"]} calls ({stage["items"]} items)')
+        return report
+
+# shared by every script and library module; disabled until a script's --profile flag starts it
+PROFILER = Profiler()
+
+def add_profile_argument(parser):
+    """
+    Add the --profile option to an argument parser
+    """
+    # write per-stage timings (PREFIX.json) and a cProfile dump (PREFIX.prof)
+    parser.add_argument('--profile', metavar='PREFIX', help='Write per-stage timings to PREFIX.json and a cProfile dump to PREFIX.prof.')
@@ -1,6 +1,119 @@
 import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-import xml.etree.ElementTree 
+import sys
+from annotations import location_of, read_location, relocate
+from dataset_index import build_index, check_integrity, get_classes
+from dedup import load_dataset_hashes, remap_dataset_hashes, stale_dataset_hashes
+from manifest import remap_manifest
+from profiling import PROFILER, add_profile_argument
+
+def plan_ids(stems) -> dict:
+    """
+    Work out the renames that number the files 0-(n-1) while keeping their order.
+    Each file moves down to its rank, so the newest images (which train.py holds out) keep the highest ids.
+    Args:
+        stems: list of integer file stems
+    Returns:
+        dictionary of {old stem: new stem} for the files that have to move
+    """
+    return {stem: rank for rank, stem in enumerate(sorted(stems)) if stem != rank}
+
+def order_renames(renames) -> list:
+    """
+    Order the renames from plan_ids so that no rename ever lands on a file that hasn't moved out yet.
+    Every file moves down to a lower id, so going in ascending order only ever lands on gaps or on ids
+    that were already vacated; no temporary names are needed.
+    Args:
+        renames: dictionary of {old stem: new stem}
+    Returns:
+        list of (old stem, new stem) steps
+    """
+    return sorted(renames.items(), key=lambda step: step[1])
+
+def fix_label(label_file, image_file, dry_run=False) -> bool:
+    """
+    Make sure a label file points at its image
+    Args:
+        label_file: the .xml label file
+        image_file: the image it belongs to
+        dry_run: only report whether the file needs fixing
+    Returns:
+        True if the label file needed fixing
+    """
+    if read_location(label_file) == location_of(image_file):
+        return False
+    if not dry_run:
+        relocate(label_file, image_file)
+    return True
+
+def _fix_label(job):
+    # unpacks the job tuple for the process pool
+    return fix_label(*job)
+
+def repair_dataset(images_folder, labels_folder, workers=None, dry_run=False, verbose=True) -> tuple:
+    """
+    Number the images and labels 0-(n-1) and make every label file point at its image
+    Args:
+        images_folder: the clean_data images folder
+        labels_folder: the clean_data labels folder
+        workers: number of worker processes used to check and fix the label files
+        dry_run: only work out (and print) what would be changed
+        verbose: print every rename (and, in a dry run, every label that would be fixed)
+    Returns:
+        tuple of (number of renames, number of label fixes), the ones that would be made in a dry run
+    """
+    images_folder, labels_folder = Path(images_folder), Path(labels_folder)
+    # get the image and label stems
+    with PROFILER.stage('scan'):
+        image_stems = [entry.name[:-4] for entry in os.scandir(images_folder) if entry.name.endswith('.png')]
+        label_stems = {entry.name[:-4] for entry in os.scandir(labels_folder) if entry.name.endswith('.xml')}
+    image_count = len(image_stems)
+    label_count = len(label_stems)
+    # check that there is a corresponding label file for each image in the source folder
+    for image_name in image_stems:
+        # check that the label file exists
+        if image_name not in label_stems:
+            label_file = labels_folder/f'{image_name}.xml'
+            raise FileNotFoundError(f'{label_file} does not exist for image {image_name}.png. There must be a label in the source labels folder for each image in the source images folder.')
+    # check that the image and label counts are equal
+    if image_count != label_count:
+        raise Exception(f'{image_count} images found in {images_folder} but {label_count} labels found in {labels_folder}. The number of images must equal the number of labels.')
+    # work out which files have to be renamed to get to 0-(n-1)
+    stems = [int(stem) for stem in image_stems]
+    renames = plan_ids(stems)
+    steps = order_renames(renames)
+    if verbose:
+        for src, dst in steps:
+            print(f'{src}.png/.xml -> {dst}.png/.xml')
+    # renamed labels always need fixing; everything else is checked
+    moved = set(renames.values())
+    jobs = [(labels_folder/f'{i}.xml', images_folder/f'{i}.png', dry_run) for i in range(image_count) if i not in moved]
+    if dry_run:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            broken = [job[0] for job, needs_fix in zip(jobs, pool.map(_fix_label, jobs, chunksize=256)) if needs_fix]
+        if verbose:
+            for label_file in broken:
+                print(f'{label_file} would be fixed')
+        return len(steps), len(broken) + len(moved)
+
+    # rename the images and labels
+    with PROFILER.stage('rename', len(steps)):
+        for src, dst in steps:
+            (images_folder/f'{src}.png').rename(images_folder/f'{dst}.png')
+            (labels_folder/f'{src}.xml').rename(labels_folder/f'{dst}.xml')
+        if renames:
+            remap_manifest(labels_folder.parent/'manifest.csv', renames, set(stems))
+            remap_dataset_hashes(labels_folder.parent/'hashes.npz', renames)
+
+    # repair the xml files in parallel
+    # fix the folder file and path in the xml files that don't point at their image
+    jobs += [(labels_folder/f'{i}.xml', images_folder/f'{i}.png', False) for i in sorted(moved)]
+    with PROFILER.stage('fix_labels', len(jobs)), ProcessPoolExecutor(max_workers=workers) as pool:
+        fixed = sum(pool.map(_fix_label, jobs, chunksize=256))
+    return len(steps), fixed
+
 # this file ensures that the data folder is in a consistent state
 if __name__ == "__main__":
     # this program takes several command line arguments
@@ -14,15 +127,23 @@ if __name__ == "__main__":
     parser.add_argument('-i', '--images', help='Folder containing the verified images.')
     # optional argument to specify the folder containing the verified labels; defaults to ../clean_data/labels if not specified
     parser.add_argument('-l', '--labels', help='Folder containing the verified labels.')
+    # report what would be changed without touching anything
+    parser.add_argument('-n', '--dry-run', action='store_true', help='Print the renames and label fixes without applying them.')
+    # number of worker processes used to check and fix the label files
+    parser.add_argument('-w', '--workers', type=int, help='Number of worker processes.')
+    # only check the dataset against the (incrementally updated) dataset index and report problems
+    parser.add_argument('-c', '--check', action='store_true', help='Check integrity using the dataset index without repairing or writing anything.')
+    add_profile_argument(parser)
 
     args = parser.parse_args()
+    PROFILER.start(args.profile)
     here = Path(__file__).parent
     if args.images:
-        images_folder = args.images
+        images_folder = Path(args.images)
     else:
         images_folder = here/'../clean_data/images'
     if args.labels:
-        labels_folder = args.labels
+        labels_folder = Path(args.labels)
     else:
         labels_folder = here/'../clean_data/labels'
 
@@ -32,57 +153,30 @@ if __name__ == "__main__":
     if not labels_folder.exists():
         raise FileNotFoundError(f'{labels_folder} does not exist')
 
-    # get count of images and labels
-    image_count = len(list(images_folder.glob('*.png')))
-    label_count = len(list(labels_folder.glob('*.xml')))
-    # check that there is a corresponding label file for each image in the source folder
-    for image_file in images_folder.glob('*.png'):
-        # get the image file name without the extension
-        image_name = image_file.stem
-        # get the label file name
-        label_file = labels_folder/f'{image_name}.xml'
-        # check that the label file exists
-        if not label_file.exists():
-            raise FileNotFoundError(f'{label_file} does not exist for image {image_name}.png. There must be a label in the source labels folder for each image in the source images folder.')
-    # check that the image and label counts are equal
-    if image_count != label_count:
-        raise Exception(f'{image_count} images found in {images_folder} but {label_count} labels found in {labels_folder}. The number of images must equal the number of labels.')
-    # rename the images and labels to 0-(n-1)
-    image_names = list(images_folder.glob('*.png'))
-    label_names = list(labels_folder.glob('*.xml'))
-    # sort the image and label names
-    image_names.sort(key=lambda x: int(x.stem))
-    label_names.sort(key=lambda x: int(x.stem))
-    for i in range(image_count):
-        image_names[i].rename(images_folder/f'{i}.png')
-        label_names[i].rename(labels_folder/f'{i}.xml')
-
-    # repair the xml files      
-    # fix the folder file and path in the xml file
-    for label_file in labels_folder.glob('*.xml'):
-        # get the image file
-        image_file = images_folder/f'{label_file.stem}.png'
-        # get the xml tree
-        tree = xml.etree.ElementTree.parse(label_file)
-        # get the root element
-        root = tree.getroot()
-        # get the folder element
-        folder = root.find('folder')
-        # set the folder to the folder containing the image 
-        folder.text = image_file.parent.name
-        # get the filename element
-        filename = root.find('filename')
-        # set the filename to the image file name
-        filename.text = image_file.name
-        # get the path element
-        path = root.find('path')
-        # set the path to the image file name
-        path.text = image_file.resolve().as_posix()
-        # write the xml file
-        tree.write(label_file)
-
-        
-        
-
-
+    if args.check:
+        classes = get_classes(here/'../clean_data/static/set6_classes.csv')
+        # the index is updated in memory only; a check never writes to clean_data
+        with PROFILER.stage('index'):
+            index = build_index(labels_folder, images_folder, classes, labels_folder.parent/'dataset.idx', save=False)
+        problems = check_integrity(index)
+        # commit_data.py trusts the saved image hashes, so this is where they get checked against the images
+        with PROFILER.stage('dedup_check'):
+            stale = stale_dataset_hashes(images_folder, labels_folder.parent/'hashes.npz')
+        if stale:
+            problems.append(f'{len(stale)} saved image hashes are missing or out of date (e.g. {stale[0]}.png); run repair_integrity.py to update them')
+        for problem in problems:
+            print(problem)
+        print(f'{len(index)} labels checked, {len(problems)} problems found')
+        PROFILER.finish()
+        sys.exit(1 if problems else 0)
 
+    steps, fixed = repair_dataset(images_folder, labels_folder, workers=args.workers, dry_run=args.dry_run)
+    if args.dry_run:
+        print(f'{steps} renames and {fixed} label fixes would be made.')
+    else:
+        print(f'{steps} renames and {fixed} label fixes made.')
+        # commit_data.py trusts the saved image hashes; bring them up to date with any images changed by hand
+        with PROFILER.stage('dedup_rescan'):
+            hashes = load_dataset_hashes(images_folder, labels_folder.parent/'hashes.npz', workers=args.workers, rescan=True)
+        print(f'{len(hashes)} image hashes up to date')
+    PROFILER.finish()
@@ -1,25 +1,25 @@
 from PIL import Image
-import win32gui
-import pyautogui
-from ctypes import windll
 import argparse
+import os
+import time
 from pathlib import Path
+from capture import BACKENDS, FRAME_SUFFIXES, Recorder, Win32Backend, default_backend_name, get_backend, save_frame
+from dedup import RecentFrames
+from profiling import PROFILER, add_profile_argument
 def get_tft_window_screenshot() -> Image.Image:
-    window_name = "League of Legends (TM) Client"
-    hwnd = win32gui.FindWindow(None, window_name)
-    if hwnd:
-        win32gui.SetForegroundWindow(hwnd)
-        x, y, x1, y1 = win32gui.GetClientRect(hwnd)
-        x, y = win32gui.ClientToScreen(hwnd, (x, y))
-        x1, y1 = win32gui.ClientToScreen(hwnd, (x1 - x, y1 - y))
-        im = pyautogui.screenshot(region=(x, y, x1, y1))
-        # check that the screenshot is the right size
-        if im.size != (1920, 1080):
-            im.show()
-            raise Exception("Image is not 1920x1080. Dimensions: " + str(im.size))
-        return im
-    else:
-        print('Window not found!')
+    return Win32Backend().grab()
+
+def next_index(folder) -> int:
+    """
+    Get the next free sequential file name in a folder (scanned once, not on every screenshot)
+    Args:
+        folder: the screenshots folder
+    Returns:
+        one past the largest numbered image in the folder
+    """
+    stems = [int(entry.name.rsplit('.', 1)[0]) for entry in os.scandir(folder)
+             if entry.name.endswith(FRAME_SUFFIXES) and entry.name.rsplit('.', 1)[0].isdigit()]
+    return max(stems) + 1 if stems else 0
 
 if __name__ == "__main__":
     # program takes one command line arg - the folder to save the screenshot to
@@ -28,25 +28,80 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Take a screenshot of the League of Legends window.')
     # optional argument to specify the folder to save the screenshot to; defaults to ../screenshots if not specified
     parser.add_argument('-f', '--folder', help='Folder to save the screenshot to.')
+    # optional argument to pick where frames come from; defaults to the game window on windows and the X display elsewhere
+    parser.add_argument('-b', '--backend', choices=list(BACKENDS), default=default_backend_name(), help='Capture backend to use.')
+    # the video file or image folder for the offline backends (or the display for x11)
+    parser.add_argument('-s', '--source', help='Video file, image folder or X display to capture from.')
+    # record continuously instead of taking one screenshot per enter press
+    parser.add_argument('-r', '--record', action='store_true', help='Record continuously at a fixed frame rate.')
+    parser.add_argument('--fps', type=float, default=4, help='Frames per second to record.')
+    parser.add_argument('--duration', type=float, help='Seconds to record for (defaults to until ctrl+c or the source runs out).')
+    parser.add_argument('--buffer', type=int, default=64, help='Maximum number of frames waiting to be encoded.')
+    parser.add_argument('--encoders', type=int, default=2, help='Number of encoder threads.')
+    parser.add_argument('--format', choices=['png', 'webp'], default='png', help='Image format to record to.')
+    # drop frames that are nearly identical to one of the last few saved frames
+    parser.add_argument('-d', '--dedup', action='store_true', help='Skip frames that are near-duplicates of recent frames.')
+    parser.add_argument('--dedup-threshold', type=int, default=4, help='Frames whose 64 bit hashes differ in at most this many bits are duplicates.')
+    parser.add_argument('--dedup-window', type=int, default=32, help='Number of recent frames to compare against.')
+    add_profile_argument(parser)
     args = parser.parse_args()
+    PROFILER.start(args.profile)
     here = Path(__file__).parent
     if args.folder:
-        folder = args.folder
+        folder = Path(args.folder)
     else:
         folder = here/'../screenshots'
     # make sure the folder exists
     folder.mkdir(parents=True, exist_ok=True)
+    # the game window only needs to be focused once when recording
+    kwargs = {'focus_each_grab': False} if args.record and args.backend == 'win32' else {}
+    backend = get_backend(args.backend, args.source, **kwargs)
+    # compute the next available file name once; later screenshots count up from it
+    index = next_index(folder)
+    recent = RecentFrames(args.dedup_window, args.dedup_threshold) if args.dedup else None
 
-    while True:
-        # get the screenshot
+    if args.record:
+        recorder = Recorder(backend, folder, fps=args.fps, buffer_size=args.buffer, encoders=args.encoders, image_format=args.format, first_index=index, frame_filter=recent.is_new if recent else None).start()
+        start = time.perf_counter()
+        print("Recording, press ctrl+c to stop")
+        # finish in a finally so an encoder error raised by stop() still writes the profile
+        try:
+            try:
+                recorder.wait(args.duration)
+            except KeyboardInterrupt:
+                recorder.stop()
+            elapsed = time.perf_counter() - start
+            print(f"{recorder.saved} frames saved ({recorder.captured/elapsed:.2f} fps captured, {recorder.filtered} duplicates skipped, {recorder.buffer.dropped} dropped)")
+        finally:
+            backend.close()
+            PROFILER.finish()
+    else:
         try:
-            im = get_tft_window_screenshot()
-            # compute the next available file name
-            file_name = folder/'{}.png'.format(str(len(list(folder.glob('*.png')))))
-            # save the screenshot
-            im.save(file_name)
-        except Exception as e:
-            print(e)
-        # wait for the user to press enter
-        input("Press enter to take another screenshot")
-        print("Screenshot taken")
\ No newline at end of file
+            while True:
+                # get the screenshot
+                try:
+                    # the same stages the recorder reports
+                    with PROFILER.stage('grab'):
+                        im = backend.grab()
+                    if im is None:
+                        print("Source exhausted")
+                        break
+                    with PROFILER.stage('filter'):
+                        duplicate = recent is not None and not recent.is_new(im)
+                    if duplicate:
+                        print("Duplicate of a recent screenshot, not saved")
+                    else:
+                        # save the screenshot
+                        with PROFILER.stage('encode'):
+                            save_frame(im, folder/f'{index}.png')
+                        index += 1
+                except Exception as e:
+                    print(e)
+                # wait for the user to press enter
+                input("Press enter to take another screenshot")
+                print("Screenshot taken")
+        except (KeyboardInterrupt, EOFError):
+            pass
+        finally:
+            backend.close()
+            PROFILER.finish()
@@ -0,0 +1,172 @@
+# ranks unlabelled screenshots by how much verifying them would help the model
+# each image is scored from cheap signals of one model pass: how uncertain its detections are and how many
+# rare units (fewer than --rare-below labelled examples in clean_data, counted like tally.py) it seems to contain.
+# scoring streams through the images in batches; scores are spilled to sorted run files and merged at the end
+# (an external sort), so ranking 100k screenshots never holds more than one run in memory. the raw predictions
+# go into the inference cache, so labelling the top of the queue with auto_label.py --queue is nearly free.
+import argparse
+import csv
+import heapq
+import os
+import shutil
+import tempfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+from auto_label import _batched, _bounded_map, load_image, predict_batch
+from capture import FRAME_SUFFIXES
+from detection_server import RemoteDetector
+from detector import add_detector_arguments, detector_from_args
+from inference_cache import InferenceCache
+from tally import tally_files
+
+def rarity_weights(labels_folder, classes, rare_below=100) -> dict:
+    """
+    Weight each unit by how rare it is in the labelled data
+    Args:
+        labels_folder: the clean_data labels folder
+        classes: list of unit abbreviations
+        rare_below: units with at least this many labelled examples get weight 0
+    Returns:
+        dictionary of {unit_abbreviation: weight}; 1 for unseen units, falling linearly to 0 at rare_below
+    """
+    counts = Counter()
+    if Path(labels_folder).exists():
+        # the same cache tally.py keeps, so this only re-parses label files that changed
+        for objects in tally_files(labels_folder, Path(labels_folder).parent/'tally_cache.json').values():
+            counts.update(name for name, _, _ in objects)
+    return {c: max(0.0, 1 - counts[c] / rare_below) for c in classes}
+
+def score_prediction(raw, filtered, weights, uncertainty_weight=1.0, rarity_weight=1.0) -> tuple:
+    """
+    Score one image
+    Args:
+        raw: the raw (labels, boxes, scores) of the image
+        filtered: the post-processed (labels, boxes, scores) of the image
+        weights: rarity weights from rarity_weights
+        uncertainty_weight: how much uncertain detections count
+        rarity_weight: how much rare units count
+    Returns:
+        tuple of (score, uncertainty, rarity, list of rare units detected)
+    """
+    scores = np.asarray(raw[2], dtype=np.float64).reshape(-1)
+    # 1 for a detection at 0.5 confidence, 0 for one the model is sure about either way
+    uncertainty = float(np.sum(4 * scores * (1 - scores)))
+    rare = [label for label in filtered[0] if weights.get(label, 0) > 0]
+    rarity = float(sum(weights[label] for label in rare))
+    return uncertainty_weight * uncertainty + rarity_weight * rarity, uncertainty, rarity, sorted(set(rare))
+
+def _write_run(run, folder, n) -> Path:
+    # highest score first; the score is the first column so the runs can be merged on it
+    run.sort(key=lambda x: -x[0])
+    path = Path(folder)/f'run_{n:05d}.tsv'
+    with open(path, 'w', newline='') as f:
+        f.writelines(f'{score!r}\t{uncertainty:.4f}\t{rarity:.4f}\t{" ".join(rare)}\t{image_path}\n' for score, uncertainty, rarity, rare, image_path in run)
+    return path
+
+def _read_run(path):
+    with open(path, newline='') as f:
+        for line in f:
+            score, uncertainty, rarity, rare, image_path = line.rstrip('\n').split('\t', 4)
+            yield float(score), uncertainty, rarity, rare, image_path
+
+def rank_images(detector, images, queue_path, weights, cache=None, workers=4, batch_size=4, run_size=10000,
+                uncertainty_weight=1.0, rarity_weight=1.0, report_every=1000) -> int:
+    """
+    Score images in a streaming batched pass and write them to a queue file, most valuable first
+    Args:
+        detector: the Detector to predict with
+        images: iterable of image paths
+        queue_path: the csv to write the ranked queue to
+        weights: rarity weights from rarity_weights
+        cache: optional InferenceCache of raw predictions
+        workers: number of decoding threads
+        batch_size: number of images per predict call
+        run_size: number of scores kept in memory before they are spilled to disk
+        uncertainty_weight: how much uncertain detections count
+        rarity_weight: how much rare units count
+        report_every: print progress every this many images (0 to disable)
+    Returns:
+        number of ranked images
+    """
+    run_folder = Path(tempfile.mkdtemp(prefix='rank_', dir=Path(queue_path).parent))
+    runs, run, done = [], [], 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as decoders:
+            decoded = _bounded_map(decoders, lambda p: load_image(p, cache), images, window=max(2*batch_size, workers))
+            for batch in _batched(decoded, batch_size):
+                results = predict_batch(detector, batch, cache)
+                raw = [r[2:] for r in results]
+                for (image_path, *_), prediction, filtered in zip(results, raw, detector.postprocess(raw)):
+                    run.append((*score_prediction(prediction, filtered, weights, uncertainty_weight, rarity_weight), image_path))
+                done += len(results)
+                if len(run) >= run_size:
+                    runs.append(_write_run(run, run_folder, len(runs)))
+                    run = []
+                if report_every and results and done % report_every < len(results):
+                    print(f'[INFO] scored {done} images')
+        if run:
+            runs.append(_write_run(run, run_folder, len(runs)))
+        # merge the sorted runs straight into the queue
+        tmp_path = Path(str(queue_path) + '.tmp')
+        with open(tmp_path, 'w', newline='') as f:
+            # csv quoting, so image paths with commas survive
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(['rank', 'image', 'score', 'uncertainty', 'rarity', 'rare_units'])
+            merged = heapq.merge(*[_read_run(path) for path in runs], key=lambda x: -x[0])
+            for rank, (score, uncertainty, rarity, rare, image_path) in enumerate(merged):
+                writer.writerow([rank, image_path, f'{score:.4f}', uncertainty, rarity, rare])
+        os.replace(tmp_path, queue_path)
+    finally:
+        shutil.rmtree(run_folder, ignore_errors=True)
+    return done
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Rank unlabelled screenshots by how valuable verifying them would be.')
+    # optional argument to specify the folder of unlabelled images; defaults to ../screenshots if not specified
+    parser.add_argument('-i', '--images', help='Folder containing the images to rank.')
+    # images that already have a label here are skipped; defaults to ../labels if not specified
+    parser.add_argument('-l', '--labels', help='Folder of existing label files (those images are skipped).')
+    # labelled dataset the rare unit counts come from; defaults to ../clean_data/labels
+    parser.add_argument('--clean-labels', help='Folder of verified labels to count rare units in.')
+    # optional argument to specify the queue file; defaults to ../queue.csv
+    parser.add_argument('-q', '--queue', help='Path to write the ranked queue to.')
+    # model and post-processing options (-m model, -f label file, thresholds, nms)
+    add_detector_arguments(parser)
+    parser.add_argument('--server', help='URL of a running detection server to use instead of loading the model.')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='Number of image decoding threads.')
+    parser.add_argument('-b', '--batch-size', type=int, default=4, help='Number of images per predict call.')
+    # units with fewer labelled examples than this count as rare (tally.py reports the same threshold)
+    parser.add_argument('--rare-below', type=int, default=100, help='Units with fewer labelled examples than this are rare.')
+    parser.add_argument('--uncertainty-weight', type=float, default=1.0, help='Weight of uncertain detections in the score.')
+    parser.add_argument('--rarity-weight', type=float, default=1.0, help='Weight of rare units in the score.')
+    parser.add_argument('--run-size', type=int, default=10000, help='Number of scores kept in memory before spilling to disk.')
+    parser.add_argument('-c', '--cache', help='Path to the inference cache file.')
+    parser.add_argument('--no-cache', action='store_true', help='Do not read or write the inference cache.')
+    args = parser.parse_args()
+    here = Path(__file__).parent
+    images_folder = Path(args.images) if args.images else here/'../screenshots'
+    labels_folder = Path(args.labels) if args.labels else here/'../labels'
+    clean_labels = Path(args.clean_labels) if args.clean_labels else here/'../clean_data/labels'
+    queue_path = Path(args.queue) if args.queue else here/'../queue.csv'
+    if args.server:
+        detector = RemoteDetector.from_args(args.server, args)
+    else:
+        detector = detector_from_args(args)
+    weights = rarity_weights(clean_labels, detector.classes, args.rare_below)
+    print(f'{sum(w > 0 for w in weights.values())} of {len(weights)} units are rare')
+    cache = None
+    if not args.no_cache:
+        cache_path = Path(args.cache) if args.cache else here/'../cache/inference_cache.sqlite'
+        cache = InferenceCache(cache_path, detector.fingerprint)
+    # stream the candidates instead of listing them all up front
+    images = (Path(entry.path) for entry in os.scandir(images_folder)
+              if entry.name.endswith(FRAME_SUFFIXES) and not (labels_folder/f'{Path(entry.name).stem}.xml').exists())
+    try:
+        n = rank_images(detector, images, queue_path, weights, cache, args.workers, args.batch_size, args.run_size,
+                        args.uncertainty_weight, args.rarity_weight)
+    finally:
+        if cache is not None:
+            cache.close()
+    print(f'Ranked {n} images into {queue_path}')
@@ -0,0 +1,322 @@
+# packs clean_data into pre-decoded image shards for training
+# every image is decoded once and stored as raw BGR uint8 in fixed-size shard files (.npy, memory-mapped
+# when read) alongside its boxes, so an epoch is a sequence of memory copies instead of thousands of png
+# decodes and xml parses. the layout of a shard folder:
+#   shards.json          classes, shard names and image count (written last; a folder without it is incomplete)
+#   shard_00000.npy      flat uint8 array of the shard's images, back to back
+#   shard_00000.npz      stems, offsets, shapes and boxes/labels of the shard's images
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+from annotations import read_annotation
+from dataset_index import get_classes
+
+# 2: images are stored BGR, the channel order every inference path feeds the model
+SHARD_VERSION = 2
+# the normalization detecto applies to training images
+IMAGENET_MEAN = torch.tensor([0.485, 0.456, 0.406]).view(3, 1, 1)
+IMAGENET_STD = torch.tensor([0.229, 0.224, 0.225]).view(3, 1, 1)
+
+def labelled_stems(images_folder, labels_folder) -> list:
+    """
+    Get the sorted stems of the clean_data images that have a label file
+    """
+    image_stems = {entry.name[:-4] for entry in os.scandir(images_folder) if entry.name.endswith('.png')}
+    return sorted(int(entry.name[:-4]) for entry in os.scandir(labels_folder)
+                  if entry.name.endswith('.xml') and entry.name[:-4].isdigit() and entry.name[:-4] in image_stems)
+
+def held_out_count(total, val=200) -> int:
+    """
+    The number of most recently committed images train.py holds out for validation: val, but at most a fifth of the dataset
+    """
+    return min(val, total // 5)
+
+def read_image(image_path, scale=1.0) -> np.ndarray:
+    """
+    Decode an image to a HxWx3 BGR uint8 array (as read by cv2, like auto_label.py and the detector), optionally resized
+    """
+    image = cv2.imdecode(np.fromfile(str(image_path), dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f'Could not decode {image_path}')
+    if scale != 1:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return image
+
+def read_target(label_path, class_ids, scale=1.0) -> tuple:
+    """
+    Read the boxes of a label file
+    Returns:
+        tuple of (Nx4 float32 boxes, N int64 class ids); units not in class_ids are skipped
+    """
+    annotation = read_annotation(label_path)
+    boxes = np.frombuffer(annotation.boxes, dtype=np.int32).reshape(-1, 4).astype(np.float32) * scale
+    labels = np.array([class_ids.get(name, -1) for name in annotation.names], dtype=np.int64)
+    known = labels >= 0
+    return boxes[known], labels[known]
+
+def _image_shape(image_path, scale) -> tuple:
+    # only reads the png header
+    with Image.open(image_path) as im:
+        width, height = im.size
+    return round(height * scale), round(width * scale), 3
+
+def pack_shards(images_folder, labels_folder, classes, output_folder, shard_size=64, scale=1.0, workers=None, verbose=False) -> int:
+    """
+    Pack every labelled image into shards
+    Args:
+        images_folder: folder containing the .png images
+        labels_folder: folder containing the .xml label files
+        classes: list of unit abbreviations; class ids are positions in this list
+        output_folder: folder to write the shards to (replaced)
+        shard_size: number of images per shard
+        scale: resize images (and boxes) by this factor while packing
+        workers: number of decoding threads
+        verbose: print progress
+    Returns:
+        the number of packed images
+    """
+    images_folder, labels_folder, output_folder = Path(images_folder), Path(labels_folder), Path(output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    # the manifest goes last, so drop the old one first; a half-written folder is never mistaken for a complete one
+    (output_folder/'shards.json').unlink(missing_ok=True)
+    for old in output_folder.glob('shard_*'):
+        old.unlink()
+    class_ids = {c: i for i, c in enumerate(classes)}
+    stems = labelled_stems(images_folder, labels_folder)
+    start = time.perf_counter()
+    names = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for n, first in enumerate(range(0, len(stems), shard_size)):
+            shard_stems = stems[first:first + shard_size]
+            image_paths = [images_folder/f'{stem}.png' for stem in shard_stems]
+            shapes = np.array(list(pool.map(lambda p: _image_shape(p, scale), image_paths)), dtype=np.int64).reshape(-1, 3)
+            sizes = shapes.prod(axis=1)
+            offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int64)
+            name = f'shard_{n:05d}'
+            data = np.lib.format.open_memmap(output_folder/f'{name}.npy', mode='w+', dtype=np.uint8, shape=(int(sizes.sum()),))
+
+            def pack_one(i):
+                image = read_image(image_paths[i], scale)
+                if image.shape != tuple(shapes[i]):
+                    raise ValueError(f'{image_paths[i]} decoded to {image.shape}, expected {tuple(shapes[i])}')
+                # each thread writes its own slice of the shard
+                data[offsets[i]:offsets[i] + sizes[i]] = image.reshape(-1)
+                return read_target(labels_folder/f'{shard_stems[i]}.xml', class_ids, scale)
+
+            targets = list(pool.map(pack_one, range(len(shard_stems))))
+            data.flush()
+            del data
+            counts = np.array([len(labels) for _, labels in targets], dtype=np.int64)
+            np.savez(output_folder/f'{name}.npz',
+                     stems=np.array(shard_stems, dtype=np.int64), offsets=offsets, shapes=shapes,
+                     first=np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64), count=counts,
+                     boxes=np.concatenate([b for b, _ in targets]) if targets else np.zeros((0, 4), np.float32),
+                     labels=np.concatenate([l for _, l in targets]) if targets else np.zeros(0, np.int64))
+            names.append(name)
+            if verbose:
+                done = first + len(shard_stems)
+                print(f'[INFO] packed {done}/{len(stems)} images ({done / (time.perf_counter() - start):.1f} images/sec)')
+    meta = {'version': SHARD_VERSION, 'classes': list(classes), 'scale': scale, 'images': len(stems), 'shards': names}
+    tmp_path = output_folder/'shards.json.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, output_folder/'shards.json')
+    return len(stems)
+
+def _to_tensor(image, normalize) -> torch.Tensor:
+    tensor = torch.from_numpy(image).permute(2, 0, 1).float().div_(255)
+    if normalize:
+        tensor = (tensor - IMAGENET_MEAN) / IMAGENET_STD
+    return tensor
+
+def _target(boxes, labels) -> dict:
+    # class id 0 is detecto's __background__
+    return {'boxes': torch.as_tensor(boxes, dtype=torch.float32).reshape(-1, 4), 'labels': torch.as_tensor(labels, dtype=torch.int64) + 1}
+
+class ShardDataset(torch.utils.data.Dataset):
+    """
+    The images of a shard folder as (image tensor, target dict) pairs, ready for a torchvision detection model
+    """
+    def __init__(self, shard_folder, normalize=True):
+        """
+        Args:
+            shard_folder: folder written by pack_shards
+            normalize: apply detecto's imagenet normalization
+        """
+        self.folder = Path(shard_folder)
+        with open(self.folder/'shards.json') as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != SHARD_VERSION:
+            raise ValueError(f'{self.folder} was packed by a different version; repack it')
+        self.classes = self.meta['classes']
+        self.normalize = normalize
+        self.shards = []
+        for name in self.meta['shards']:
+            with np.load(self.folder/f'{name}.npz') as data:
+                self.shards.append({k: data[k] for k in data.files})
+        sizes = [len(shard['stems']) for shard in self.shards]
+        # global index -> (shard, position in shard)
+        self.shard_of = np.repeat(np.arange(len(sizes)), sizes)
+        self.position = np.concatenate([np.arange(n) for n in sizes]) if sizes else np.zeros(0, dtype=np.int64)
+        self.stems = np.concatenate([shard['stems'] for shard in self.shards]) if sizes else np.zeros(0, dtype=np.int64)
+        # memmaps are opened on first use so every DataLoader worker gets its own
+        self._data = None
+
+    def __len__(self):
+        return len(self.shard_of)
+
+    def _shard_data(self, shard):
+        if self._data is None:
+            self._data = [None] * len(self.shards)
+        if self._data[shard] is None:
+            self._data[shard] = np.load(self.folder/f'{self.meta["shards"][shard]}.npy', mmap_mode='r')
+        return self._data[shard]
+
+    def __getitem__(self, i):
+        shard, position = int(self.shard_of[i]), int(self.position[i])
+        meta = self.shards[shard]
+        offset, shape = int(meta['offsets'][position]), tuple(meta['shapes'][position])
+        image = np.array(self._shard_data(shard)[offset:offset + int(np.prod(shape))]).reshape(shape)
+        first, count = int(meta['first'][position]), int(meta['count'][position])
+        return _to_tensor(image, self.normalize), _target(meta['boxes'][first:first + count], meta['labels'][first:first + count])
+
+    def __getstate__(self):
+        # don't send open memmaps to the workers
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+class PngXmlDataset(torch.utils.data.Dataset):
+    """
+    The same pairs as ShardDataset, decoded straight from the png and xml files
+    """
+    def __init__(self, images_folder, labels_folder, classes, stems=None, normalize=True, scale=1.0):
+        self.scale = scale
+        self.images_folder, self.labels_folder = Path(images_folder), Path(labels_folder)
+        self.classes = list(classes)
+        self.class_ids = {c: i for i, c in enumerate(self.classes)}
+        self.stems = np.array(stems if stems is not None else labelled_stems(images_folder, labels_folder), dtype=np.int64)
+        self.normalize = normalize
+
+    def __len__(self):
+        return len(self.stems)
+
+    def __getitem__(self, i):
+        stem = int(self.stems[i])
+        image = read_image(self.images_folder/f'{stem}.png', self.scale)
+        boxes, labels = read_target(self.labels_folder/f'{stem}.xml', self.class_ids, self.scale)
+        return _to_tensor(image, self.normalize), _target(boxes, labels)
+
+class ShardSampler(torch.utils.data.Sampler):
+    """
+    Shuffles the order of the shards and the order of the images within each shard, so reads stay
+    mostly sequential within a shard file while every epoch still sees a different order
+    """
+    def __init__(self, dataset, indices=None, shuffle=True, seed=0):
+        """
+        Args:
+            dataset: the ShardDataset to sample
+            indices: optional subset of dataset indices to sample (e.g. the training split)
+            shuffle: shuffle every epoch; otherwise indices are returned in order
+            seed: base random seed
+        """
+        self.indices = np.arange(len(dataset)) if indices is None else np.asarray(indices)
+        self.shard_of = dataset.shard_of[self.indices] if hasattr(dataset, 'shard_of') else np.zeros(len(self.indices), dtype=np.int64)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        if not self.shuffle:
+            return iter(self.indices.tolist())
+        rng = np.random.default_rng(self.seed + self.epoch)
+        order = []
+        for shard in rng.permutation(np.unique(self.shard_of)):
+            members = self.indices[self.shard_of == shard]
+            order.extend(rng.permutation(members).tolist())
+        return iter(order)
+
+    def __len__(self):
+        return len(self.indices)
+
+def collate(batch):
+    # detection models take lists of images and targets rather than stacked tensors
+    return tuple(zip(*batch))
+
+def make_loader(dataset, batch_size=2, workers=4, prefetch=4, shuffle=True, indices=None, seed=0) -> torch.utils.data.DataLoader:
+    """
+    Build a multi-worker DataLoader with prefetching over a ShardDataset or PngXmlDataset
+    Args:
+        dataset: the dataset to load
+        batch_size: images per batch
+        workers: number of loader processes (0 loads on the main process)
+        prefetch: batches each worker loads ahead
+        shuffle: shuffle every epoch (call loader.sampler.set_epoch)
+        indices: optional subset of dataset indices to load
+        seed: base random seed for the shuffle
+    """
+    sampler = ShardSampler(dataset, indices, shuffle, seed)
+    kwargs = {'prefetch_factor': prefetch, 'persistent_workers': True} if workers > 0 else {}
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, sampler=sampler, num_workers=workers, collate_fn=collate, **kwargs)
+
+def benchmark_loader(loader, limit=None) -> float:
+    """
+    Measure how fast a loader produces images
+    Args:
+        loader: the DataLoader to read from
+        limit: stop after about this many images
+    Returns:
+        images per second
+    """
+    start = time.perf_counter()
+    n = 0
+    for images, _ in loader:
+        n += len(images)
+        if limit is not None and n >= limit:
+            break
+    return n / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pack clean_data into pre-decoded training shards.')
+    # optional argument to specify the clean_data folders; default to ../clean_data/images and ../clean_data/labels
+    parser.add_argument('-i', '--images', help='Folder containing the images.')
+    parser.add_argument('-l', '--labels', help='Folder containing the label files.')
+    # optional argument to specify where to write the shards; defaults to ../clean_data/shards
+    parser.add_argument('-o', '--output', help='Folder to write the shards to.')
+    parser.add_argument('-n', '--shard-size', type=int, default=64, help='Number of images per shard.')
+    # store the images smaller; the model resizes 1920x1080 frames to 1333x750 anyway
+    parser.add_argument('--scale', type=float, default=1.0, help='Resize images by this factor while packing.')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='Number of decoding threads.')
+    # after packing, compare loading the shards with loading the pngs and xmls
+    parser.add_argument('-b', '--benchmark', type=int, help='Benchmark the data loaders on this many images.')
+    parser.add_argument('--loader-workers', type=int, default=4, help='Number of DataLoader workers for the benchmark.')
+    parser.add_argument('--batch-size', type=int, default=2, help='Batch size for the benchmark.')
+    parser.add_argument('--skip-pack', action='store_true', help='Only run the benchmark on existing shards.')
+    args = parser.parse_args()
+    here = Path(__file__).parent
+    images_folder = Path(args.images) if args.images else here/'../clean_data/images'
+    labels_folder = Path(args.labels) if args.labels else here/'../clean_data/labels'
+    shard_folder = Path(args.output) if args.output else here/'../clean_data/shards'
+    classes = get_classes(here/'../clean_data/static/set6_classes.csv')
+    if not args.skip_pack:
+        start = time.perf_counter()
+        n = pack_shards(images_folder, labels_folder, classes, shard_folder, args.shard_size, args.scale, args.workers, verbose=True)
+        print(f'Packed {n} images into {shard_folder} in {time.perf_counter() - start:.2f}s')
+    if args.benchmark:
+        shards = ShardDataset(shard_folder)
+        direct = PngXmlDataset(images_folder, labels_folder, classes, shards.stems, scale=shards.meta['scale'])
+        for name, dataset in (('png+xml', direct), ('shards', shards)):
+            loader = make_loader(dataset, args.batch_size, args.loader_workers)
+            # the first batches include starting the workers, so warm up before timing
+            benchmark_loader(loader, args.batch_size * max(1, args.loader_workers))
+            print(f'{name:8} {benchmark_loader(loader, args.benchmark):.1f} images/sec')
@@ -1,3 +1,9 @@
+import csv
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from annotations import iter_objects
 def get_labels(labels_file_name) -> dict:
     """
     Get the labels of the set 6 units.
@@ -13,36 +19,184 @@ def get_labels(labels_file_name) -> dict:
             unit_name, abbreviated_name = [x.strip() for x in line.split(",")]
             SET_6_UNITS[unit_name] = abbreviated_name
     return SET_6_UNITS
+def tally_file(label_file) -> list:
+    """
+    Map step: read the units out of one label file
+    Args:
+        label_file: path to the .xml label file
+    Returns:
+        list of [unit_name, box_width, box_height] for each unit in the file
+    """
+    return [[name, box[2] - box[0], box[3] - box[1]] for name, box in iter_objects(label_file)]
+
+def tally_files(labels_folder, cache_path=None, workers=None, verbose=False) -> dict:
+    """
+    Tally every label file in a folder with a process pool.
+    Per-file results are persisted to cache_path so later runs only re-parse files that changed.
+    Args:
+        labels_folder: folder containing the .xml label files
+        cache_path: json file to persist per-file results to (None to disable)
+        workers: number of worker processes (defaults to the number of cores)
+        verbose: print how many files were re-parsed
+    Returns:
+        dictionary of {label_stem: [[unit_name, box_width, box_height], ...]}
+    """
+    cache = {}
+    if cache_path is not None and Path(cache_path).exists():
+        try:
+            with open(cache_path) as f:
+                cache = json.load(f)
+        except ValueError:
+            cache = {}
+    entries = [entry for entry in os.scandir(labels_folder) if entry.name.endswith('.xml')]
+    partials = {}
+    fresh_cache = {}
+    stale = []
+    for entry in entries:
+        st = entry.stat()
+        stem = entry.name[:-4]
+        cached = cache.get(stem)
+        if cached is not None and cached['mtime_ns'] == st.st_mtime_ns and cached['size'] == st.st_size:
+            partials[stem] = cached['objects']
+            fresh_cache[stem] = cached
+        else:
+            stale.append((stem, entry.path, st))
+    if stale:
+        # small jobs aren't worth the process start up cost
+        if len(stale) < 64 or workers == 1:
+            results = map(tally_file, [path for _, path, _ in stale])
+            for (stem, _, st), objects in zip(stale, results):
+                partials[stem] = objects
+                fresh_cache[stem] = {'mtime_ns': st.st_mtime_ns, 'size': st.st_size, 'objects': objects}
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                chunksize = max(1, len(stale) // (4*(workers or os.cpu_count() or 1)))
+                results = pool.map(tally_file, [path for _, path, _ in stale], chunksize=chunksize)
+                for (stem, _, st), objects in zip(stale, results):
+                    partials[stem] = objects
+                    fresh_cache[stem] = {'mtime_ns': st.st_mtime_ns, 'size': st.st_size, 'objects': objects}
+    if verbose:
+        print(f'[INFO] tallied {len(entries)} label files ({len(stale)} re-parsed)')
+    if cache_path is not None and (stale or len(fresh_cache) != len(cache)):
+        tmp_path = str(cache_path) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(fresh_cache, f, separators=(',', ':'))
+        os.replace(tmp_path, cache_path)
+    return partials
+
+def summarize(partials, units, bin_size=16, bins=32) -> dict:
+    """
+    Reduce step: combine the per-file results into dataset statistics
+    Args:
+        partials: dictionary of {label_stem: [[unit_name, box_width, box_height], ...]}
+        units: list of unit abbreviations
+        bin_size: width in pixels of each box size histogram bin
+        bins: number of histogram bins; the last bin also holds everything larger
+    Returns:
+        dictionary with unit counts, box size histograms, co-occurrence counts and per-image unit counts
+    """
+    unit_counts = {unit: 0 for unit in units}
+    widths = {unit: [0]*bins for unit in units}
+    heights = {unit: [0]*bins for unit in units}
+    # number of images each pair of units appears in together
+    cooccurrence = {unit: {} for unit in units}
+    per_image = {}
+    for stem, objects in partials.items():
+        per_image[stem] = len(objects)
+        for name, width, height in objects:
+            if name not in unit_counts:
+                raise KeyError(f'Unknown unit {name} in {stem}.xml')
+            unit_counts[name] += 1
+            widths[name][min(max(width, 0) // bin_size, bins - 1)] += 1
+            heights[name][min(max(height, 0) // bin_size, bins - 1)] += 1
+        present = sorted({name for name, _, _ in objects})
+        for i, a in enumerate(present):
+            row = cooccurrence[a]
+            for b in present[i + 1:]:
+                row[b] = row.get(b, 0) + 1
+                cooccurrence[b][a] = cooccurrence[b].get(a, 0) + 1
+    return {
+        'unit_counts': unit_counts,
+        'box_size_bins': [i*bin_size for i in range(bins)],
+        'box_widths': widths,
+        'box_heights': heights,
+        'cooccurrence': cooccurrence,
+        'units_per_image': per_image,
+    }
+
+def export_json(stats, json_path):
+    """
+    Write the statistics to a json file
+    """
+    with open(json_path, 'w') as f:
+        json.dump(stats, f, indent=1)
+
+def export_csv(stats, csv_folder):
+    """
+    Write the statistics to csv files in a folder
+    (unit_counts.csv, box_sizes.csv, cooccurrence.csv, units_per_image.csv)
+    """
+    csv_folder = Path(csv_folder)
+    csv_folder.mkdir(parents=True, exist_ok=True)
+    units = list(stats['unit_counts'])
+    with open(csv_folder/'unit_counts.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['unit', 'count'])
+        writer.writerows(stats['unit_counts'].items())
+    with open(csv_folder/'box_sizes.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['unit', 'dimension'] + stats['box_size_bins'])
+        for unit in units:
+            writer.writerow([unit, 'width'] + stats['box_widths'][unit])
+            writer.writerow([unit, 'height'] + stats['box_heights'][unit])
+    with open(csv_folder/'cooccurrence.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([''] + units)
+        for a in units:
+            writer.writerow([a] + [stats['cooccurrence'][a].get(b, 0) for b in units])
+    with open(csv_folder/'units_per_image.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['image', 'units'])
+        writer.writerows(sorted(stats['units_per_image'].items(), key=lambda x: (len(x[0]), x[0])))
+
 if __name__ == '__main__':
-    import os
-    import xml.etree.ElementTree as ET
     import argparse
     import glob
     import shutil
     import sys
     import re
-    from pathlib import Path
+    from dataset_index import build_index
+    from profiling import PROFILER, add_profile_argument
 
     # construct the argument parser
     ap = argparse.ArgumentParser()
     ap.add_argument("-l", "--labels", required=False, help="path to the labels folder")
     ap.add_argument("-i", "--images", required=False, help="path to the images folder")
+    # use (and update) the dataset index instead of parsing every label file
+    ap.add_argument("-x", "--index", action="store_true", help="count from the dataset index")
+    # number of worker processes used to parse the label files
+    ap.add_argument("-w", "--workers", type=int, required=False, help="number of worker processes")
+    # write the full statistics (box sizes, co-occurrence, units per image) out
+    ap.add_argument("-j", "--json", required=False, help="path to export the statistics to as json")
+    ap.add_argument("-c", "--csv", required=False, help="folder to export the statistics to as csv files")
+    add_profile_argument(ap)
     # argument for verbosity
     ap.add_argument("-v", "--verbose", action="store_true", help="increase output verbosity")
 
     # parse the arguments
     args = vars(ap.parse_args())
+    PROFILER.start(args["profile"])
 
     here = Path(__file__).parent
  
     # if the labels folder is not specified, use the default(clean_data\labels)
     if args["labels"]:
-        labels_folder = args["labels"]
+        labels_folder = Path(args["labels"])
     else:
         labels_folder = here/'../clean_data/labels'
     # if the images folder is not specified, use the default(clean_data\screenshots)
     if args["images"]:
-        images_folder = args["images"]
+        images_folder = Path(args["images"])
     else:
         images_folder = here/'../clean_data/images'
     # if the verbosity flag was set, print out the arguments
@@ -52,32 +206,40 @@ if __name__ == '__main__':
     # open the csv of units to get the keys for the dict
     lp = here/'../clean_data/static/set6_classes.csv'
     units = get_labels(lp).values()
-    # create a dict to store the counts of each unit type
-    unit_counts = {}
-    for unit in units:
-        unit_counts[unit] = 0
-    # get the list of label files
-    label_files = glob.glob(str(labels_folder) + '/*.xml')
-    # loop through the label files
-    for label_file in label_files:
-        # get the label file name without the extension
-        label_name = Path(label_file).stem
-        # get the image file name
-        image_file = images_folder/f'{label_name}.png'
-        # check that the image file exists
-        if not image_file.exists():
-            raise FileNotFoundError(f'{image_file} does not exist for label {label_name}.xml. There must be an image in the source images folder for each label in the source labels folder.')
-        # open the label file
-        tree = ET.parse(label_file)
-        root = tree.getroot()
-        # get the units that occur in the label file
-        units = root.findall('object')
-        # loop through the units
-        for unit in units:
-            # get the name of the unit
-            unit_name = unit.find('name').text
-            # increment the count of the unit type
-            unit_counts[unit_name] += 1
+    if args["index"]:
+        # bring the index up to date; only changed label files get parsed
+        with PROFILER.stage('index'):
+            index = build_index(labels_folder, images_folder, list(units), labels_folder.parent/'dataset.idx', verbose=args["verbose"])
+        missing = index.missing_images()
+        if len(missing):
+            raise FileNotFoundError(f'{images_folder/f"{missing[0]}.png"} does not exist for label {missing[0]}.xml. There must be an image in the source images folder for each label in the source labels folder.')
+        if index.class_counts().get(None):
+            raise KeyError(f'{index.class_counts()[None]} labelled units are not in {lp}')
+        # turn the index rows into the same per-file results the label files produce
+        classes = index.classes
+        sizes = index.box_sizes().tolist()
+        class_ids = index.objects['class_id'].tolist()
+        partials = {}
+        for stem, first, count in zip(index.images['stem'].tolist(), index.images['first'].tolist(), index.images['count'].tolist()):
+            partials[str(stem)] = [[classes[class_ids[i]], *sizes[i]] for i in range(first, first + count)]
+    else:
+        # check that there is an image for each label file
+        image_stems = {entry.name[:-4] for entry in os.scandir(images_folder) if entry.name.endswith('.png')}
+        with PROFILER.stage('tally'):
+            partials = tally_files(labels_folder, labels_folder.parent/'tally_cache.json', workers=args["workers"], verbose=args["verbose"])
+        for label_name in partials:
+            if label_name not in image_stems:
+                image_file = images_folder/f'{label_name}.png'
+                raise FileNotFoundError(f'{image_file} does not exist for label {label_name}.xml. There must be an image in the source images folder for each label in the source labels folder.')
+    with PROFILER.stage('summarize', len(partials)):
+        stats = summarize(partials, list(units))
+    unit_counts = stats['unit_counts']
+    total_images = len(partials)
+    with PROFILER.stage('export'):
+        if args["json"]:
+            export_json(stats, args["json"])
+        if args["csv"]:
+            export_csv(stats, args["csv"])
     # print the counts of each unit type (only in verbose mode)
     if args["verbose"]:
 
@@ -87,8 +249,6 @@ if __name__ == '__main__':
     total_units = sum(unit_counts.values())
     # print the total number of units
     print(f'Total units: {total_units}')
-    # get the total number of images
-    total_images = len(label_files)
     # print the total number of images
     print(f'Total images: {total_images}')
     # get the average number of units per image
@@ -113,6 +273,7 @@ if __name__ == '__main__':
     # percentage left to find
     left = 100 - (c/size)*100
     print(f'{left}% Of units occur less than 100 times')
+    PROFILER.finish()
 
 
 
@@ -0,0 +1,130 @@
+# trains the Faster R-CNN unit detector on clean_data
+# the images are read from pre-decoded shards (see shards.py; packed first if they don't exist yet) through a
+# multi-worker DataLoader. the last images of clean_data are held out for validation and the weights with the
+# best validation mAP are saved in detecto's format, so auto_label.py can load them with -m.
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+import detecto.core
+import numpy as np
+import torch
+from dataset_index import get_classes
+from metrics import DetectionEvaluator
+from shards import SHARD_VERSION, ShardDataset, held_out_count, make_loader, pack_shards
+
+def validate(model, loader, classes, iou_threshold=0.5) -> DetectionEvaluator:
+    """
+    Compute the validation mAP of a torchvision detection model
+    Args:
+        model: the internal torchvision model
+        loader: DataLoader of the validation images
+        classes: list of unit abbreviations (class id i+1 is classes[i])
+        iou_threshold: minimum IoU for a detection to count as a true positive
+    Returns:
+        the DetectionEvaluator
+    """
+    model.eval()
+    evaluator = DetectionEvaluator(classes, iou_threshold)
+    names = ['__background__'] + list(classes)
+    with torch.no_grad():
+        for images, targets in loader:
+            for prediction, target in zip(model(list(images)), targets):
+                evaluator.add([names[i] for i in prediction['labels'].tolist()], prediction['boxes'].numpy(), prediction['scores'].numpy(),
+                              [names[i] for i in target['labels'].tolist()], target['boxes'].numpy())
+    return evaluator
+
+def train(model, train_loader, val_loader, classes, output_path, epochs=10, lr=0.005, verbose=True) -> float:
+    """
+    Train a detecto model, saving the weights whenever the validation mAP improves
+    Args:
+        model: the detecto Model to train
+        train_loader: DataLoader of the training images
+        val_loader: DataLoader of the validation images (None to save after every epoch)
+        classes: list of unit abbreviations
+        output_path: the .pth file to save the best weights to
+        epochs: number of passes over the training images
+        lr: initial learning rate
+        verbose: print the loss and mAP of every epoch
+    Returns:
+        the best validation mAP
+    """
+    internal = model.get_internal_model()
+    parameters = [p for p in internal.parameters() if p.requires_grad]
+    # the same optimizer and schedule detecto's Model.fit uses
+    optimizer = torch.optim.SGD(parameters, lr=lr, momentum=0.9, weight_decay=0.0005)
+    scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=3, gamma=0.1)
+    best = -1.0
+    for epoch in range(epochs):
+        internal.train()
+        train_loader.sampler.set_epoch(epoch)
+        start = time.perf_counter()
+        losses, n = [], 0
+        for images, targets in train_loader:
+            loss = sum(internal(list(images), list(targets)).values())
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            losses.append(loss.item())
+            n += len(images)
+        scheduler.step()
+        elapsed = time.perf_counter() - start
+        score = validate(internal, val_loader, classes).mean_ap() if val_loader is not None else float('nan')
+        if verbose:
+            print(f'epoch {epoch + 1}/{epochs}: loss {np.mean(losses):.4f}, val mAP@0.5 {score:.4f}, {n / elapsed:.1f} images/sec')
+        # without a validation score every epoch is kept
+        if np.isnan(score) or score > best:
+            best = max(best, score) if not np.isnan(score) else best
+            model.save(str(output_path))
+    return best
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Train the unit detector on clean_data.')
+    # optional argument to specify the clean_data folders; default to ../clean_data/images and ../clean_data/labels
+    parser.add_argument('-i', '--images', help='Folder containing the images.')
+    parser.add_argument('-l', '--labels', help='Folder containing the label files.')
+    # optional argument to specify the shard folder; defaults to ../clean_data/shards
+    parser.add_argument('-s', '--shards', help='Folder containing the packed shards.')
+    # repack the shards even if they exist (e.g. after committing new data)
+    parser.add_argument('-p', '--pack', action='store_true', help='Repack the shards before training.')
+    # optional argument to specify where to save the weights; defaults to ../models/set6_trained_model.pth
+    parser.add_argument('-o', '--output', help='Path to save the best weights to.')
+    parser.add_argument('-e', '--epochs', type=int, default=10, help='Number of epochs to train for.')
+    parser.add_argument('-b', '--batch-size', type=int, default=2, help='Images per training step.')
+    parser.add_argument('--lr', type=float, default=0.005, help='Initial learning rate.')
+    # number of most recently committed images held out for validation
+    parser.add_argument('--val', type=int, default=200, help='Number of images to hold out for validation.')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='Number of DataLoader workers.')
+    parser.add_argument('--prefetch', type=int, default=4, help='Batches each DataLoader worker loads ahead.')
+    parser.add_argument('-t', '--torch-threads', type=int, help='Number of threads torch uses for training.')
+    args = parser.parse_args()
+    here = Path(__file__).parent
+    images_folder = Path(args.images) if args.images else here/'../clean_data/images'
+    labels_folder = Path(args.labels) if args.labels else here/'../clean_data/labels'
+    shard_folder = Path(args.shards) if args.shards else here/'../clean_data/shards'
+    output_path = Path(args.output) if args.output else here/'../models/set6_trained_model.pth'
+    classes = get_classes(here/'../clean_data/static/set6_classes.csv')
+    if args.torch_threads:
+        torch.set_num_threads(args.torch_threads)
+    def packed_version():
+        with open(shard_folder/'shards.json') as f:
+            return json.load(f)['version']
+    # shards from an older version (e.g. RGB images) are repacked automatically
+    if args.pack or not (shard_folder/'shards.json').exists() or packed_version() != SHARD_VERSION:
+        n = pack_shards(images_folder, labels_folder, classes, shard_folder, workers=os.cpu_count(), verbose=True)
+        print(f'Packed {n} images into {shard_folder}')
+    dataset = ShardDataset(shard_folder)
+    if dataset.classes != classes:
+        raise Exception(f'{shard_folder} was packed with different classes; repack it with -p')
+    # the shards are in stem order, so the last images are the most recently committed
+    n_val = held_out_count(len(dataset), args.val)
+    train_indices = np.arange(len(dataset) - n_val)
+    val_indices = np.arange(len(dataset) - n_val, len(dataset))
+    train_loader = make_loader(dataset, args.batch_size, args.workers, args.prefetch, shuffle=True, indices=train_indices)
+    val_loader = make_loader(dataset, args.batch_size, args.workers, args.prefetch, shuffle=False, indices=val_indices) if n_val else None
+    model = detecto.core.Model(classes)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    print(f'Training on {len(train_indices)} images, validating on {len(val_indices)}')
+    best = train(model, train_loader, val_loader, classes, output_path, args.epochs, args.lr)
+    print(f'Best validation mAP@0.5 {best:.4f}; weights saved to {output_path} (load them with -m {output_path} -f {here/"../clean_data/static/set6_classes.csv"})')
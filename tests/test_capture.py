@@ -0,0 +1,34 @@
+import os
+import pytest
+from PIL import Image
+from capture import ImageDirectoryBackend, Recorder, convert_to_png
+
+@pytest.fixture
+def frames(tmp_path):
+    folder = tmp_path/'frames'
+    folder.mkdir()
+    for i in range(5):
+        Image.new('RGB', (32, 24), (40*i, 0, 0)).save(folder/f'{i}.png')
+    return folder
+
+@pytest.mark.parametrize('image_format', ['png', 'webp'])
+def test_recorder_writes_every_frame(frames, tmp_path, image_format):
+    out = tmp_path/'out'
+    recorder = Recorder(ImageDirectoryBackend(frames), out, fps=200, image_format=image_format, first_index=3).start()
+    recorder.wait(10)
+    assert recorder.saved == 5
+    # only finished frames are in the folder, no temporary files
+    assert sorted(os.listdir(out)) == [f'{i}.{image_format}' for i in range(3, 8)]
+    with Image.open(out/f'7.{image_format}') as im:
+        assert im.size == (32, 24) and im.getpixel((0, 0)) == (160, 0, 0)
+
+def test_convert_to_png(frames, tmp_path):
+    Image.new('RGB', (8, 8), (1, 2, 3)).save(tmp_path/'9.webp', lossless=True)
+    png_path = convert_to_png(tmp_path/'9.webp')
+    assert png_path == tmp_path/'9.png' and not (tmp_path/'9.webp').exists()
+    with Image.open(png_path) as im:
+        assert im.format == 'PNG' and im.getpixel((0, 0)) == (1, 2, 3)
+    assert convert_to_png(frames/'0.png') == frames/'0.png'
+    Image.new('RGB', (8, 8)).save(frames/'0.webp', lossless=True)
+    with pytest.raises(FileExistsError):
+        convert_to_png(frames/'0.webp')
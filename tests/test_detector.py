@@ -0,0 +1,90 @@
+import threading
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+from detector import REGIONS, Detector, load_detector, parse_regions
+
+class FakeModel:
+    """
+    Finds one 10x10 box at the top left of every image it's given
+    """
+    def __init__(self):
+        self.shapes = []
+
+    def predict(self, images):
+        self.shapes.extend(image.shape for image in images)
+        return [(['Ahri'], torch.tensor([[0, 0, 10, 10]], dtype=torch.float32), torch.tensor([0.9])) for _ in images]
+
+def test_regions_are_fractions_of_the_frame():
+    board = REGIONS['board']
+    assert all(0 <= v <= 1 for v in board)
+    assert parse_regions(['board']) == [board]
+    assert parse_regions(['380:150:1540:760']) == [board]
+    with pytest.raises(ValueError):
+        parse_regions(['10:10:5:20'])
+    with pytest.raises(ValueError):
+        parse_regions(['kitchen'])
+
+@pytest.mark.parametrize('width, height', [(1920, 1080), (1280, 720), (2560, 1440)])
+def test_regions_scale_with_the_frame(width, height):
+    model = FakeModel()
+    detector = Detector(model, ['Ahri'], None, regions=parse_regions(['board', 'shop']))
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+    (labels, boxes, scores), = detector.predict_raw([image])
+    s = width / 1920
+    assert model.shapes == [(round(760*s) - round(150*s), round(1540*s) - round(380*s), 3), (height - round(920*s), round(1500*s) - round(470*s), 3)]
+    # boxes come back in full frame coordinates
+    assert labels == ['Ahri', 'Ahri']
+    assert boxes.tolist() == [[round(380*s), round(150*s), round(380*s) + 10, round(150*s) + 10],
+                              [round(470*s), round(920*s), round(470*s) + 10, round(920*s) + 10]]
+
+def test_torchscript_rejects_regions(tmp_path):
+    (tmp_path/'model.pt').write_bytes(b'')
+    (tmp_path/'labels.csv').write_text('Ahri, Ahri\n')
+    with pytest.raises(ValueError):
+        load_detector(tmp_path/'model.pt', tmp_path/'labels.csv', regions=parse_regions(['board']), engine='torchscript')
+
+class FakeDetecto:
+    # the parts of a detecto Model the detector uses
+    def __init__(self, network):
+        self._model = network
+        self._classes = ['__background__', 'Ahri', 'Zed']
+        self._device = torch.device('cpu')
+
+    def predict(self, images):
+        tensors = [torch.from_numpy(np.ascontiguousarray(image)).permute(2, 0, 1).float().div_(255) for image in images]
+        with torch.no_grad():
+            predictions = self._model(tensors)
+        return [([self._classes[i] for i in p['labels'].tolist()], p['boxes'], p['scores']) for p in predictions]
+
+def test_regions_leave_the_model_alone():
+    torchvision = pytest.importorskip('torchvision')
+    torch.manual_seed(0)
+    network = torchvision.models.detection.fasterrcnn_mobilenet_v3_large_320_fpn(
+        weights=None, weights_backbone=None, num_classes=3, box_score_thresh=0.0).eval()
+    sizes = (tuple(network.transform.min_size), network.transform.max_size)
+    detector = Detector(FakeDetecto(network), ['Ahri', 'Zed'], None, regions=parse_regions(['board']), scale=0.5)
+    images = [np.random.default_rng(i).integers(0, 255, (720, 1280, 3), dtype=np.uint8) for i in range(2)]
+    full_frame = Detector(FakeDetecto(network), ['Ahri', 'Zed'], None)
+    expected = full_frame.predict_raw(images)
+    # region and full frame predictions on the same model at the same time
+    errors = []
+    def run_regions():
+        try:
+            for _ in range(3):
+                for labels, boxes, scores in detector.predict_raw(images):
+                    x0, y0, x1, y1 = [round(v * s) for v, s in zip(REGIONS['board'], (1280, 720, 1280, 720))]
+                    if len(boxes):
+                        assert boxes[:, 0].min() >= x0 - 1 and boxes[:, 2].max() <= x1 + 1
+                        assert boxes[:, 1].min() >= y0 - 1 and boxes[:, 3].max() <= y1 + 1
+        except Exception as e:
+            errors.append(e)
+    thread = threading.Thread(target=run_regions)
+    thread.start()
+    for _ in range(3):
+        for (labels, boxes, _), (expected_labels, expected_boxes, _) in zip(full_frame.predict_raw(images), expected):
+            assert labels == expected_labels and torch.allclose(boxes, expected_boxes)
+    thread.join()
+    assert not errors
+    assert (tuple(network.transform.min_size), network.transform.max_size) == sizes
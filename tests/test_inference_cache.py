@@ -0,0 +1,91 @@
+import sqlite3
+import subprocess
+import sys
+from pathlib import Path
+import numpy as np
+from inference_cache import InferenceCache
+
+BOXES = np.array([[1, 2, 3, 4], [5, 6, 7, 8]], dtype=np.float32)
+SCORES = np.array([0.9, 0.5], dtype=np.float32)
+
+def put(cache, image_hash):
+    cache.put(image_hash, ['Ahri', 'Zed'], BOXES, SCORES, (10, 20, 3))
+
+def test_round_trip(tmp_path):
+    with InferenceCache(tmp_path/'cache.sqlite', 'model') as cache:
+        put(cache, 'a')
+        labels, boxes, scores, shape = cache.get('a')
+        assert labels == ['Ahri', 'Zed']
+        assert np.array_equal(boxes, BOXES) and np.array_equal(scores, SCORES)
+        assert shape == (10, 20, 3)
+        assert cache.get('b') is None
+    with InferenceCache(tmp_path/'cache.sqlite', 'model') as cache:
+        assert cache.get('a')[0] == ['Ahri', 'Zed']
+    # another model's predictions are a miss
+    with InferenceCache(tmp_path/'cache.sqlite', 'other') as cache:
+        assert cache.get('a') is None
+
+def test_two_handles_at_once(tmp_path):
+    # two processes sharing the file (e.g. two auto_label.py shards) must not lock each other out
+    a = InferenceCache(tmp_path/'cache.sqlite', 'model', flush_every=1, timeout=1.0)
+    b = InferenceCache(tmp_path/'cache.sqlite', 'model', flush_every=1, timeout=1.0)
+    try:
+        put(a, 'a')
+        put(b, 'b')
+        assert b.get('a') is not None
+        assert a.get('b') is not None
+        put(a, 'c')
+        put(b, 'd')
+    finally:
+        a.close()
+        b.close()
+
+def test_buffered_writes_dont_hold_the_lock(tmp_path):
+    a = InferenceCache(tmp_path/'cache.sqlite', 'model', flush_every=1000, flush_interval=1000)
+    try:
+        put(a, 'a')
+        # a's put is still buffered, but the file is free for another writer
+        with sqlite3.connect(str(tmp_path/'cache.sqlite'), timeout=0.1) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('ROLLBACK')
+        assert a.get('a') is not None
+    finally:
+        a.close()
+
+def test_size_cap_counts_every_handle(tmp_path):
+    size = BOXES.nbytes + SCORES.nbytes + len('Ahri,Zed')
+    a = InferenceCache(tmp_path/'cache.sqlite', 'model', max_bytes=10*size, flush_every=1)
+    b = InferenceCache(tmp_path/'cache.sqlite', 'model', max_bytes=10*size, flush_every=1)
+    try:
+        for i in range(8):
+            put(a, f'a{i}')
+        for i in range(8):
+            put(b, f'b{i}')
+        # neither handle wrote more than the cap, but together they did
+        assert a.total_bytes() <= 10*size
+        count = a._conn.execute('SELECT COUNT(*), SUM(size) FROM predictions').fetchone()
+        assert count[1] == a.total_bytes() == b.total_bytes()
+        assert count[0] <= 10
+        # the oldest entries went first
+        assert a.get('a0') is None and b.get('b7') is not None
+    finally:
+        a.close()
+        b.close()
+
+def test_concurrent_processes(tmp_path):
+    script = (
+        'import sys\n'
+        'import numpy as np\n'
+        'from inference_cache import InferenceCache\n'
+        'with InferenceCache(sys.argv[1], "model", flush_every=4, timeout=10.0) as cache:\n'
+        '    for i in range(200):\n'
+        '        cache.put(f"{sys.argv[2]}{i}", ["Ahri"], np.zeros((1, 4)), np.ones(1), (1, 1, 3))\n'
+        '        cache.get(f"{sys.argv[2]}{i // 2}")\n')
+    src = Path(__file__).resolve().parent.parent/'src'
+    workers = [subprocess.Popen([sys.executable, '-c', script, str(tmp_path/'cache.sqlite'), name], cwd=src, stderr=subprocess.PIPE)
+               for name in 'abc']
+    for worker in workers:
+        _, err = worker.communicate(timeout=60)
+        assert worker.returncode == 0, err.decode()
+    with InferenceCache(tmp_path/'cache.sqlite', 'model') as cache:
+        assert all(cache.get(f'{name}{i}') is not None for name in 'abc' for i in range(200))
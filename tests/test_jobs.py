@@ -0,0 +1,73 @@
+import subprocess
+import sys
+from pathlib import Path
+import pytest
+from inference_cache import InferenceCache
+from jobs import Journal, Progress, job_files, job_status, parse_shard, select_shard
+
+def test_parse_shard():
+    assert parse_shard('1/4') == (1, 4)
+    with pytest.raises(ValueError):
+        parse_shard('4/4')
+    with pytest.raises(ValueError):
+        parse_shard('one/4')
+
+def test_shards_partition_the_items():
+    paths = [Path(f'screenshots/{i}.png') for i in range(1000)]
+    shards = [select_shard(paths, k, 4) for k in range(4)]
+    assert sorted(p for shard in shards for p in shard) == sorted(paths)
+    assert all(shards)
+    # the split only depends on the name, so adding items doesn't move the old ones
+    more = paths + [Path(f'screenshots/{i}.png') for i in range(1000, 1100)]
+    assert set(shards[0]) <= set(select_shard(more, 0, 4))
+
+def test_journal_resumes_and_redoes_a_cut_record(tmp_path):
+    with Journal(tmp_path/'shard.journal') as journal:
+        journal.record('0.png')
+        journal.record('1.png')
+    # a crash in the middle of a record
+    with open(tmp_path/'shard.journal', 'a') as f:
+        f.write('2.p')
+    with Journal(tmp_path/'shard.journal') as journal:
+        assert '0.png' in journal and '1.png' in journal and '2.p' not in journal
+        journal.record('2.png')
+    with Journal(tmp_path/'shard.journal') as journal:
+        assert journal.done == {'0.png', '1.png', '2.png'}
+
+def test_progress_files(tmp_path):
+    journal_path, progress_path = job_files(tmp_path, 1, 2)
+    progress = Progress(progress_path, total=10, done=4, shard='1/2')
+    progress.update(6)
+    progress.write()
+    status = job_status(tmp_path)
+    assert len(status) == 1
+    assert status[0]['shard'] == '1/2' and status[0]['finished']
+
+def test_shards_share_the_inference_cache(tmp_path):
+    # what `auto_label.py --shard K/N` does on one host: a journal each and the default shared cache
+    script = (
+        'import sys\n'
+        'from pathlib import Path\n'
+        'import numpy as np\n'
+        'from inference_cache import InferenceCache\n'
+        'from jobs import Journal, job_files, select_shard\n'
+        'folder, k = Path(sys.argv[1]), int(sys.argv[2])\n'
+        'images = select_shard([f"{i}.png" for i in range(300)], k, 3)\n'
+        'journal_path, _ = job_files(folder/"jobs", k, 3)\n'
+        'with InferenceCache(folder/"cache.sqlite", "model", timeout=10.0) as cache, Journal(journal_path) as journal:\n'
+        '    for name in images:\n'
+        '        cache.put(name, ["Ahri"], np.zeros((1, 4)), np.ones(1), (1, 1, 3))\n'
+        '        journal.record(name)\n')
+    src = Path(__file__).resolve().parent.parent/'src'
+    workers = [subprocess.Popen([sys.executable, '-c', script, str(tmp_path), str(k)], cwd=src, stderr=subprocess.PIPE)
+               for k in range(3)]
+    for worker in workers:
+        _, err = worker.communicate(timeout=60)
+        assert worker.returncode == 0, err.decode()
+    done = set()
+    for k in range(3):
+        with Journal(job_files(tmp_path/'jobs', k, 3)[0]) as journal:
+            done |= journal.done
+    assert done == {f'{i}.png' for i in range(300)}
+    with InferenceCache(tmp_path/'cache.sqlite', 'model') as cache:
+        assert all(cache.get(f'{i}.png') is not None for i in range(300))
@@ -0,0 +1,90 @@
+import pytest
+from PIL import Image
+from annotations import Annotation, location_of, read_location, write_annotation
+from manifest import apply_commit, bootstrap_manifest, journal_path, load_journal, next_id, relocate, rollback_commit, start_commit
+
+@pytest.fixture
+def batch(tmp_path):
+    # three verified screenshots and labels, and an empty clean_data
+    source_images, source_labels = tmp_path/'screenshots', tmp_path/'labels'
+    clean_images, clean_labels = tmp_path/'clean_data/images', tmp_path/'clean_data/labels'
+    for folder in (source_images, source_labels, clean_images, clean_labels):
+        folder.mkdir(parents=True)
+    moves = []
+    for i, name in enumerate(['a', 'b', 'c']):
+        image_path = source_images/f'{name}.png'
+        Image.new('RGB', (4, 4), (i, 0, 0)).save(image_path)
+        annotation = Annotation(*location_of(image_path), 4, 4, 3)
+        annotation.add('Ahri', (0, 0, 1, 1))
+        write_annotation(source_labels/f'{name}.xml', annotation)
+        moves.append((i, image_path, source_labels/f'{name}.xml', clean_images/f'{i}.png', clean_labels/f'{i}.xml'))
+    return tmp_path/'clean_data/manifest.csv', moves
+
+def manifest_ids(manifest_path):
+    with open(manifest_path) as f:
+        return [int(line.split(',')[0]) for line in f.readlines()[1:]]
+
+def test_commit(batch):
+    manifest_path, moves = batch
+    assert next_id(manifest_path, moves[0][3].parent) == 0
+    apply_commit(start_commit(manifest_path, moves))
+    for _, source_image, source_label, dest_image, dest_label in moves:
+        assert not source_image.exists() and not source_label.exists()
+        assert read_location(dest_label) == location_of(dest_image)
+    assert manifest_ids(manifest_path) == [0, 1, 2]
+    assert next_id(manifest_path, moves[0][3].parent) == 3
+    assert load_journal(manifest_path) is None
+
+def interrupt(moves, done):
+    # what apply_commit leaves behind if it is killed after moving `done` files
+    for _, source_image, source_label, dest_image, dest_label in moves[:done]:
+        relocate(source_label, dest_image, out_path=dest_label)
+        source_image.replace(dest_image)
+
+@pytest.mark.parametrize('done', [0, 1, 3])
+def test_resume(batch, done):
+    manifest_path, moves = batch
+    next_id(manifest_path, moves[0][3].parent)
+    start_commit(manifest_path, moves)
+    interrupt(moves, done)
+    journal = load_journal(manifest_path)
+    assert journal is not None
+    apply_commit(journal)
+    assert all(dest_image.exists() and dest_label.exists() for *_, dest_image, dest_label in moves)
+    assert not any(source_image.exists() or source_label.exists() for _, source_image, source_label, _, _ in moves)
+    assert manifest_ids(manifest_path) == [0, 1, 2]
+    assert not journal_path(manifest_path).exists()
+    # resuming twice doesn't record the batch twice
+    start_commit(manifest_path, moves)
+    apply_commit(load_journal(manifest_path))
+    assert manifest_ids(manifest_path) == [0, 1, 2]
+
+@pytest.mark.parametrize('done', [0, 2, 3])
+def test_rollback(batch, done):
+    manifest_path, moves = batch
+    next_id(manifest_path, moves[0][3].parent)
+    start_commit(manifest_path, moves)
+    interrupt(moves, done)
+    rollback_commit(load_journal(manifest_path))
+    for _, source_image, source_label, dest_image, dest_label in moves:
+        assert source_image.exists() and not dest_image.exists() and not dest_label.exists()
+        assert read_location(source_label) == location_of(source_image)
+    assert manifest_ids(manifest_path) == []
+    assert load_journal(manifest_path) is None
+
+def test_rollback_refuses_a_recorded_batch(batch):
+    manifest_path, moves = batch
+    next_id(manifest_path, moves[0][3].parent)
+    journal = start_commit(manifest_path, moves)
+    apply_commit(journal)
+    # the journal is gone once the batch is recorded; put it back as if the final unlink was lost
+    start_commit(manifest_path, moves)
+    with pytest.raises(ValueError):
+        rollback_commit(load_journal(manifest_path))
+
+def test_bootstrap(tmp_path):
+    for stem in (0, 1, 5):
+        (tmp_path/f'{stem}.png').write_bytes(b'')
+    bootstrap_manifest(tmp_path/'manifest.csv', tmp_path)
+    assert manifest_ids(tmp_path/'manifest.csv') == [0, 1, 5]
+    assert next_id(tmp_path/'manifest.csv', tmp_path) == 6
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+from metrics import DetectionEvaluator, average_precision, box_iou, match_detections, match_image
+
+def test_box_iou():
+    ious = box_iou([[0, 0, 10, 10], [5, 5, 15, 15]], [[0, 0, 10, 10], [20, 20, 30, 30], [0, 0, 0, 0]])
+    assert ious.shape == (2, 3)
+    assert ious[0, 0] == 1.0
+    assert ious[1, 0] == pytest.approx(25 / 175)
+    assert (ious[:, 1:] == 0).all()
+    assert box_iou(np.zeros((0, 4)), [[0, 0, 1, 1]]).shape == (0, 1)
+
+def test_match_highest_score_first():
+    # both detections overlap the same box best; the higher scoring one gets it even though it comes second
+    gt = [[0, 0, 10, 10]]
+    matches = match_detections([[0, 0, 10, 9], [0, 0, 10, 10]], [0.5, 0.9], gt)
+    assert matches.tolist() == [-1, 0]
+
+def test_match_takes_next_best_box():
+    gt = [[0, 0, 10, 10], [1, 0, 11, 10]]
+    matches = match_detections([[0, 0, 10, 10], [0, 0, 10, 10]], [0.9, 0.8], gt)
+    assert matches.tolist() == [0, 1]
+    assert match_detections([[0, 0, 10, 10]], [0.9], gt, iou_threshold=1.01).tolist() == [-1]
+
+def test_match_image_keeps_units_apart():
+    boxes = [[0, 0, 10, 10], [20, 20, 30, 30]]
+    matches = match_image([0, 1], boxes, [0.9, 0.9], [1, 1], boxes)
+    assert matches.tolist() == [-1, 1]
+
+def naive_match(ious, scores, iou_threshold):
+    matches, taken = [-1] * len(scores), set()
+    for i in sorted(range(len(scores)), key=lambda i: -scores[i]):
+        best, best_iou = -1, iou_threshold
+        for j in range(ious.shape[1]):
+            if j not in taken and ious[i, j] >= best_iou and (best < 0 or ious[i, j] > ious[i, best]):
+                best, best_iou = j, ious[i, j]
+        if best >= 0:
+            matches[i] = best
+            taken.add(best)
+    return matches
+
+def test_match_agrees_with_naive_greedy():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        gt = rng.uniform(0, 50, (rng.integers(0, 6), 2))
+        gt = np.hstack([gt, gt + rng.uniform(5, 20, gt.shape)])
+        pred = gt[rng.integers(0, len(gt), rng.integers(0, 8))] if len(gt) else np.zeros((0, 4))
+        pred = pred + rng.normal(0, 3, pred.shape)
+        scores = rng.uniform(size=len(pred))
+        expected = naive_match(box_iou(pred, gt), scores, 0.5)
+        assert match_detections(pred, scores, gt).tolist() == expected
+
+def test_average_precision():
+    # ranked tp, fp, tp over 3 boxes: precision 1 up to recall 1/3, then 2/3 up to recall 2/3
+    assert average_precision([0.9, 0.8, 0.7], [True, False, True], 3) == pytest.approx(1 / 3 + 2 / 3 / 3)
+    # the order of the input doesn't matter, only the scores
+    assert average_precision([0.7, 0.9, 0.8], [True, True, False], 3) == pytest.approx(1 / 3 + 2 / 3 / 3)
+    assert average_precision([0.9, 0.8], [True, True], 2) == 1.0
+    assert average_precision([], [], 2) == 0.0
+    assert np.isnan(average_precision([0.9], [False], 0))
+
+def test_evaluator():
+    evaluator = DetectionEvaluator(['Ahri', 'Zed', 'Lux'])
+    # image 1: Ahri found, Zed detected as Ahri, a spurious Zed, and an unknown unit that is ignored
+    evaluator.add(['Ahri', 'Ahri', 'Zed', 'Teemo'], [[0, 0, 10, 10], [20, 20, 30, 30], [50, 50, 60, 60], [0, 0, 10, 10]],
+                  [0.9, 0.8, 0.3, 0.99], ['Ahri', 'Zed'], [[0, 0, 10, 10], [20, 20, 30, 30]])
+    # image 2: Zed found, an Ahri missed
+    evaluator.add(['Zed'], [[0, 0, 10, 10]], [0.6], ['Zed', 'Ahri'], [[0, 0, 10, 10], [40, 40, 50, 50]])
+    aps = evaluator.average_precisions()
+    # Ahri: tp (0.9), fp (0.8) over 2 boxes
+    assert aps['Ahri'] == pytest.approx(0.5)
+    # Zed: tp (0.6), fp (0.3) over 2 boxes
+    assert aps['Zed'] == pytest.approx(0.5)
+    assert np.isnan(aps['Lux'])
+    assert evaluator.mean_ap() == pytest.approx(0.5)
+    pr = evaluator.precision_recall(score_threshold=0.5)
+    assert pr['Ahri'] == {'precision': 0.5, 'recall': 0.5, 'true_positives': 1, 'false_positives': 1, 'ground_truth': 2}
+    assert pr['Zed']['precision'] == 1.0 and pr['Zed']['false_positives'] == 0
+    assert np.isnan(pr['Lux']['precision']) and np.isnan(pr['Lux']['recall'])
+    ahri, zed, lux, background = range(4)
+    assert evaluator.confusion[ahri, ahri] == 1 and evaluator.confusion[zed, zed] == 1
+    assert evaluator.confusion[zed, ahri] == 1
+    assert evaluator.confusion[ahri, background] == 1
+    assert evaluator.confusion[background, zed] == 1
+    assert evaluator.confusion.sum() == 5
+    assert set(evaluator.confusions()) == {('Zed', 'Ahri', 1), ('Ahri', 'background', 1), ('background', 'Zed', 1)}
+
+def test_empty_evaluator():
+    evaluator = DetectionEvaluator(['Ahri'])
+    assert np.isnan(evaluator.mean_ap())
+    evaluator.add([], [], [], ['Ahri'], [[0, 0, 1, 1]])
+    assert evaluator.average_precisions() == {'Ahri': 0.0}
+    assert evaluator.confusions() == [('Ahri', 'background', 1)]
@@ -0,0 +1,86 @@
+import subprocess
+import sys
+from pathlib import Path
+import numpy as np
+from PIL import Image
+from annotations import Annotation, location_of, read_annotation, read_location, write_annotation
+from dedup import dhash_files, load_dataset_hashes
+from manifest import append_manifest, bootstrap_manifest
+from repair_integrity import order_renames, plan_ids, repair_dataset
+
+def test_plan_keeps_the_order():
+    assert plan_ids([0, 2, 5, 7]) == {2: 1, 5: 2, 7: 3}
+    assert plan_ids([3, 1, 0, 2]) == {}
+    assert plan_ids([10, 11, 12]) == {10: 0, 11: 1, 12: 2}
+
+def test_renames_never_land_on_a_file():
+    rng = np.random.default_rng(0)
+    for _ in range(100):
+        stems = set(rng.choice(60, size=rng.integers(1, 40), replace=False).tolist())
+        files = set(stems)
+        for src, dst in order_renames(plan_ids(stems)):
+            assert dst not in files
+            files.remove(src)
+            files.add(dst)
+        assert files == set(range(len(stems)))
+
+def make_dataset(tmp_path, stems):
+    images_folder, labels_folder = tmp_path/'images', tmp_path/'labels'
+    images_folder.mkdir()
+    labels_folder.mkdir()
+    rng = np.random.default_rng(1)
+    for stem in stems:
+        image_path = images_folder/f'{stem}.png'
+        Image.fromarray(rng.integers(0, 255, (16, 16, 3), dtype=np.uint8)).save(image_path)
+        annotation = Annotation(*location_of(image_path), 16, 16, 3)
+        # remember which image the label was made for
+        annotation.add(f'unit{stem}', (0, 0, 1, 1))
+        write_annotation(labels_folder/f'{stem}.xml', annotation)
+    return images_folder, labels_folder
+
+def test_repair_renumbers_in_order(tmp_path):
+    images_folder, labels_folder = make_dataset(tmp_path, [0, 2, 5, 7])
+    manifest_path = tmp_path/'manifest.csv'
+    bootstrap_manifest(manifest_path, images_folder)
+    hashes = dict(zip(['0', '2', '5', '7'], dhash_files([images_folder/f'{stem}.png' for stem in (0, 2, 5, 7)]).tolist()))
+    load_dataset_hashes(images_folder, tmp_path/'hashes.npz')
+
+    assert repair_dataset(images_folder, labels_folder, workers=1, dry_run=True, verbose=False) == (3, 3)
+    assert sorted(p.name for p in images_folder.iterdir()) == ['0.png', '2.png', '5.png', '7.png']
+
+    assert repair_dataset(images_folder, labels_folder, workers=1, verbose=False) == (3, 3)
+    assert sorted(p.name for p in images_folder.iterdir()) == ['0.png', '1.png', '2.png', '3.png']
+    for new, old in enumerate([0, 2, 5, 7]):
+        assert read_annotation(labels_folder/f'{new}.xml').names == [f'unit{old}']
+        assert read_location(labels_folder/f'{new}.xml') == location_of(images_folder/f'{new}.png')
+    # the manifest and the saved hashes follow the renames
+    with open(manifest_path) as f:
+        assert [line.split(',')[0] for line in f.readlines()[1:]] == ['0', '1', '2', '3']
+    index = load_dataset_hashes(images_folder, tmp_path/'hashes.npz')
+    assert dict(zip(index.names, index.hashes().tolist())) == {str(new): hashes[str(old)] for new, old in enumerate([0, 2, 5, 7])}
+    # nothing left to do
+    assert repair_dataset(images_folder, labels_folder, workers=1, verbose=False) == (0, 0)
+
+def test_repair_keeps_the_newest_images_last(tmp_path):
+    images_folder, labels_folder = make_dataset(tmp_path, [1, 3, 4, 9, 20])
+    manifest_path = tmp_path/'manifest.csv'
+    bootstrap_manifest(manifest_path, images_folder)
+    append_manifest(manifest_path, [(21, 'new.png')])
+    repair_dataset(images_folder, labels_folder, workers=1, verbose=False)
+    assert [read_annotation(labels_folder/f'{i}.xml').names[0] for i in range(5)] == ['unit1', 'unit3', 'unit4', 'unit9', 'unit20']
+    # entries for images that are gone are dropped
+    with open(manifest_path) as f:
+        assert [line.split(',')[0] for line in f.readlines()[1:]] == ['0', '1', '2', '3', '4']
+
+def test_check_is_read_only(tmp_path):
+    images_folder, labels_folder = make_dataset(tmp_path, [0, 1, 3])
+    load_dataset_hashes(images_folder, tmp_path/'hashes.npz')
+    (images_folder/'4.png').write_bytes((images_folder/'0.png').read_bytes())
+    before = {p: p.stat().st_mtime_ns for p in tmp_path.rglob('*')}
+    src = Path(__file__).resolve().parent.parent/'src'
+    result = subprocess.run([sys.executable, src/'repair_integrity.py', '--check', '-i', images_folder, '-l', labels_folder],
+                            capture_output=True, text=True)
+    assert result.returncode == 1
+    assert '4.png has no label' in result.stdout
+    assert 'saved image hashes are missing or out of date' in result.stdout
+    assert {p: p.stat().st_mtime_ns for p in tmp_path.rglob('*')} == before